@@ -0,0 +1,353 @@
+# Nearest-neighbor indexes of the retrieval database (one index for each agent type)
+# ExactIndex is the brute-force L2 search (same results as the dense search in generate_context.py),
+# IVFFlatIndex is an inverted-file index: the vectors are clustered by k-means (numpy, on CPU) and a query
+# only scans the vectors of the `nprobe` closest clusters
+# Both indexes run on CPU with numpy, and are saved as .npy files loaded with mmap
+
+
+import os
+import json
+
+import numpy as np
+
+
+INDEX_META_FILE = 'meta.json'
+
+
+def compute_squared_dist(queries, vectors, vectors_sqr_norm=None):
+    """
+    Args:
+        queries (num_queries, C):
+        vectors (num_vectors, C):
+        vectors_sqr_norm (num_vectors): precomputed ||vectors||^2
+
+    Returns:
+        sqr_dist (num_queries, num_vectors): ||a||^2 + ||b||^2 - 2ab
+    """
+    if vectors_sqr_norm is None:
+        vectors_sqr_norm = (vectors.astype(np.float32) ** 2).sum(axis=-1)
+    queries_sqr_norm = (queries ** 2).sum(axis=-1)
+    sqr_dist = queries_sqr_norm[:, None] + vectors_sqr_norm[None, :] - 2 * queries @ vectors.astype(np.float32).T
+    return np.maximum(sqr_dist, 0)
+
+
+def select_topk(sqr_dist, ids, k):
+    """
+    Args:
+        sqr_dist (num_queries, num_candidates): squared L2 distances, inf for invalid candidates
+        ids (num_candidates) or (num_queries, num_candidates): the ids of candidates
+        k (int):
+
+    Returns:
+        topk_sqr_dists (num_queries, k): in ascending order, inf for padding
+        topk_idxs (num_queries, k): -1 for padding (if there are less than k valid candidates)
+    """
+    num_queries, num_candidates = sqr_dist.shape
+    ids = np.broadcast_to(ids, sqr_dist.shape)
+    if num_candidates < k:
+        sqr_dist = np.concatenate((sqr_dist, np.full((num_queries, k - num_candidates), np.inf, dtype=np.float32)), axis=-1)
+        ids = np.concatenate((ids, np.full((num_queries, k - num_candidates), -1, dtype=np.int64)), axis=-1)
+    elif num_candidates > k:
+        candidate_idxs = np.argpartition(sqr_dist, k - 1, axis=-1)[:, :k]
+        sqr_dist = np.take_along_axis(sqr_dist, candidate_idxs, axis=-1)
+        ids = np.take_along_axis(ids, candidate_idxs, axis=-1)
+
+    order = np.argsort(sqr_dist, axis=-1, kind='stable')
+    topk_sqr_dists = np.take_along_axis(sqr_dist, order, axis=-1).astype(np.float32)
+    topk_idxs = np.where(np.isinf(topk_sqr_dists), -1, np.take_along_axis(ids, order, axis=-1)).astype(np.int64)
+    return topk_sqr_dists, topk_idxs
+
+
+def exact_search(queries, vectors, k, vectors_sqr_norm=None, chunk_size=65536):
+    """
+    Brute-force L2 search, the vectors are scanned in chunks and merged into a running top-k
+
+    Args:
+        queries (num_queries, C): C can be smaller than the dim of vectors (only the first C dims are used)
+        vectors (num_vectors, D):
+        vectors_sqr_norm (num_vectors): precomputed ||vectors||^2 (only used if C == D)
+
+    Returns:
+        topk_dists (num_queries, k): L2 distances, inf for padding
+        topk_idxs (num_queries, k): -1 for padding
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    num_queries, num_dims = queries.shape
+    if num_dims != vectors.shape[1]:
+        vectors_sqr_norm = None
+
+    topk_sqr_dists = np.full((num_queries, k), np.inf, dtype=np.float32)
+    topk_idxs = np.full((num_queries, k), -1, dtype=np.int64)
+    for start_idx in range(0, len(vectors), chunk_size):
+        cur_vectors = vectors[start_idx:start_idx + chunk_size, :num_dims]
+        cur_sqr_norm = None if vectors_sqr_norm is None else vectors_sqr_norm[start_idx:start_idx + chunk_size]
+        cur_sqr_dist = compute_squared_dist(queries, cur_vectors, cur_sqr_norm)
+        cur_ids = np.arange(start_idx, start_idx + len(cur_vectors))
+
+        # merge with the running top-k
+        topk_sqr_dists, topk_idxs = select_topk(
+            np.concatenate((topk_sqr_dists, cur_sqr_dist), axis=-1),
+            np.concatenate((topk_idxs, np.broadcast_to(cur_ids, cur_sqr_dist.shape)), axis=-1), k
+        )
+    return np.sqrt(topk_sqr_dists), topk_idxs
+
+
+def kmeans(vectors, num_clusters, num_iters=20, max_train_points=None, seed=0, chunk_size=16384):
+    """
+    Args:
+        vectors (num_vectors, C):
+        num_clusters (int):
+        max_train_points (int): train on a random subset of vectors if given
+
+    Returns:
+        centroids (num_clusters, C):
+    """
+    rng = np.random.RandomState(seed)
+    if max_train_points is not None and len(vectors) > max_train_points:
+        vectors = vectors[np.sort(rng.choice(len(vectors), max_train_points, replace=False))]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    num_clusters = min(num_clusters, len(vectors))
+
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(num_iters):
+        assignment = assign_to_centroids(vectors, centroids, chunk_size=chunk_size)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        new_centroids = np.zeros_like(centroids)
+        np.add.at(new_centroids, assignment, vectors)
+
+        empty_mask = counts == 0
+        new_centroids[~empty_mask] /= counts[~empty_mask, None]
+        # re-seed the empty clusters with random vectors
+        new_centroids[empty_mask] = vectors[rng.choice(len(vectors), empty_mask.sum(), replace=False)]
+        centroids = new_centroids
+    return centroids
+
+
+def assign_to_centroids(vectors, centroids, chunk_size=16384):
+    centroids_sqr_norm = (centroids ** 2).sum(axis=-1)
+    assignment = np.zeros(len(vectors), dtype=np.int64)
+    for start_idx in range(0, len(vectors), chunk_size):
+        cur_vectors = np.asarray(vectors[start_idx:start_idx + chunk_size], dtype=np.float32)
+        assignment[start_idx:start_idx + chunk_size] = compute_squared_dist(cur_vectors, centroids, centroids_sqr_norm).argmin(axis=-1)
+    return assignment
+
+
+class ExactIndex(object):
+    def __init__(self, vectors=None, vectors_sqr_norm=None):
+        self.vectors = vectors
+        self.vectors_sqr_norm = vectors_sqr_norm
+
+    @property
+    def num_vectors(self):
+        return len(self.vectors)
+
+    def build(self, vectors):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.vectors_sqr_norm = (self.vectors ** 2).sum(axis=-1)
+        return self
+
+    def search(self, queries, k, nprobe=None):
+        return exact_search(queries, self.vectors, k, vectors_sqr_norm=self.vectors_sqr_norm)
+
+    def save(self, index_path):
+        os.makedirs(index_path, exist_ok=True)
+        np.save(os.path.join(index_path, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(index_path, 'vectors_sqr_norm.npy'), self.vectors_sqr_norm)
+        with open(os.path.join(index_path, INDEX_META_FILE), 'w') as f:
+            json.dump({'name': 'exact', 'num_vectors': self.num_vectors}, f)
+
+    @classmethod
+    def load(cls, index_path):
+        return cls(
+            vectors=np.load(os.path.join(index_path, 'vectors.npy'), mmap_mode='r'),
+            vectors_sqr_norm=np.load(os.path.join(index_path, 'vectors_sqr_norm.npy'))
+        )
+
+
+class IVFFlatIndex(object):
+    def __init__(self, nlist=256, nprobe=16, num_kmeans_iters=20, max_train_points=100000, seed=0):
+        """
+        Args:
+            nlist (int): number of clusters (inverted lists)
+            nprobe (int): number of clusters to scan for each query, a larger nprobe gives a higher recall
+        """
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.num_kmeans_iters = num_kmeans_iters
+        self.max_train_points = max_train_points
+        self.seed = seed
+
+        self.centroids = None
+        self.list_offsets = None  # (nlist + 1), the vectors of the k-th list are list_offsets[k]:list_offsets[k + 1]
+        self.list_ids = None  # (num_vectors), the original id of the vectors (sorted by list)
+        self.vectors = None  # (num_vectors, C), sorted by list
+        self.vectors_sqr_norm = None
+
+    @property
+    def num_vectors(self):
+        return len(self.list_ids)
+
+    def build(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.centroids = kmeans(
+            vectors, self.nlist, num_iters=self.num_kmeans_iters, max_train_points=self.max_train_points, seed=self.seed
+        )
+        self.nlist = len(self.centroids)
+
+        assignment = assign_to_centroids(vectors, self.centroids)
+        self.list_ids = np.argsort(assignment, kind='stable')
+        self.list_offsets = np.concatenate(([0], np.bincount(assignment, minlength=self.nlist).cumsum())).astype(np.int64)
+        self.vectors = np.ascontiguousarray(vectors[self.list_ids])
+        self.vectors_sqr_norm = (self.vectors ** 2).sum(axis=-1)
+        return self
+
+    def search(self, queries, k, nprobe=None):
+        """
+        Args:
+            queries (num_queries, C):
+            k (int):
+            nprobe (int): override the nprobe of the index
+
+        Returns:
+            topk_dists (num_queries, k): L2 distances, inf for padding
+            topk_idxs (num_queries, k): ids of the vectors passed to build, -1 for padding
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        nprobe = min(self.nprobe if nprobe is None else nprobe, self.nlist)
+
+        coarse_sqr_dist = compute_squared_dist(queries, self.centroids)
+        probe_lists = np.argpartition(coarse_sqr_dist, nprobe - 1, axis=-1)[:, :nprobe] if nprobe < self.nlist \
+            else np.tile(np.arange(self.nlist), (len(queries), 1))
+
+        topk_dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        topk_idxs = np.full((len(queries), k), -1, dtype=np.int64)
+        for query_idx in range(len(queries)):
+            candidate_pos = np.concatenate([
+                np.arange(self.list_offsets[list_idx], self.list_offsets[list_idx + 1]) for list_idx in probe_lists[query_idx]
+            ])
+            cur_sqr_dist = compute_squared_dist(
+                queries[query_idx:query_idx + 1], self.vectors[candidate_pos], self.vectors_sqr_norm[candidate_pos]
+            )
+            cur_topk_sqr_dists, cur_topk_idxs = select_topk(cur_sqr_dist, self.list_ids[candidate_pos], k)
+            topk_dists[query_idx], topk_idxs[query_idx] = np.sqrt(cur_topk_sqr_dists[0]), cur_topk_idxs[0]
+        return topk_dists, topk_idxs
+
+    def save(self, index_path):
+        os.makedirs(index_path, exist_ok=True)
+        for key in ['centroids', 'list_offsets', 'list_ids', 'vectors', 'vectors_sqr_norm']:
+            np.save(os.path.join(index_path, f'{key}.npy'), getattr(self, key))
+        with open(os.path.join(index_path, INDEX_META_FILE), 'w') as f:
+            json.dump({'name': 'ivf_flat', 'nlist': self.nlist, 'nprobe': self.nprobe, 'num_vectors': self.num_vectors}, f)
+
+    @classmethod
+    def load(cls, index_path):
+        with open(os.path.join(index_path, INDEX_META_FILE), 'r') as f:
+            meta = json.load(f)
+        index = cls(nlist=meta['nlist'], nprobe=meta['nprobe'])
+        for key in ['centroids', 'list_offsets', 'list_ids', 'vectors_sqr_norm']:
+            setattr(index, key, np.load(os.path.join(index_path, f'{key}.npy')))
+        index.vectors = np.load(os.path.join(index_path, 'vectors.npy'), mmap_mode='r')
+        return index
+
+
+def compute_recall_at_k(approx_idxs, exact_idxs):
+    """
+    Args:
+        approx_idxs (num_queries, k): the results of an approximate index
+        exact_idxs (num_queries, k): the results of the exact search
+
+    Returns:
+        recall (float): the fraction of the exact top-k found by the approximate index
+    """
+    num_found = sum(len(np.intersect1d(a[a >= 0], e[e >= 0])) for a, e in zip(approx_idxs, exact_idxs))
+    num_total = max((exact_idxs >= 0).sum(), 1)
+    return num_found / num_total
+
+
+def exclude_self_matches(topk_idxs, query_idxs, k):
+    """
+    The queries sampled from the indexed vectors find themselves at distance 0, which inflates the recall,
+    so they are searched with k + 1 and their own index is removed from the results
+
+    Args:
+        topk_idxs (num_queries, k + 1): -1 for padding
+        query_idxs (num_queries): the index of each query in the indexed vectors
+        k (int):
+
+    Returns:
+        topk_idxs (num_queries, k): the first k results other than the query itself, -1 for padding
+    """
+    keep_mask = topk_idxs != query_idxs[:, None]
+    order = np.argsort(~keep_mask, axis=-1, kind='stable')
+    return np.take_along_axis(np.where(keep_mask, topk_idxs, -1), order, axis=-1)[:, :k]
+
+
+def load_retrieval_index(index_path):
+    with open(os.path.join(index_path, INDEX_META_FILE), 'r') as f:
+        name = json.load(f)['name']
+    return __all__[name].load(index_path)
+
+
+def build_retrieval_index_dict(retrieval_database, backend='ivf_flat', **kwargs):
+    """
+    Args:
+        retrieval_database (dict): agent_type => {'embedding': (N, C), ...} as saved by generate_feature_vector.py
+        backend (str): name of the index in __all__
+        kwargs: the arguments of the index
+
+    Returns:
+        index_dict (dict): agent_type => index
+    """
+    index_dict = {}
+    for agent_type, agent_database in retrieval_database.items():
+        vectors = np.asarray(agent_database['embedding'], dtype=np.float32)
+        index_dict[agent_type] = __all__[backend](**kwargs).build(vectors)
+    return index_dict
+
+
+def save_retrieval_index_dict(index_dict, index_dir):
+    for agent_type, index in index_dict.items():
+        index.save(os.path.join(index_dir, agent_type))
+
+
+def load_retrieval_index_dict(index_dir):
+    return {
+        agent_type: load_retrieval_index(os.path.join(index_dir, agent_type)) for agent_type in sorted(os.listdir(index_dir))
+        if os.path.exists(os.path.join(index_dir, agent_type, INDEX_META_FILE))
+    }
+
+
+def search_retrieval_index_dict(index_dict, queries, agent_types, k, nprobe=None):
+    """
+    Args:
+        index_dict (dict): agent_type => index
+        queries (num_queries, C): C can be smaller than the dim of the database, then the exact search on the first C dims is used
+        agent_types (num_queries): the agent type of each query
+        k (int):
+
+    Returns:
+        topk_dists (num_queries, k):
+        topk_idxs (num_queries, k): the index in the database of the agent type of each query, -1 for padding
+    """
+    queries = np.asarray(queries, dtype=np.float32)
+    agent_types = np.asarray(agent_types)
+    topk_dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+    topk_idxs = np.full((len(queries), k), -1, dtype=np.int64)
+    for agent_type in np.unique(agent_types):
+        query_mask = agent_types == agent_type
+        index = index_dict[agent_type]
+        if queries.shape[1] == index.vectors.shape[1]:
+            topk_dists[query_mask], topk_idxs[query_mask] = index.search(queries[query_mask], k, nprobe=nprobe)
+        else:
+            # vectors of IVFFlatIndex are sorted by list, map back to the original ids
+            cur_dists, cur_pos = exact_search(queries[query_mask], index.vectors, k)
+            original_ids = getattr(index, 'list_ids', None)
+            topk_dists[query_mask] = cur_dists
+            topk_idxs[query_mask] = cur_pos if original_ids is None else np.where(cur_pos >= 0, original_ids[cur_pos], -1)
+    return topk_dists, topk_idxs
+
+
+__all__ = {
+    'exact': ExactIndex,
+    'ivf_flat': IVFFlatIndex,
+}
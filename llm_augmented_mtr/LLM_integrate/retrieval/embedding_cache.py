@@ -0,0 +1,201 @@
+# Cache of the encoder embeddings (the retrieval keys) on disk
+# cache_root/{checkpoint_hash}/{dataset_type}/meta.json                       the split dir and the info file of the encoded scenarios
+# cache_root/{checkpoint_hash}/{dataset_type}/shard_{rank}_{index}/
+#     scenario_id.npy / track_index.npy / object_type.npy / embedding_dim.npy  (N)
+#     embedding.npy                                                            (N, C), loaded with mmap
+# The embedding of an agent without HD map has 256 dims, it is padded with zeros to C and embedding_dim keeps the valid dims
+# The cache is keyed by the checkpoint (the sha1 of its content), the scenario_id and the track_index,
+# so re-running the retrieval with another window size or database does not need the encoder
+
+
+import os
+import glob
+import hashlib
+import json
+import shutil
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from mtr.config import cfg
+from mtr.utils import common_utils
+
+
+EMBEDDING_CACHE_COLUMNS = ['scenario_id', 'track_index', 'object_type', 'embedding_dim', 'embedding']
+EMBEDDING_CACHE_META_FILE = 'meta.json'
+
+
+def get_checkpoint_hash(ckpt_path, chunk_size=1 << 24):
+    sha1 = hashlib.sha1()
+    with open(ckpt_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()[:16]
+
+
+def get_embedding_cache_dir(cache_root, ckpt_path, dataset_type):
+    return os.path.join(str(cache_root), get_checkpoint_hash(ckpt_path), dataset_type)
+
+
+def get_embedding_cache_source(dataset_cfg, dataset_type):
+    """
+    Returns:
+        source (dict): the split dir and the info file of dataset_type as WaymoDataset resolves them,
+            the same dataset_type means different scenarios in the configs of generate_feature_vector.py and generate_context.py
+    """
+    data_root = cfg.ROOT_DIR / dataset_cfg.DATA_ROOT
+    return {
+        'split_dir': os.path.abspath(data_root / dataset_cfg.SPLIT_DIR[dataset_type]),
+        'info_file': os.path.abspath(data_root / dataset_cfg.INFO_FILE[dataset_type]),
+    }
+
+
+def create_embedding_cache_writer(cache_root, ckpt_path, dataset_type, source):
+    """
+    The cache of this checkpoint and dataset is regenerated: rank 0 removes the old one and records the source
+    (get_embedding_cache_source) of the embeddings, and every rank writes its own shards
+    """
+    rank, world_size = common_utils.get_dist_info()
+    cache_dir = get_embedding_cache_dir(cache_root, ckpt_path, dataset_type)
+    if rank == 0:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        os.makedirs(cache_dir)
+        with open(os.path.join(cache_dir, EMBEDDING_CACHE_META_FILE), 'w') as f:
+            json.dump(source, f)
+    if world_size > 1:
+        dist.barrier()
+    return EmbeddingCacheWriter(cache_dir, rank=rank)
+
+
+class EmbeddingCacheWriter(object):
+    """
+    Each rank writes its own shards, a shard only appears when it is completely written
+    """
+    def __init__(self, cache_dir, rank=0, shard_size=65536, dtype='float32'):
+        self.cache_dir = cache_dir
+        self.rank = rank
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.num_shards = len(glob.glob(os.path.join(cache_dir, f'shard_{rank:03d}_*')))
+        self.buffer = {key: [] for key in EMBEDDING_CACHE_COLUMNS}
+        self.num_buffered = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def add(self, scenario_ids, track_indexes, object_types, embeddings):
+        """
+        Args:
+            scenario_ids (num_agents): str
+            track_indexes (num_agents): int
+            object_types (num_agents): str
+            embeddings (num_agents, C): tensor or numpy array
+        """
+        if isinstance(embeddings, torch.Tensor):
+            embeddings = embeddings.detach().cpu().numpy()
+        if isinstance(track_indexes, torch.Tensor):
+            track_indexes = track_indexes.cpu().numpy()
+        self.buffer['scenario_id'].extend([str(x) for x in scenario_ids])
+        self.buffer['track_index'].extend([int(x) for x in track_indexes])
+        self.buffer['object_type'].extend([str(x) for x in object_types])
+        self.buffer['embedding_dim'].extend([embeddings.shape[1]] * len(embeddings))
+        self.buffer['embedding'].extend(list(embeddings.astype(self.dtype)))
+        self.num_buffered += len(embeddings)
+        if self.num_buffered >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self.num_buffered == 0:
+            return
+        max_dim = max(self.buffer['embedding_dim'])
+        embedding = np.zeros((self.num_buffered, max_dim), dtype=self.dtype)
+        for k, x in enumerate(self.buffer['embedding']):
+            embedding[k, :len(x)] = x
+        columns = {
+            'scenario_id': np.array(self.buffer['scenario_id']),
+            'track_index': np.array(self.buffer['track_index'], dtype=np.int32),
+            'object_type': np.array(self.buffer['object_type']),
+            'embedding_dim': np.array(self.buffer['embedding_dim'], dtype=np.int32),
+            'embedding': embedding,
+        }
+
+        shard_dir = os.path.join(self.cache_dir, f'shard_{self.rank:03d}_{self.num_shards:05d}')
+        tmp_shard_dir = shard_dir + '.tmp'
+        shutil.rmtree(tmp_shard_dir, ignore_errors=True)
+        os.makedirs(tmp_shard_dir)
+        for key, value in columns.items():
+            np.save(os.path.join(tmp_shard_dir, f'{key}.npy'), value)
+        os.replace(tmp_shard_dir, shard_dir)
+
+        self.num_shards += 1
+        self.buffer = {key: [] for key in EMBEDDING_CACHE_COLUMNS}
+        self.num_buffered = 0
+
+    def close(self):
+        self.flush()
+
+
+class EmbeddingCache(object):
+    def __init__(self, cache_dir, source):
+        """
+        Args:
+            cache_dir (str):
+            source (dict): get_embedding_cache_source of the scenarios to retrieve, a cache of other scenarios is rejected
+        """
+        self.cache_dir = cache_dir
+        meta_file = os.path.join(cache_dir, EMBEDDING_CACHE_META_FILE)
+        assert os.path.exists(meta_file), f'{cache_dir} has no {EMBEDDING_CACHE_META_FILE}, regenerate the embedding cache'
+        with open(meta_file, 'r') as f:
+            cache_source = json.load(f)
+        assert cache_source == source, \
+            f'the embedding cache {cache_dir} is encoded from {cache_source}, but the context is generated for {source}'
+        shard_dirs = sorted([x for x in glob.glob(os.path.join(cache_dir, 'shard_*')) if not x.endswith('.tmp')])
+        assert len(shard_dirs) > 0, f'no embedding cache in {cache_dir}'
+        self.shards = [
+            {key: np.load(os.path.join(shard_dir, f'{key}.npy'), mmap_mode='r') for key in EMBEDDING_CACHE_COLUMNS}
+            for shard_dir in shard_dirs
+        ]
+        self.key_to_row = None
+
+    def __len__(self):
+        return sum([len(shard['scenario_id']) for shard in self.shards])
+
+    def build_key_to_row(self):
+        self.key_to_row = {}
+        for shard_idx, shard in enumerate(self.shards):
+            for row, (scenario_id, track_index) in enumerate(zip(shard['scenario_id'], shard['track_index'])):
+                self.key_to_row.setdefault((str(scenario_id), int(track_index)), (shard_idx, row))
+
+    def __contains__(self, key):
+        if self.key_to_row is None:
+            self.build_key_to_row()
+        return key in self.key_to_row
+
+    def get_embedding(self, scenario_id, track_index):
+        """
+        Returns:
+            embedding (C): the valid dims of the cached embedding of the agent
+        """
+        if self.key_to_row is None:
+            self.build_key_to_row()
+        shard_idx, row = self.key_to_row[(str(scenario_id), int(track_index))]
+        shard = self.shards[shard_idx]
+        return np.asarray(shard['embedding'][row, :shard['embedding_dim'][row]])
+
+    def iter_batches(self, batch_size, rank=0, world_size=1):
+        """
+        Iterate over the cached agents (the shards are split among the ranks), the agents in one batch have the same embedding dim
+
+        Yields:
+            batch (dict): scenario_id (B), track_index (B), object_type (B), embedding (B, C)
+        """
+        for shard in self.shards[rank::world_size]:
+            for dim in np.unique(shard['embedding_dim']):
+                rows = np.nonzero(shard['embedding_dim'] == dim)[0]
+                for start_idx in range(0, len(rows), batch_size):
+                    cur_rows = rows[start_idx:start_idx + batch_size]
+                    yield {
+                        'scenario_id': shard['scenario_id'][cur_rows].tolist(),
+                        'track_index': shard['track_index'][cur_rows],
+                        'object_type': shard['object_type'][cur_rows].tolist(),
+                        'embedding': np.array(shard['embedding'][cur_rows, :dim], dtype=np.float32),
+                    }
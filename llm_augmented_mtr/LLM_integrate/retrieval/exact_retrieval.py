@@ -0,0 +1,88 @@
+# Exact nearest-neighbor retrieval on GPU for generate_context.py
+# The database of each agent type is kept as one (N, C) tensor with precomputed squared norms,
+# queries are grouped by agent type and the database is scanned chunk by chunk with
+# ||a||^2 + ||b||^2 - 2ab (a matmul), keeping a running top-k, so the memory is bounded by (num_queries, chunk_size)
+
+
+import torch
+
+
+class ChunkedExactRetrieval(object):
+    def __init__(self, database_embedding_dict, device=None, chunk_size=65536):
+        """
+        Args:
+            database_embedding_dict (dict): agent_type => (N, C) embeddings (tensor, numpy array or list of lists)
+            device: the device to keep the database on
+            chunk_size (int): number of database entries scanned at once
+        """
+        self.chunk_size = chunk_size
+        self.database_dict = {}
+        self.sqr_norm_dict = {}  # (agent_type, dim) => (N), the norm of the first dim channels
+        for agent_type, embedding in database_embedding_dict.items():
+            embedding = torch.as_tensor(embedding, dtype=torch.float32, device=device)
+            self.database_dict[agent_type] = embedding
+            self.sqr_norm_dict[(agent_type, embedding.shape[1])] = (embedding ** 2).sum(dim=-1)
+
+    def get_num_entries(self, agent_type):
+        return self.database_dict[agent_type].shape[0]
+
+    def get_sqr_norm(self, agent_type, dim):
+        key = (agent_type, dim)
+        if key not in self.sqr_norm_dict:
+            self.sqr_norm_dict[key] = (self.database_dict[agent_type][:, :dim] ** 2).sum(dim=-1)
+        return self.sqr_norm_dict[key]
+
+    def search_single_type(self, queries, agent_type, k):
+        """
+        Args:
+            queries (num_queries, C): C can be smaller than the dim of the database (e.g. 256 if there is no map embedding),
+                then only the first C channels of the database are used
+            agent_type (str):
+            k (int):
+
+        Returns:
+            topk_dists (num_queries, k): L2 distance, inf for padding
+            topk_idxs (num_queries, k): index in the database of agent_type, -1 for padding
+        """
+        database = self.database_dict[agent_type]
+        num_queries, dim = queries.shape
+        database_sqr_norm = self.get_sqr_norm(agent_type, dim)
+        queries = queries.to(database.device, dtype=torch.float32)
+        queries_sqr_norm = (queries ** 2).sum(dim=-1, keepdim=True)
+
+        topk_dists = queries.new_full((num_queries, k), float('inf'))
+        topk_idxs = torch.full((num_queries, k), -1, dtype=torch.long, device=database.device)
+        for start_idx in range(0, database.shape[0], self.chunk_size):
+            cur_database = database[start_idx:start_idx + self.chunk_size, :dim]
+            cur_sqr_dist = queries_sqr_norm + database_sqr_norm[start_idx:start_idx + self.chunk_size][None, :] - 2 * queries @ cur_database.t()
+
+            cur_k = min(k, cur_sqr_dist.shape[1])
+            cur_dists, cur_idxs = cur_sqr_dist.topk(k=cur_k, dim=-1, largest=False)
+            merged_dists = torch.cat((topk_dists, cur_dists), dim=-1)
+            merged_idxs = torch.cat((topk_idxs, cur_idxs + start_idx), dim=-1)
+            topk_dists, sorted_idxs = merged_dists.topk(k=k, dim=-1, largest=False)
+            topk_idxs = merged_idxs.gather(dim=-1, index=sorted_idxs)
+
+        # the expansion may be slightly negative due to the rounding error
+        topk_dists = topk_dists.clamp(min=0).sqrt()
+        return topk_dists, topk_idxs
+
+    def search(self, queries, agent_types, k):
+        """
+        Args:
+            queries (num_queries, C):
+            agent_types (num_queries): the agent type of each query
+            k (int):
+
+        Returns:
+            topk_dists (num_queries, k):
+            topk_idxs (num_queries, k): index in the database of the agent type of each query, -1 for padding
+        """
+        topk_dists = queries.new_full((queries.shape[0], k), float('inf'), dtype=torch.float32)
+        topk_idxs = torch.full((queries.shape[0], k), -1, dtype=torch.long, device=queries.device)
+        for agent_type in sorted(set(agent_types)):
+            query_idxs = torch.tensor([idx for idx, x in enumerate(agent_types) if x == agent_type], dtype=torch.long, device=queries.device)
+            cur_dists, cur_idxs = self.search_single_type(queries[query_idxs], agent_type, k)
+            topk_dists[query_idxs] = cur_dists.to(queries.device)
+            topk_idxs[query_idxs] = cur_idxs.to(queries.device)
+        return topk_dists, topk_idxs
@@ -0,0 +1,219 @@
+# PCA projection of the retrieval embeddings
+# The retrieval key is [center_objects_feature (256), 32 nearest map features (32*256)], the first `num_keep_dims` channels
+# (the agent feature) are kept as they are and the map channels are projected to `pca_dim` principal components,
+# so the agent-only retrieval (no HD map) still compares the first 256 channels of the projected database
+# The projection is fitted in generate_feature_vector.py (or fit_pca_projection.py) and saved into the retrieval database dir,
+# together with the projected embedding matrix of each agent type
+
+
+import os
+import time
+
+import numpy as np
+import torch
+
+from LLM_integrate.retrieval import ann_index
+from LLM_integrate.retrieval.retrieval_database import load_retrieval_database
+
+
+PCA_PROJECTION_FILE = 'pca_projection.npz'
+PROJECTED_EMBEDDING_NAME = 'projected_embedding'
+
+
+class PCAProjection(object):
+    def __init__(self, pca_dim, num_keep_dims=256, mean=None, components=None, explained_variance=None):
+        """
+        Args:
+            pca_dim (int): number of principal components of the projected channels
+            num_keep_dims (int): the first num_keep_dims channels are not projected
+            mean (C - num_keep_dims):
+            components (pca_dim, C - num_keep_dims):
+            explained_variance (pca_dim):
+        """
+        self.pca_dim = pca_dim
+        self.num_keep_dims = num_keep_dims
+        self.mean = mean
+        self.components = components
+        self.explained_variance = explained_variance
+        self.cached_device_tensors = {}
+
+    @property
+    def output_dim(self):
+        return self.num_keep_dims + self.pca_dim
+
+    def fit(self, vectors, max_fit_points=200000, seed=0, chunk_size=16384, device=None):
+        """
+        Args:
+            vectors (N, C): numpy array (can be mmap)
+        """
+        if len(vectors) > max_fit_points:
+            rng = np.random.RandomState(seed)
+            vectors = vectors[np.sort(rng.choice(len(vectors), max_fit_points, replace=False))]
+        num_points, dim = len(vectors), vectors.shape[1] - self.num_keep_dims
+        assert self.pca_dim <= dim, f'pca_dim={self.pca_dim} is larger than the number of projected channels ({dim})'
+
+        # accumulate the covariance chunk by chunk in float64
+        sum_x = torch.zeros(dim, dtype=torch.float64, device=device)
+        sum_xx = torch.zeros(dim, dim, dtype=torch.float64, device=device)
+        for start_idx in range(0, num_points, chunk_size):
+            cur_x = torch.from_numpy(np.asarray(vectors[start_idx:start_idx + chunk_size, self.num_keep_dims:], dtype=np.float64)).to(device)
+            sum_x += cur_x.sum(dim=0)
+            sum_xx += cur_x.t() @ cur_x
+        mean = sum_x / num_points
+        covariance = sum_xx / num_points - mean[:, None] * mean[None, :]
+
+        eigen_values, eigen_vectors = torch.linalg.eigh(covariance)  # in ascending order
+        order = eigen_values.argsort(descending=True)[:self.pca_dim]
+        self.mean = mean.float().cpu().numpy()
+        self.components = eigen_vectors[:, order].t().float().cpu().numpy()
+        self.explained_variance = eigen_values[order].float().cpu().numpy()
+        self.cached_device_tensors = {}
+        return self
+
+    def get_device_tensors(self, device):
+        key = str(device)
+        if key not in self.cached_device_tensors:
+            self.cached_device_tensors[key] = (
+                torch.from_numpy(self.mean).to(device), torch.from_numpy(self.components).to(device)
+            )
+        return self.cached_device_tensors[key]
+
+    def transform(self, x):
+        """
+        Args:
+            x (N, C) or (N, num_keep_dims): tensor, the agent-only embedding (no HD map) is returned as it is
+
+        Returns:
+            projected_x (N, num_keep_dims + pca_dim) or (N, num_keep_dims):
+        """
+        if x.shape[-1] == self.num_keep_dims:
+            return x
+        mean, components = self.get_device_tensors(x.device)
+        x = x.float()
+        projected_x = (x[:, self.num_keep_dims:] - mean) @ components.t()
+        return torch.cat((x[:, :self.num_keep_dims], projected_x), dim=-1)
+
+    def transform_numpy(self, vectors, chunk_size=16384, dtype=np.float32):
+        projected_vectors = np.zeros((len(vectors), self.output_dim), dtype=dtype)
+        for start_idx in range(0, len(vectors), chunk_size):
+            cur_x = torch.from_numpy(np.array(vectors[start_idx:start_idx + chunk_size], dtype=np.float32))
+            projected_vectors[start_idx:start_idx + chunk_size] = self.transform(cur_x).numpy()
+        return projected_vectors
+
+    def save(self, file_path):
+        np.savez(
+            file_path, pca_dim=self.pca_dim, num_keep_dims=self.num_keep_dims,
+            mean=self.mean, components=self.components, explained_variance=self.explained_variance
+        )
+
+    @classmethod
+    def load(cls, file_path):
+        data = np.load(file_path)
+        return cls(
+            pca_dim=int(data['pca_dim']), num_keep_dims=int(data['num_keep_dims']),
+            mean=data['mean'], components=data['components'], explained_variance=data['explained_variance']
+        )
+
+
+def fit_pca_projection(retrieval_database, pca_dim, num_keep_dims=256, max_fit_points=200000, seed=0, device=None):
+    """
+    Fit one projection on the embeddings of all agent types, so that the same projection is applied to every query
+    """
+    embedding_list = [agent_database['embedding'] for agent_database in retrieval_database.values() if len(agent_database['embedding']) > 0]
+    num_vectors = sum([len(x) for x in embedding_list])
+
+    # only the sampled points of each agent type are read into memory
+    rng = np.random.RandomState(seed)
+    sampled_idxs = np.sort(rng.choice(num_vectors, min(max_fit_points, num_vectors), replace=False))
+    type_offsets = np.cumsum([0] + [len(x) for x in embedding_list])
+    vectors = np.concatenate([
+        np.asarray(embedding[sampled_idxs[(sampled_idxs >= type_offsets[k]) & (sampled_idxs < type_offsets[k + 1])] - type_offsets[k]], dtype=np.float32)
+        for k, embedding in enumerate(embedding_list)
+    ], axis=0)
+    return PCAProjection(pca_dim, num_keep_dims=num_keep_dims).fit(vectors, max_fit_points=max_fit_points, seed=seed, device=device)
+
+
+def save_projected_database(retrieval_database, projection, database_dir):
+    """
+    Save the projection and the projected embedding matrix of each agent type into the retrieval database dir
+    """
+    for agent_type, agent_database in retrieval_database.items():
+        vectors = agent_database['embedding']
+        if len(vectors) > 0:
+            projected_vectors = projection.transform_numpy(vectors, dtype=np.asarray(vectors[:1]).dtype)
+        else:
+            projected_vectors = np.zeros((0, projection.output_dim), dtype=np.float32)
+        np.save(os.path.join(database_dir, f'{agent_type}_{PROJECTED_EMBEDDING_NAME}.npy'), projected_vectors)
+    projection.save(os.path.join(database_dir, PCA_PROJECTION_FILE))
+
+
+def fit_and_save_pca_projection(database_dir, pca_dim, logger, k=4, num_queries=1000, max_database_points=10000, device=None):
+    """
+    Fit the projection on the retrieval database dir, save it with the projected embeddings, and log the agreement report
+    """
+    retrieval_database = load_retrieval_database(database_dir)
+    projection = fit_pca_projection(retrieval_database, pca_dim, device=device)
+    save_projected_database(retrieval_database, projection, database_dir)
+    report = evaluate_pca_projection(retrieval_database, projection, k=k, num_queries=num_queries, max_database_points=max_database_points)
+    log_pca_projection_report(report, projection, logger, k=k)
+    return projection
+
+
+def load_pca_projection(database_dir):
+    projection_path = os.path.join(database_dir, PCA_PROJECTION_FILE)
+    assert os.path.exists(projection_path), f'{projection_path} does not exist, fit it with generate_feature_vector.py --pca_dim'
+    return PCAProjection.load(projection_path)
+
+
+def evaluate_pca_projection(retrieval_database, projection, k=4, num_queries=1000, max_database_points=10000, seed=0):
+    """
+    Compare the retrieval in the projected space with the full-dimension exact search on a random sample of the database
+    (at most max_database_points entries of each agent type are read), the queries are sampled entries and their self-match
+    is excluded from both results
+
+    Returns:
+        report (dict): agent_type => {'agreement', 'num_database_points', 'full_ms_per_query', 'projected_ms_per_query', 'full_mb', 'projected_mb'},
+            the memory is the one of the whole database in float32
+    """
+    rng = np.random.RandomState(seed)
+    report = {}
+    for agent_type, agent_database in retrieval_database.items():
+        embedding = agent_database['embedding']
+        if len(embedding) == 0:
+            continue
+        sampled_idxs = np.sort(rng.choice(len(embedding), min(max_database_points, len(embedding)), replace=False))
+        vectors = np.asarray(embedding[sampled_idxs], dtype=np.float32)
+        query_idxs = rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+        queries = vectors[query_idxs]
+        projected_vectors = projection.transform_numpy(vectors)
+        projected_queries = projected_vectors[query_idxs]
+
+        start_time = time.time()
+        _, full_idxs = ann_index.exact_search(queries, vectors, k + 1)
+        full_time = time.time() - start_time
+        start_time = time.time()
+        _, projected_idxs = ann_index.exact_search(projected_queries, projected_vectors, k + 1)
+        projected_time = time.time() - start_time
+        full_idxs = ann_index.exclude_self_matches(full_idxs, query_idxs, k)
+        projected_idxs = ann_index.exclude_self_matches(projected_idxs, query_idxs, k)
+
+        report[agent_type] = {
+            'agreement': ann_index.compute_recall_at_k(projected_idxs, full_idxs),
+            'num_database_points': len(vectors),
+            'full_ms_per_query': full_time / len(queries) * 1000,
+            'projected_ms_per_query': projected_time / len(queries) * 1000,
+            'full_mb': len(embedding) * vectors.shape[1] * 4 / 1024 ** 2,
+            'projected_mb': len(embedding) * projection.output_dim * 4 / 1024 ** 2,
+        }
+    return report
+
+
+def log_pca_projection_report(report, projection, logger, k=4):
+    logger.info(f'PCA projection: {projection.num_keep_dims} + {projection.mean.shape[0]} => {projection.num_keep_dims} + {projection.pca_dim} dims')
+    for agent_type, cur_report in report.items():
+        logger.info(
+            f'{agent_type:>16s}: agreement@{k}={cur_report["agreement"]:.4f}, '
+            f'search {cur_report["full_ms_per_query"]:.3f} => {cur_report["projected_ms_per_query"]:.3f} ms/query '
+            f'(x{cur_report["full_ms_per_query"] / max(cur_report["projected_ms_per_query"], 1e-9):.1f}) on {cur_report["num_database_points"]} entries, '
+            f'memory {cur_report["full_mb"]:.1f} => {cur_report["projected_mb"]:.1f} MB (fp32)'
+        )
@@ -0,0 +1,137 @@
+# Binary on-disk format of the retrieval database (the output of generate_feature_vector.py)
+# database_dir/
+#     info.json                   dtype / dim / number of entries of each agent type
+#     {agent_type}_embedding.npy  (N, C) float16 or float32 matrix, loaded with mmap
+#     {agent_type}_meta.pkl       scenario_id / track_index arrays and the intention / affordance / scenario label codes
+#                                 ((N, 8) int8 and (N) uint8 bitmasks, see mtr/datasets/llm_context/context_codec.py)
+# load_retrieval_database returns the same dict layout as the legacy pickle (agent_type => {'embedding', 'scenario_id', ...}),
+# with 'embedding' being the (N, C) matrix instead of a list of lists, and the labels being codes instead of lists of strings
+
+
+import os
+import json
+import pickle
+import shutil
+
+import numpy as np
+import torch
+
+from mtr.datasets.llm_context.context_codec import encode_label_lists, get_code_shape, get_empty_codes
+
+
+RETRIEVAL_DATABASE_INFO_FILE = 'info.json'
+RETRIEVAL_DATABASE_LABEL_KEYS = ['intention', 'affordance', 'scenario']
+
+
+def get_retrieval_database_dir(database_path):
+    return os.path.splitext(str(database_path))[0]
+
+
+def is_retrieval_database_dir(database_path):
+    return os.path.isfile(os.path.join(str(database_path), RETRIEVAL_DATABASE_INFO_FILE))
+
+
+def get_label_codes(labels, context_type):
+    """
+    Args:
+        labels (list or array): lists of type names (legacy) or the rows of codes
+
+    Returns:
+        codes (N, 8) int8 for intention, (N) uint8 for affordance / scenario
+    """
+    if len(labels) == 0:
+        return get_empty_codes(0, context_type)
+    if isinstance(labels, np.ndarray):
+        return labels
+    if isinstance(labels[0], (np.ndarray, np.integer)):
+        return np.array(labels).reshape((len(labels),) + get_code_shape(context_type))
+    return encode_label_lists(labels, context_type)
+
+
+def save_retrieval_database(embedding_dict, database_dir, dtype='float16'):
+    """
+    Args:
+        embedding_dict (dict): agent_type => {'scenario_id', 'track_index', 'embedding', 'intention', 'affordance', 'scenario'},
+            each embedding is a (C) array / tensor / list, each label is a row of codes or a list of type names
+        database_dir (str):
+        dtype (str): float16 or float32, the dtype of the embedding matrix
+    """
+    assert dtype in ['float16', 'float32'], f'unsupported dtype {dtype}'
+
+    # write into a temporary dir first, the database only appears when it is complete
+    tmp_database_dir = database_dir + '.tmp'
+    shutil.rmtree(tmp_database_dir, ignore_errors=True)
+    os.makedirs(tmp_database_dir)
+
+    info = {'dtype': dtype, 'agent_types': {}}
+    for agent_type, agent_database in embedding_dict.items():
+        embeddings = agent_database['embedding']
+        if len(embeddings) > 0:
+            embedding_matrix = np.stack([
+                x.detach().cpu().numpy() if isinstance(x, torch.Tensor) else np.asarray(x) for x in embeddings
+            ], axis=0).astype(dtype)
+        else:
+            embedding_matrix = np.zeros((0, 0), dtype=dtype)
+        np.save(os.path.join(tmp_database_dir, f'{agent_type}_embedding.npy'), embedding_matrix)
+
+        meta = {
+            'scenario_id': np.array(agent_database['scenario_id']),
+            'track_index': np.array(agent_database['track_index'], dtype=np.int32),
+        }
+        meta.update({key: get_label_codes(agent_database[key], key) for key in RETRIEVAL_DATABASE_LABEL_KEYS})
+        with open(os.path.join(tmp_database_dir, f'{agent_type}_meta.pkl'), 'wb') as f:
+            pickle.dump(meta, f)
+
+        info['agent_types'][agent_type] = {'num_entries': embedding_matrix.shape[0], 'dim': embedding_matrix.shape[1]}
+
+    with open(os.path.join(tmp_database_dir, RETRIEVAL_DATABASE_INFO_FILE), 'w') as f:
+        json.dump(info, f)
+
+    shutil.rmtree(database_dir, ignore_errors=True)
+    os.replace(tmp_database_dir, database_dir)
+    return database_dir
+
+
+def load_retrieval_database(database_path, mmap=True, embedding_name='embedding'):
+    """
+    Args:
+        database_path (str): dir written by save_retrieval_database, or a legacy pickle
+        mmap (bool): map the embedding matrix instead of reading it into memory
+        embedding_name (str): load {agent_type}_{embedding_name}.npy as 'embedding', e.g. projected_embedding (see pca_projection.py)
+
+    Returns:
+        retrieval_database (dict): agent_type => {'embedding': (N, C), 'scenario_id', 'track_index', 'intention' (N, 8),
+            'affordance' (N), 'scenario' (N)}
+    """
+    if not is_retrieval_database_dir(database_path):
+        assert embedding_name == 'embedding', f'{database_path} is a legacy pickle, convert it with convert_retrieval_database.py first'
+        with open(database_path, 'rb') as f:
+            retrieval_database = pickle.load(f)
+        for agent_database in retrieval_database.values():
+            agent_database.update({key: get_label_codes(agent_database[key], key) for key in RETRIEVAL_DATABASE_LABEL_KEYS})
+        return retrieval_database
+
+    with open(os.path.join(database_path, RETRIEVAL_DATABASE_INFO_FILE), 'r') as f:
+        info = json.load(f)
+
+    retrieval_database = {}
+    for agent_type in info['agent_types']:
+        with open(os.path.join(database_path, f'{agent_type}_meta.pkl'), 'rb') as f:
+            agent_database = pickle.load(f)
+        # the database dirs saved before the label codes keep lists of type names
+        agent_database.update({key: get_label_codes(agent_database[key], key) for key in RETRIEVAL_DATABASE_LABEL_KEYS})
+        agent_database['embedding'] = np.load(os.path.join(database_path, f'{agent_type}_{embedding_name}.npy'), mmap_mode='r' if mmap else None)
+        retrieval_database[agent_type] = agent_database
+    return retrieval_database
+
+
+def load_embedding_tensor(retrieval_database, agent_type, device=None, dtype=torch.float32):
+    """
+    Returns:
+        embedding (N, C): the embedding matrix of agent_type as a tensor
+    """
+    embedding = retrieval_database[agent_type]['embedding']
+    if isinstance(embedding, np.ndarray):
+        return torch.from_numpy(np.array(embedding)).to(device=device, dtype=dtype)
+    # legacy pickle, list of lists
+    return torch.tensor(embedding, dtype=dtype, device=device)
@@ -0,0 +1,64 @@
+# in this script, we build the nearest-neighbor index of each agent type for the retrieval database
+# (generated by generate_feature_vector.py), and measure its recall@k against the exact search
+
+import _init_path # insert the project path into system path, so that we can use `import mtr.xxx`
+import argparse
+import time
+
+import numpy as np
+
+from LLM_integrate.retrieval import ann_index
+from LLM_integrate.retrieval.pca_projection import PROJECTED_EMBEDDING_NAME
+from LLM_integrate.retrieval.retrieval_database import load_retrieval_database
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--retrieval_database', required=True, type=str, help='path of generated llm_out_put_with_embedding (binary database dir or legacy pickle)')
+    parser.add_argument('--output_dir', required=True, type=str, help='the dir to save the index of each agent type')
+    parser.add_argument('--retrieval_backend', choices=list(ann_index.__all__.keys()), default='ivf_flat', help='type of the index')
+    parser.add_argument('--use_pca_projection', action='store_true', default=False, help='build the index on the PCA projected embeddings')
+    parser.add_argument('--nlist', type=int, default=256, help='number of clusters of ivf_flat')
+    parser.add_argument('--nprobe', type=int, default=16, help='number of clusters to scan for each query of ivf_flat')
+    parser.add_argument('--retrieval_window_size', type=int, default=4, help='the k of recall@k')
+    parser.add_argument('--num_recall_queries', type=int, default=1000, help='number of database entries used as queries to measure the recall (excluding the entry itself)')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_config()
+    embedding_name = PROJECTED_EMBEDDING_NAME if args.use_pca_projection else 'embedding'
+    retrieval_database = load_retrieval_database(args.retrieval_database, embedding_name=embedding_name)
+
+    index_kwargs = {'nlist': args.nlist, 'nprobe': args.nprobe} if args.retrieval_backend == 'ivf_flat' else {}
+    start_time = time.time()
+    index_dict = ann_index.build_retrieval_index_dict(retrieval_database, backend=args.retrieval_backend, **index_kwargs)
+    print(f'Build {args.retrieval_backend} index in {time.time() - start_time:.1f}s')
+    ann_index.save_retrieval_index_dict(index_dict, args.output_dir)
+    print(f'Index is saved to {args.output_dir}')
+
+    rng = np.random.RandomState(0)
+    for agent_type, index in index_dict.items():
+        vectors = np.asarray(retrieval_database[agent_type]['embedding'], dtype=np.float32)
+        query_idxs = rng.choice(len(vectors), min(args.num_recall_queries, len(vectors)), replace=False)
+        queries = vectors[query_idxs]
+
+        # the queries are indexed vectors, their self-match is excluded from both results
+        start_time = time.time()
+        _, exact_idxs = ann_index.exact_search(queries, vectors, args.retrieval_window_size + 1)
+        exact_time = time.time() - start_time
+        start_time = time.time()
+        _, approx_idxs = index.search(queries, args.retrieval_window_size + 1)
+        approx_time = time.time() - start_time
+        exact_idxs = ann_index.exclude_self_matches(exact_idxs, query_idxs, args.retrieval_window_size)
+        approx_idxs = ann_index.exclude_self_matches(approx_idxs, query_idxs, args.retrieval_window_size)
+
+        recall = ann_index.compute_recall_at_k(approx_idxs, exact_idxs)
+        print(f'{agent_type:>16s}: {len(vectors)} entries, recall@{args.retrieval_window_size}={recall:.4f}, '
+              f'exact {exact_time / len(queries) * 1000:.2f} ms/query, {args.retrieval_backend} {approx_time / len(queries) * 1000:.2f} ms/query')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+# in this script, we convert the legacy retrieval database pickle (list of lists embeddings, generated by the old generate_feature_vector.py)
+# into the binary database dir of LLM_integrate/retrieval/retrieval_database.py
+
+import _init_path # insert the project path into system path, so that we can use `import mtr.xxx`
+import argparse
+import pickle
+
+from LLM_integrate.retrieval.retrieval_database import get_retrieval_database_dir, save_retrieval_database
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--retrieval_database', required=True, type=str, help='path of the legacy llm_output_context_with_xxx.pkl')
+    parser.add_argument('--output_dir', type=str, default=None, help='default is the pickle path without .pkl')
+    parser.add_argument('--dtype', choices=['float16', 'float32'], default='float32', help='dtype of the saved embedding matrix')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_config()
+    output_dir = args.output_dir if args.output_dir is not None else get_retrieval_database_dir(args.retrieval_database)
+
+    with open(args.retrieval_database, 'rb') as retrieval_database_file:
+        retrieval_database = pickle.load(retrieval_database_file)
+    save_retrieval_database(retrieval_database, output_dir, dtype=args.dtype)
+
+    for agent_type, agent_database in retrieval_database.items():
+        print(f'{agent_type:>16s}: {len(agent_database["embedding"])} entries')
+    print(f'Retrieval database is saved to {output_dir}')
+
+
+if __name__ == '__main__':
+    main()
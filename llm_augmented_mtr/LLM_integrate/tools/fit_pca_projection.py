@@ -0,0 +1,37 @@
+# in this script, we fit the PCA projection of an existing retrieval database dir (see generate_feature_vector.py --pca_dim),
+# save the projected embeddings into the same dir, and report the retrieval agreement with the full-dimension search
+
+import _init_path # insert the project path into system path, so that we can use `import mtr.xxx`
+import argparse
+
+import torch
+
+from LLM_integrate.retrieval.pca_projection import fit_and_save_pca_projection
+from mtr.utils import common_utils
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--retrieval_database', required=True, type=str, help='the retrieval database dir')
+    parser.add_argument('--pca_dim', required=True, type=int, help='number of principal components of the map channels')
+    parser.add_argument('--retrieval_window_size', type=int, default=4, help='the k of the agreement@k')
+    parser.add_argument('--num_queries', type=int, default=1000, help='number of database entries used as queries to measure the agreement')
+    parser.add_argument('--max_database_points', type=int, default=10000, help='number of sampled entries of each agent type searched by the agreement queries')
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_config()
+    logger = common_utils.create_logger()
+    device = torch.cuda.current_device() if torch.cuda.is_available() else None
+    fit_and_save_pca_projection(
+        args.retrieval_database, args.pca_dim, logger, k=args.retrieval_window_size, num_queries=args.num_queries,
+        max_database_points=args.max_database_points, device=device
+    )
+    logger.info(f'PCA projection is saved to {args.retrieval_database}')
+
+
+if __name__ == '__main__':
+    main()
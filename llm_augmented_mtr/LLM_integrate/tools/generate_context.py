@@ -8,6 +8,7 @@ import datetime
 import glob
 import os
 import re
+import shutil
 import time
 from pathlib import Path
 
@@ -17,9 +18,18 @@ from tensorboardX import SummaryWriter
 import pickle
 from tqdm import tqdm
 
+from LLM_integrate.retrieval import ann_index
+from LLM_integrate.retrieval.embedding_cache import EmbeddingCache, create_embedding_cache_writer, get_embedding_cache_dir, get_embedding_cache_source
+from LLM_integrate.retrieval.exact_retrieval import ChunkedExactRetrieval
+from LLM_integrate.retrieval.pca_projection import PROJECTED_EMBEDDING_NAME, load_pca_projection
+from LLM_integrate.retrieval.retrieval_database import load_embedding_tensor, load_retrieval_database
 from LLM_integrate.tools.generate_feature_vector_utils import generate_feature_vector_utils
 from mtr.config import cfg, cfg_from_list, cfg_from_yaml_file, log_config_to_file
 from mtr.datasets import build_dataloader
+from mtr.datasets.llm_context.context_store import (
+    CONTEXT_KEYS, ContextStore, create_context_shard_writer, get_context_store_path, merge_context_shards, set_context_store_source
+)
+from mtr.datasets.llm_context.context_codec import decode_codes, get_empty_codes
 from mtr.models import model as model_utils
 from mtr.utils import common_utils
 
@@ -43,9 +53,23 @@ def parse_config():
     parser.add_argument('--ckpt_dir', type=str, default=None, help='specify a ckpt directory to be evaluated if needed')
     parser.add_argument('--save_to_file', action='store_true', default=False, help='')
     # new add
-    parser.add_argument('--retrieval_database', required=True, type=str, help='path of generated llm_out_put_with_embedding')
+    parser.add_argument('--retrieval_database', required=True, type=str, help='path of generated llm_out_put_with_embedding (binary database dir or legacy pickle)')
     parser.add_argument('--retrieval_window_size', required=False, type=int, default=4, help='the retrieval window size')
     parser.add_argument('--dataset_type', choices=["train", "valid", "test"], required=True, type=str, default="", help='generate context data of which part of dataset')
+    parser.add_argument('--retrieval_backend', choices=['dense'] + list(ann_index.__all__.keys()), default='dense',
+                        help='dense: brute-force retrieval on GPU, others: retrieval with the index of LLM_integrate/retrieval/ann_index.py on CPU')
+    parser.add_argument('--retrieval_index', type=str, default=None, help='dir of the index built by build_retrieval_index.py, build it in memory if not given')
+    parser.add_argument('--use_pca_projection', action='store_true', default=False,
+                        help='retrieve with the PCA projected embeddings fitted by generate_feature_vector.py --pca_dim (the --retrieval_index should also be built with them)')
+    parser.add_argument('--embedding_cache_root', type=str, default=None, help='keep the encoder embeddings in {root}/{ckpt_hash}/{dataset_type}')
+    parser.add_argument('--from_embedding_cache', action='store_true', default=False,
+                        help='retrieve with the embeddings in --embedding_cache_root of --ckpt, without running the encoder')
+    parser.add_argument('--nprobe', type=int, default=None, help='number of clusters to scan for each query of ivf_flat (default: the value of the index)')
+    parser.add_argument('--skip_context_pickle', action='store_true', default=False,
+                        help='only save the context store, not the legacy context pickle (text labels) read by the configs without USE_CONTEXT_MMAP_STORE')
+    parser.add_argument('--device', choices=['cuda', 'cpu'], default='cuda',
+                        help='run the encoder and the dense retrieval on GPU, or on CPU (launch several processes with --launcher pytorch for a gloo group)')
+    parser.add_argument('--num_threads', type=int, default=None, help='number of threads of each process for the CPU computation (torch.set_num_threads)')
 
     args = parser.parse_args()
 
@@ -60,98 +84,238 @@ def parse_config():
 
     return args, cfg
 
-def save_context_data(merged_embedding_dict, save_context_dir, args):
+def get_context_shard_dir(save_context_dir, args):
+    return os.path.join(save_context_dir, f"context_shards_{args.extra_tag}")
+
+
+def save_context_data(save_context_dir, args, logger):
+    """
+    Merge the context shards of all ranks into the context store ({context pickle path}_store) on rank 0,
+    the legacy pickle is decoded from the store unless --skip_context_pickle is given
+    """
     save_context_path = os.path.join(save_context_dir, f"context_data_{args.extra_tag}.pkl")
-    pickle.dump(merged_embedding_dict, open(save_context_path, 'wb'))
-    
-def generate_batch_context(batch_dict, context_dict, retrieval_database_embedding_dict, retrieval_database, retrieval_window_size=4):
-    # 1. calc embeddings for each agent in current batch
-    scenario_id_list = batch_dict['input_dict']['scenario_id'] # shape (#agent)
-    track_index_to_predict = batch_dict['input_dict']['track_index_to_predict_origin'] # shape (#agent)
+    store_path = get_context_store_path(save_context_path)
+    shard_dir = get_context_shard_dir(save_context_dir, args)
+    num_scenarios, num_agents = merge_context_shards(shard_dir, store_path, has_retrieval_window=True)
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    logger.info(f'Save context of {num_scenarios} scenarios ({num_agents} agents) into {store_path}')
+
+    if not args.skip_context_pickle:
+        save_context_pickle(store_path, save_context_path)
+        # the pickle decoded from the store is its source, so the dataset does not convert it again
+        set_context_store_source(store_path, save_context_path)
+        logger.info(f'Save context pickle into {save_context_path}')
+
+
+def save_context_pickle(store_path, save_context_path):
+    """
+    Decode the context store into the legacy pickle, key: scenario_id, value: dict(key: track_indexes, track_intentions, track_affordances, track_scenarios)
+    """
+    context_store = ContextStore(store_path)
+    context_dict = {}
+    for scenario_id in tqdm(context_store.scenario_id, desc='decode context'):
+        rows = context_store.get_scenario_rows(scenario_id)
+        # shape (#agent, #window, 8), (#agent, #window), (#agent, #window)
+        codes = {key: np.array(context_store.context_arrays[key][rows]) for key in CONTEXT_KEYS.keys()}
+        # every agent keeps its #window samples (the dataset asserts the window size), a retrieved sample may have empty labels
+        # and the padding of the window (topk_idxes < 0, the database of this agent type has less than #window samples)
+        # is written with the empty codes by retrieve_batch_context, both are decoded into empty labels
+        num_agents, window_size = codes['track_affordances'].shape
+        context_data = {"track_indexes": context_store.track_index[rows].tolist()}
+        for key, context_type in CONTEXT_KEYS.items():
+            label_lists = decode_codes(codes[key].reshape((num_agents * window_size,) + codes[key].shape[2:]), context_type)
+            context_data[key] = [label_lists[k * window_size:(k + 1) * window_size] for k in range(num_agents)]
+        context_dict[str(scenario_id)] = context_data
+    with open(save_context_path, 'wb') as f:
+        pickle.dump(context_dict, f)
+
+
+def get_retrieval_database_context_codes(retrieval_database):
+    """
+    Returns:
+        context_codes (dict): agent_type => {track_intentions (N, 8), track_affordances (N), track_scenarios (N)}, the label codes
+            of the database samples, so the context of the retrieved samples is gathered by index
+    """
+    return {
+        agent_type: {key: np.asarray(agent_database[context_type]) for key, context_type in CONTEXT_KEYS.items()}
+        for agent_type, agent_database in retrieval_database.items()
+    }
+
+
+def get_batch_embedding(batch_dict):
+    """
+    Returns:
+        batch_embedding (#agent, 33*256) or (#agent, 256): the retrieval key of each agent in current batch
+    """
     center_objects_feature = batch_dict['center_objects_feature'] #shape (#agent, 256)
     map_feature =  batch_dict['map_feature'] # shape (#agent, #polyline, 256)
     map_pos = batch_dict['map_pos'] # shape (#agent, #polyline, 3)
     map_mask = batch_dict['map_mask'] # shape (#agent, #polyline)
-    center_objects_type = batch_dict['input_dict']['center_objects_type'] # shape (#agent)
     
     # if no HD-Map num_of_polyline = 1 in default
-    # in this case, we only use agent embedding to do retrieval
+    # in this case, we only use agent embedding to do retrieval (the first 256 channels of the database)
     num_of_polylines = map_feature.shape[1]
     if num_of_polylines < 32:
         print("empty HD Map or num_of_polyline is less than 32, skip map embedding, retrieval via agent embedding")
         # shape (#agent, 256)
         batch_embedding = center_objects_feature
-        # shape (#agent, num_of_retrieval_sample, 256)
-        batch_retrieval_embedding_database = torch.stack([retrieval_database_embedding_dict[agent_type][:, :256] for agent_type in center_objects_type], dim=0)
-        # (#agent, num_of_retrieval_sample, 256) => (#agent, num_of_retrieval_sample)
-        num_of_agent, _, dim_of_embedding = batch_retrieval_embedding_database.shape
-        batch_dist = (batch_embedding.view(num_of_agent, 1, dim_of_embedding) - batch_retrieval_embedding_database).norm(dim=-1)
-        # get the index of cloest sample in database for current query
-        # #window index will be obtained
-        # shape (#agent, #window)
-        topk_dists, topk_idxes = batch_dist.topk(k=retrieval_window_size, dim=-1, largest=False)
     else:
         # shape (#agent, 32*256)
-        k_nearset_map_feature = generate_feature_vector_utils.find_k_nearest_map_embedding(32, map_feature, map_pos, map_mask)
+        k_nearset_map_feature = generate_feature_vector_utils.find_k_nearest_map_embedding(map_feature, map_pos, map_mask, k=32)
         # shape (#agent, 33*256)
         batch_embedding = torch.cat([center_objects_feature, k_nearset_map_feature], dim=-1)
-        # 2. retrieval corresponding context info for each agent
-        # shape (#agent, num_of_retrieval_sample, 33*256)
-        batch_retrieval_embedding_database = torch.stack([retrieval_database_embedding_dict[agent_type] for agent_type in center_objects_type], dim=0)
-        
-        num_of_agent, _, dim_of_embedding = batch_retrieval_embedding_database.shape
-        # shape (#agent, num_of_retrieval_sample)
-        batch_dist = (batch_embedding.view(num_of_agent, 1, dim_of_embedding) - batch_retrieval_embedding_database).norm(dim=-1)
-        # get the index of cloest sample in database for current query
-        # #window index will be obtained
-        # shape (#agent, #window)
-        topk_dists, topk_idxes = batch_dist.topk(k=retrieval_window_size, dim=-1, largest=False)
-
-    # save these context data into a dict
-    for agent_index in range(num_of_agent):
-        scenario_id = scenario_id_list[agent_index]
-        track_index = track_index_to_predict[agent_index].item()
-        agent_type = center_objects_type[agent_index]
-        track_intentions = [retrieval_database[agent_type]["intention"][sample_index] for sample_index in topk_idxes[agent_index]]
-        track_affordances = [retrieval_database[agent_type]["affordance"][sample_index] for sample_index in topk_idxes[agent_index]]
-        track_scenarios = [retrieval_database[agent_type]["scenario"][sample_index] for sample_index in topk_idxes[agent_index]]
-        
-        if scenario_id in context_dict.keys():
-            context_dict[scenario_id]["track_indexes"].append(track_index)
-            context_dict[scenario_id]["track_intentions"].append(track_intentions)
-            context_dict[scenario_id]["track_affordances"].append(track_affordances)
-            context_dict[scenario_id]["track_scenarios"].append(track_scenarios)
-        else:
-            context_dict.update({
-                scenario_id: {
-                    "track_indexes": [track_index],
-                    "track_intentions": [track_intentions],
-                    "track_affordances": [track_affordances],
-                    "track_scenarios": [track_scenarios]
-                }
-            })
-    
-    
-def unify_retrieval_database_by_padding_1st_dim(vehicle_database, pedestrian_database, cyclist_database):
-    database_list = [vehicle_database, pedestrian_database, cyclist_database]
-    max_agent_num = max([len(database) for database in database_list])
-    feature_num = len(vehicle_database[0])
+    return batch_embedding
+
+
+def retrieve_batch_context(batch_embedding, scenario_id_list, track_index_list, center_objects_type, context_writer, retrieval_engine, context_codes,
+                           retrieval_window_size=4, retrieval_index_dict=None, nprobe=None, pca_projection=None):
+    num_of_agent = batch_embedding.shape[0]
+    if pca_projection is not None:
+        # shape (#agent, 256 + pca_dim), the agent-only embedding is not changed
+        batch_embedding = pca_projection.transform(batch_embedding)
+
+    # retrieval corresponding context info for each agent within the database of its agent type
+    # get the index of cloest sample in database for current query
+    # #window index will be obtained
+    # shape (#agent, #window)
+    if retrieval_index_dict is not None:
+        topk_dists, topk_idxes = ann_index.search_retrieval_index_dict(
+            retrieval_index_dict, batch_embedding.cpu().numpy(), center_objects_type, k=retrieval_window_size, nprobe=nprobe
+        )
+    else:
+        topk_dists, topk_idxes = retrieval_engine.search(batch_embedding, center_objects_type, k=retrieval_window_size)
+        topk_idxes = topk_idxes.cpu().numpy()
+
+    # gather the label codes of the retrieved samples, shape (#agent, #window, 8), (#agent, #window), (#agent, #window)
+    # -1 is padding when the database of this agent type has less than #window samples, its codes are empty
+    center_objects_type = np.array(center_objects_type)
+    context_arrays = {}
+    for key, context_type in CONTEXT_KEYS.items():
+        empty_codes = get_empty_codes(num_of_agent * retrieval_window_size, context_type)
+        context_arrays[key] = empty_codes.reshape((num_of_agent, retrieval_window_size) + empty_codes.shape[1:])
+    for agent_type in np.unique(center_objects_type):
+        agent_mask = center_objects_type == agent_type
+        cur_topk_idxes = topk_idxes[agent_mask]
+        valid_mask = cur_topk_idxes >= 0
+        if not valid_mask.any():
+            continue
+        for key in CONTEXT_KEYS.keys():
+            cur_codes = context_codes[agent_type][key][np.maximum(cur_topk_idxes, 0)]
+            cur_codes[~valid_mask] = context_arrays[key][0, 0]
+            context_arrays[key][agent_mask] = cur_codes
+
+    context_writer.add(scenario_id_list, np.array(track_index_list, dtype=np.int64), context_arrays)
+
+
+def generate_batch_context(batch_dict, context_writer, retrieval_engine, context_codes, retrieval_window_size=4,
+                           retrieval_index_dict=None, nprobe=None, pca_projection=None, cache_writer=None):
+    # 1. calc embeddings for each agent in current batch
+    batch_embedding = get_batch_embedding(batch_dict)
+    if cache_writer is not None:
+        cache_writer.add(
+            batch_dict['input_dict']['scenario_id'], batch_dict['input_dict']['track_index_to_predict_origin'],
+            batch_dict['input_dict']['center_objects_type'], batch_embedding
+        )
+    # 2. retrieval corresponding context info for each agent
+    retrieve_batch_context(
+        batch_embedding, batch_dict['input_dict']['scenario_id'], batch_dict['input_dict']['track_index_to_predict_origin'].tolist(),
+        batch_dict['input_dict']['center_objects_type'], context_writer, retrieval_engine, context_codes,
+        retrieval_window_size=retrieval_window_size, retrieval_index_dict=retrieval_index_dict, nprobe=nprobe, pca_projection=pca_projection
+    )
     
-    padding_embedding = [1000000 for _ in range(feature_num)]
     
-    for database in database_list:
-        for _ in range(max_agent_num - len(database)):
-            database.append(padding_embedding)
-            
+def get_device(args):
+    """
+    The device of current process: the GPU of its local rank, or CPU for --device cpu
+    """
+    if args.device == 'cpu':
+        return torch.device('cpu')
+    return torch.device('cuda', cfg.LOCAL_RANK % torch.cuda.device_count())
+
+
+def load_retrieval_database_to_device(retrieval_database, device, logger):
+    # load the retrieval database into the device, shape (N_v, 33*256), (N_p, 33*256), (N_c, 33*256)
+    # on CPU, the chunked distance computation (matmul) runs on the torch intra-op threads (--num_threads)
+    retrieval_engine = ChunkedExactRetrieval(
+        {agent_type: load_embedding_tensor(retrieval_database, agent_type) for agent_type in retrieval_database.keys()}, device=device
+    )
+    logger.info(f'Load embedding database to {device} successfully')
+    return retrieval_engine
+
+
+def load_retrieval_backend(retrieval_database_path, args, logger):
+    """
+    Load the retrieval database and the search backend selected by --retrieval_backend / --retrieval_index / --use_pca_projection / --device
+
+    Returns:
+        context_codes (see get_retrieval_database_context_codes), retrieval_engine (dense backend), retrieval_index_dict (other backends), pca_projection
+    """
+    if args.use_pca_projection:
+        retrieval_database = load_retrieval_database(retrieval_database_path, embedding_name=PROJECTED_EMBEDDING_NAME)
+        pca_projection = load_pca_projection(retrieval_database_path)
+        logger.info(f'Retrieve with PCA projected embeddings of {pca_projection.output_dim} dims')
+    else:
+        retrieval_database = load_retrieval_database(retrieval_database_path)
+        pca_projection = None
+
+    if args.retrieval_backend != 'dense':
+        retrieval_engine = None
+        if args.retrieval_index is not None:
+            retrieval_index_dict = ann_index.load_retrieval_index_dict(args.retrieval_index)
+        else:
+            retrieval_index_dict = ann_index.build_retrieval_index_dict(retrieval_database, backend=args.retrieval_backend)
+        logger.info(f'Load {args.retrieval_backend} retrieval index: ' + ', '.join([f'{key}={val.num_vectors}' for key, val in retrieval_index_dict.items()]))
+    else:
+        retrieval_index_dict = None
+        retrieval_engine = load_retrieval_database_to_device(retrieval_database, get_device(args), logger)
+
+    return get_retrieval_database_context_codes(retrieval_database), retrieval_engine, retrieval_index_dict, pca_projection
+
+
+def retrieve_context_from_cache(cache_dir, context_writer, args, logger, batch_size=256):
+    """
+    Retrieve the context of the agents of current rank from the embedding cache, without the encoder
+    """
+    rank, world_size = common_utils.get_dist_info()
+    context_codes, retrieval_engine, retrieval_index_dict, pca_projection = load_retrieval_backend(args.retrieval_database, args, logger)
+    embedding_cache = EmbeddingCache(cache_dir, source=get_embedding_cache_source(cfg.DATA_CONFIG, args.dataset_type))
+    logger.info(f'Retrieve context for {len(embedding_cache)} cached embeddings in {cache_dir}')
+
+    for cache_batch in embedding_cache.iter_batches(batch_size, rank=rank, world_size=world_size):
+        batch_embedding = torch.from_numpy(cache_batch['embedding']).to(get_device(args))
+        retrieve_batch_context(
+            batch_embedding, cache_batch['scenario_id'], cache_batch['track_index'], cache_batch['object_type'], context_writer,
+            retrieval_engine, context_codes, retrieval_window_size=args.retrieval_window_size,
+            retrieval_index_dict=retrieval_index_dict, nprobe=args.nprobe, pca_projection=pca_projection
+        )
+
+
+def obtain_context_data_from_cache(args, logger, dist_test=False):
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    save_context_dir = os.path.join("/".join(cur_dir.split("/")[:-1]), "context_data", args.dataset_type)
+    os.makedirs(save_context_dir, exist_ok=True)
+
+    # the context records of each rank are written into its own shards, and merged into the context store at the end
+    context_writer = create_context_shard_writer(get_context_shard_dir(save_context_dir, args), args.retrieval_window_size)
+    retrieve_context_from_cache(get_embedding_cache_dir(args.embedding_cache_root, args.ckpt, args.dataset_type), context_writer, args, logger)
+    context_writer.close()
+
+    if dist_test:
+        torch.distributed.barrier()
+    if cfg.LOCAL_RANK == 0:
+        save_context_data(save_context_dir, args, logger)
+        logger.info('****************GENERATE CONTEXT FINISHED.*****************')
+
 
 def obtain_context_data(model, dataloader, args, log_dir, logger, epoch_id, dist_test=False):
     # we first load the context data
     if args.ckpt is not None:
-        it, epoch = model.load_params_from_file(filename=args.ckpt, logger=logger, to_cpu=dist_test)
+        it, epoch = model.load_params_from_file(filename=args.ckpt, logger=logger, to_cpu=dist_test or args.device == 'cpu')
     else:
         return
-    # send all params to GPU
-    model.cuda()
+    # send all params to GPU (or keep them on CPU for --device cpu)
+    device = get_device(args)
+    model.to(device)
     logger.info(f'*************** LOAD MODEL (epoch={epoch}, iter={it}) for CONTEXT GENERATE *****************')
     # set retrieval database path and save path
     retrieval_database_path = args.retrieval_database
@@ -160,40 +324,22 @@ def obtain_context_data(model, dataloader, args, log_dir, logger, epoch_id, dist
     os.makedirs(save_context_dir, exist_ok=True)
     
     # load retrieval database
-    with open(retrieval_database_path, 'rb') as retrieval_database_file:
-        retrieval_database = pickle.load(retrieval_database_file)
-    # load the retrieval database into GPU
-    retrieval_database_embedding_vehicle = retrieval_database["TYPE_VEHICLE"]["embedding"]
-    retrieval_database_embedding_pedestrian = retrieval_database["TYPE_PEDESTRIAN"]["embedding"]
-    retrieval_database_embedding_cyclist = retrieval_database["TYPE_CYCLIST"]["embedding"]
-    # shape (N_v, 33*256), (N_p, 33*256), (N_c, 33*256)
-    unify_retrieval_database_by_padding_1st_dim(retrieval_database_embedding_vehicle, retrieval_database_embedding_pedestrian, retrieval_database_embedding_cyclist)
-       
-    cur_device = f"cuda:{os.environ['LOCAL_RANK']}"
-    
-    retrieval_database_embedding_vehicle = torch.tensor(retrieval_database_embedding_vehicle, dtype=torch.float32, device=cur_device)
-    retrieval_database_embedding_pedestrian = torch.tensor(retrieval_database_embedding_pedestrian, dtype=torch.float32, device=cur_device)
-    retrieval_database_embedding_cyclist = torch.tensor(retrieval_database_embedding_cyclist, dtype=torch.float32, device=cur_device)
+    context_codes, retrieval_engine, retrieval_index_dict, pca_projection = load_retrieval_backend(retrieval_database_path, args, logger)
 
-    assert retrieval_database_embedding_vehicle.shape == retrieval_database_embedding_pedestrian.shape and retrieval_database_embedding_pedestrian.shape == retrieval_database_embedding_cyclist.shape, "shape of embedding database is not equal"
-    
-    retrieval_database_embedding_dict = {
-        "TYPE_VEHICLE": retrieval_database_embedding_vehicle,
-        "TYPE_PEDESTRIAN": retrieval_database_embedding_pedestrian,
-        "TYPE_CYCLIST": retrieval_database_embedding_cyclist
-    }
-    
-    print(f'^.^ Load embedding database to CUDA={os.environ["LOCAL_RANK"]} successfully ^.^')
+    cache_writer = None
+    if args.embedding_cache_root is not None:
+        cache_writer = create_embedding_cache_writer(
+            args.embedding_cache_root, args.ckpt, args.dataset_type, source=get_embedding_cache_source(cfg.DATA_CONFIG, args.dataset_type)
+        )
+        logger.info(f'Write the encoder embeddings into {cache_writer.cache_dir}')
     
     # iterate and retrieve context info for each agent
     logger.info('*************** EPOCH %s GENERATE FEATURE VECTOR *****************' % epoch_id)
-    if dist_test:
+    if dist_test and device.type == 'cuda':
         if not isinstance(model, torch.nn.parallel.DistributedDataParallel):
-            num_gpus = torch.cuda.device_count()
-            local_rank = cfg.LOCAL_RANK % num_gpus
             model = torch.nn.parallel.DistributedDataParallel(
                     model,
-                    device_ids=[local_rank],
+                    device_ids=[device.index],
                     broadcast_buffers=False
             )
     model.eval()
@@ -201,13 +347,16 @@ def obtain_context_data(model, dataloader, args, log_dir, logger, epoch_id, dist
     if cfg.LOCAL_RANK == 0:
         progress_bar = tqdm(total=len(dataloader), leave=True, desc='gen fv', dynamic_ncols=True)
 
-    context_dict = {} # key: scenario_id, value: dict(key: track_indexes, track_intentions, track_affordances, track_scenarios)
+    # the context records of each rank are written into its own shards, and merged into the context store at the end
+    context_writer = create_context_shard_writer(get_context_shard_dir(save_context_dir, args), args.retrieval_window_size)
     for i, batch_dict in enumerate(dataloader):
         with torch.no_grad():
             encode_batch_dict = model(batch_dict)
-            # context_dict will change after this function finished
-            generate_batch_context(encode_batch_dict, context_dict, retrieval_database_embedding_dict, retrieval_database, retrieval_window_size=args.retrieval_window_size)
-            torch.distributed.barrier()
+            generate_batch_context(encode_batch_dict, context_writer, retrieval_engine, context_codes, retrieval_window_size=args.retrieval_window_size,
+                                   retrieval_index_dict=retrieval_index_dict, nprobe=args.nprobe, pca_projection=pca_projection,
+                                   cache_writer=cache_writer)
+            if dist_test:
+                torch.distributed.barrier()
 
         disp_dict = {}
 
@@ -221,14 +370,15 @@ def obtain_context_data(model, dataloader, args, log_dir, logger, epoch_id, dist
                         f'time_cost: {progress_bar.format_interval(past_time)}/{progress_bar.format_interval(remaining_time)}, '
                         f'{disp_str}')
             
-        
-    if dist_test:
-        logger.info(f'Number of scenarios in context_dict from multiple GPUs: {len(context_dict)}')
-        merged_embedding_dict = common_utils.merge_context_dict_dist(context_dict, tmpdir=os.path.join(save_context_dir, "tmpdir"))
+    if cache_writer is not None:
+        cache_writer.close()
+    context_writer.close()
+    logger.info(f'Write the context of {context_writer.num_agents} agents into {context_writer.num_shards} shards')
 
+    if dist_test:
+        torch.distributed.barrier()
     if cfg.LOCAL_RANK == 0:
-        logger.info(f'Number of scenarios in context_dict from multiple GPUs: {len(merged_embedding_dict)}')
-        save_context_data(merged_embedding_dict, save_context_dir, args)
+        save_context_data(save_context_dir, args, logger)
         logger.info('****************GENERATE CONTEXT FINISHED.*****************')
         
     if cfg.LOCAL_RANK == 0:
@@ -243,9 +393,12 @@ def main():
         total_gpus = 1
     else:
         total_gpus, cfg.LOCAL_RANK = getattr(common_utils, 'init_dist_%s' % args.launcher)(
-            args.tcp_port, args.local_rank, backend='nccl'
+            args.tcp_port, args.local_rank, backend='nccl' if args.device == 'cuda' else 'gloo'
         )
         dist_test = True
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
         
     if args.batch_size is None:
         args.batch_size = cfg.OPTIMIZATION.BATCH_SIZE_PER_GPU # type: ignore
@@ -279,6 +432,12 @@ def main():
         common_utils.set_random_seed(666)
     
     assert args.ckpt is not None, "ckpt_dir is none"
+
+    if args.from_embedding_cache:
+        # pure retrieval with the cached embeddings of this checkpoint, no dataloader and encoder needed
+        assert args.embedding_cache_root is not None, "--from_embedding_cache needs --embedding_cache_root"
+        obtain_context_data_from_cache(args, logger, dist_test=dist_test)
+        return
     
     dataset, dataloader, sampler = build_dataloader(
         dataset_cfg=cfg.DATA_CONFIG,
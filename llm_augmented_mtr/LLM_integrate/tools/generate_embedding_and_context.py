@@ -0,0 +1,269 @@
+# in this script, we run the encoder only once over [ training | validation | testing ] set, and in the same pass
+# 1. append the agents labeled by LLM (--llm_context) into a new retrieval database (what generate_feature_vector.py does)
+# 2. retrieve context data for each agent (what generate_context.py does), from --retrieval_database,
+#    or from the new database after the pass (the embeddings are kept in the embedding cache, so no second encoder pass)
+# 3. keep the encoder embeddings in the embedding cache (--embedding_cache_root) for later retrieval
+
+import _init_path # insert the project path into system path, so that we can use `import mtr.xxx`
+import argparse
+import copy
+import datetime
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from tqdm import tqdm
+
+from LLM_integrate.embedding import embedding_format
+from LLM_integrate.retrieval import ann_index
+from LLM_integrate.retrieval.embedding_cache import create_embedding_cache_writer, get_embedding_cache_source
+from LLM_integrate.retrieval.retrieval_database import save_retrieval_database
+from LLM_integrate.tools.generate_context import (
+    get_batch_embedding, get_context_shard_dir, get_device, load_retrieval_backend, retrieve_batch_context, retrieve_context_from_cache, save_context_data
+)
+from mtr.config import cfg, cfg_from_list, cfg_from_yaml_file, log_config_to_file
+from mtr.datasets import build_dataloader
+from mtr.datasets.llm_context.context_codec import encode_label_lists
+from mtr.datasets.llm_context.context_store import CONTEXT_KEYS, create_context_shard_writer
+from mtr.models import model as model_utils
+from mtr.utils import common_utils
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--cfg_file', type=str, default=None, help='specify the config file')
+
+    parser.add_argument('--batch_size', type=int, default=None, required=False, help='batch size for training')
+    parser.add_argument('--workers', type=int, default=4, help='number of workers for dataloader')
+    parser.add_argument('--extra_tag', type=str, default='default', help='extra tag for this experiment')
+    parser.add_argument('--ckpt', required=True, type=str, default=None, help='checkpoint to start from')
+    parser.add_argument('--launcher', choices=['none', 'pytorch', 'slurm'], default='none')
+    parser.add_argument('--tcp_port', type=int, default=18888, help='tcp port for distrbuted training')
+    parser.add_argument('--local_rank', type=int, default=0, help='local rank for distributed training')
+    parser.add_argument('--fix_random_seed', action='store_true', default=False, help='')
+    parser.add_argument('--set', dest='set_cfgs', default=None, nargs=argparse.REMAINDER,
+                        help='set extra config keys if needed')
+
+    parser.add_argument('--dataset_type', choices=["train", "valid", "test"], required=True, type=str, default="", help='run on which part of dataset')
+    # database building
+    parser.add_argument('--llm_context', type=str, default=None, help='the LLM output context file, the labeled agents are appended into the new retrieval database')
+    parser.add_argument('--database_dtype', choices=['float16', 'float32'], default='float32', help='dtype of the embedding matrix in the new retrieval database')
+    # retrieval
+    parser.add_argument('--retrieval_database', type=str, default=None, help='retrieve from this database, default is the new database built in this pass')
+    parser.add_argument('--retrieval_window_size', type=int, default=4, help='the retrieval window size, 0 to skip the retrieval')
+    parser.add_argument('--retrieval_backend', choices=['dense'] + list(ann_index.__all__.keys()), default='dense', help='see generate_context.py')
+    parser.add_argument('--retrieval_index', type=str, default=None, help='see generate_context.py')
+    parser.add_argument('--use_pca_projection', action='store_true', default=False, help='see generate_context.py')
+    parser.add_argument('--nprobe', type=int, default=None, help='see generate_context.py')
+    parser.add_argument('--device', choices=['cuda', 'cpu'], default='cuda', help='see generate_context.py')
+    parser.add_argument('--num_threads', type=int, default=None, help='see generate_context.py')
+    parser.add_argument('--skip_context_pickle', action='store_true', default=False, help='see generate_context.py')
+    # embedding cache
+    parser.add_argument('--embedding_cache_root', type=str, default=None, help='keep the encoder embeddings in {root}/{ckpt_hash}/{dataset_type}')
+
+    args = parser.parse_args()
+
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    cfg.TAG = Path(args.cfg_file).stem
+    cfg.EXP_GROUP_PATH = '/'.join(args.cfg_file.split('/')[1:-1])  # remove 'cfgs' and 'xxxx.yaml'
+
+    np.random.seed(1024)
+
+    if args.set_cfgs is not None:
+        cfg_from_list(args.set_cfgs, cfg)
+
+    return args, cfg
+
+
+def get_llm_label_dict(llm_context_path):
+    """
+    Returns:
+        llm_label_dict (dict): (scenario_id, track_index) => (intention (8), affordance, scenario), the label codes
+            of context_codec.py, the same as generate_feature_vector.py
+    """
+    with open(llm_context_path, 'rb') as f:
+        llm_context = pickle.load(f)
+
+    keys = []
+    label_lists = {key: [] for key in CONTEXT_KEYS.keys()}
+    for scenario_id, context_data in llm_context.items():
+        keys.extend([(scenario_id, int(track_index)) for track_index in context_data['track_indexes']])
+        for key in CONTEXT_KEYS.keys():
+            label_lists[key].extend(context_data[key])
+    codes = [encode_label_lists(label_lists[key], context_type) for key, context_type in CONTEXT_KEYS.items()]
+    return {key: labels for key, labels in zip(keys, zip(*codes))}
+
+
+def append_batch_into_database(new_database, batch_embedding, scenario_id_list, track_index_list, center_objects_type, llm_label_dict):
+    if batch_embedding.shape[1] == 256:
+        # the database keeps [agent, 32 nearest map] embeddings, the agents without HD map can not be appended
+        return 0
+
+    batch_embedding = batch_embedding.cpu().numpy()
+    num_appended = 0
+    for agent_index, (scenario_id, track_index, agent_type) in enumerate(zip(scenario_id_list, track_index_list, center_objects_type)):
+        labels = llm_label_dict.get((scenario_id, int(track_index)), None)
+        if labels is None:
+            continue
+        new_database[agent_type]["scenario_id"].append(scenario_id)
+        new_database[agent_type]["track_index"].append(int(track_index))
+        new_database[agent_type]["embedding"].append(batch_embedding[agent_index])
+        new_database[agent_type]["intention"].append(labels[0])
+        new_database[agent_type]["affordance"].append(labels[1])
+        new_database[agent_type]["scenario"].append(labels[2])
+        num_appended += 1
+    return num_appended
+
+
+def generate_embedding_and_context(model, dataloader, args, logger, dist_test=False):
+    it, epoch = model.load_params_from_file(filename=args.ckpt, logger=logger, to_cpu=dist_test or args.device == 'cpu')
+    model.to(get_device(args))
+    logger.info(f'*************** LOAD MODEL (epoch={epoch}, iter={it}) for EMBEDDING AND CONTEXT GENERATE *****************')
+
+    rank, world_size = common_utils.get_dist_info()
+    llm_integrate_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    save_context_dir = os.path.join(llm_integrate_dir, "context_data", args.dataset_type)
+    embedding_file_dir = os.path.join(llm_integrate_dir, "LLM_output", "context_file")
+    os.makedirs(save_context_dir, exist_ok=True)
+
+    build_database = args.llm_context is not None
+    retrieve_context = args.retrieval_window_size > 0 and (args.retrieval_database is not None or build_database)
+    # without a given database, the retrieval runs after the pass on the cached embeddings
+    retrieve_online = retrieve_context and args.retrieval_database is not None
+    cache_root = args.embedding_cache_root
+    if retrieve_context and not retrieve_online and cache_root is None:
+        cache_root = os.path.join(save_context_dir, 'embedding_cache')
+    assert build_database or retrieve_context or cache_root is not None, 'nothing to do, set --llm_context, --retrieval_database or --embedding_cache_root'
+
+    llm_label_dict = get_llm_label_dict(args.llm_context) if build_database else None
+    new_database = copy.deepcopy(embedding_format.embedding_dict)
+    num_appended = 0
+
+    if retrieve_online:
+        context_codes, retrieval_engine, retrieval_index_dict, pca_projection = load_retrieval_backend(args.retrieval_database, args, logger)
+
+    cache_writer = None
+    if cache_root is not None:
+        cache_writer = create_embedding_cache_writer(
+            cache_root, args.ckpt, args.dataset_type, source=get_embedding_cache_source(cfg.DATA_CONFIG, args.dataset_type)
+        )
+        logger.info(f'Write the encoder embeddings into {cache_writer.cache_dir}')
+
+    model.eval()
+    if rank == 0:
+        progress_bar = tqdm(total=len(dataloader), leave=True, desc='gen emb & ctx', dynamic_ncols=True)
+
+    context_writer = None
+    if retrieve_context:
+        context_writer = create_context_shard_writer(get_context_shard_dir(save_context_dir, args), args.retrieval_window_size)
+
+    for i, batch_dict in enumerate(dataloader):
+        with torch.no_grad():
+            encode_batch_dict = model(batch_dict)
+            batch_embedding = get_batch_embedding(encode_batch_dict)
+            scenario_id_list = encode_batch_dict['input_dict']['scenario_id']
+            track_index_list = encode_batch_dict['input_dict']['track_index_to_predict_origin'].tolist()
+            center_objects_type = encode_batch_dict['input_dict']['center_objects_type']
+
+            if build_database:
+                num_appended += append_batch_into_database(new_database, batch_embedding, scenario_id_list, track_index_list, center_objects_type, llm_label_dict)
+            if retrieve_online:
+                retrieve_batch_context(
+                    batch_embedding, scenario_id_list, track_index_list, center_objects_type, context_writer,
+                    retrieval_engine, context_codes, retrieval_window_size=args.retrieval_window_size,
+                    retrieval_index_dict=retrieval_index_dict, nprobe=args.nprobe, pca_projection=pca_projection
+                )
+            if cache_writer is not None:
+                cache_writer.add(scenario_id_list, track_index_list, center_objects_type, batch_embedding)
+
+        if rank == 0:
+            progress_bar.update()
+
+    if rank == 0:
+        progress_bar.close()
+    if cache_writer is not None:
+        cache_writer.close()
+
+    # 1. save the new retrieval database
+    if build_database:
+        logger.info(f'Number of agents appended into the retrieval database on rank {rank}: {num_appended}')
+        if dist_test:
+            new_database = common_utils.merge_embedding_dict_dist(new_database, tmpdir=os.path.join(embedding_file_dir, "tmpdir"))
+        if rank == 0:
+            database_dir = save_retrieval_database(
+                new_database, os.path.join(embedding_file_dir, f"llm_output_context_with_{args.extra_tag}"), dtype=args.database_dtype
+            )
+            logger.info(f'Retrieval database is saved to {database_dir}: ' + ', '.join([f'{key}={len(val["embedding"])}' for key, val in new_database.items()]))
+        if args.retrieval_database is None:
+            args.retrieval_database = os.path.join(embedding_file_dir, f"llm_output_context_with_{args.extra_tag}")
+
+    # 2. retrieve from the new database with the cached embeddings
+    if retrieve_context and not retrieve_online:
+        if dist_test:
+            dist.barrier()
+        retrieve_context_from_cache(cache_writer.cache_dir, context_writer, args, logger)
+
+    # 3. merge the context shards of all ranks into the context store
+    if retrieve_context:
+        context_writer.close()
+        if dist_test:
+            dist.barrier()
+        if rank == 0:
+            save_context_data(save_context_dir, args, logger)
+    logger.info('****************GENERATE EMBEDDING AND CONTEXT FINISHED.*****************')
+
+
+def main():
+    args, cfg = parse_config()
+
+    if args.launcher == 'none':
+        dist_test = False
+        total_gpus = 1
+    else:
+        total_gpus, cfg.LOCAL_RANK = getattr(common_utils, 'init_dist_%s' % args.launcher)(
+            args.tcp_port, args.local_rank, backend='nccl' if args.device == 'cuda' else 'gloo'
+        )
+        dist_test = True
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    if args.batch_size is None:
+        args.batch_size = cfg.OPTIMIZATION.BATCH_SIZE_PER_GPU # type: ignore
+    else:
+        assert args.batch_size % total_gpus == 0, 'Batch size should match the number of gpus'
+        args.batch_size = args.batch_size // total_gpus
+
+    output_dir = cfg.ROOT_DIR / 'output' / cfg.EXP_GROUP_PATH / cfg.TAG / args.extra_tag
+    log_dir = output_dir / 'log'
+    log_dir.mkdir(parents=True, exist_ok=True)
+    log_file = log_dir / ('log_generate_embedding_and_context_%s.txt' % datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+    logger = common_utils.create_logger(log_file, rank=cfg.LOCAL_RANK)
+
+    logger.info('**********************Start logging**********************')
+    gpu_list = os.environ['CUDA_VISIBLE_DEVICES'] if 'CUDA_VISIBLE_DEVICES' in os.environ.keys() else 'ALL'
+    logger.info('CUDA_VISIBLE_DEVICES=%s' % gpu_list)
+    for key, val in vars(args).items():
+        logger.info('{:16} {}'.format(key, val))
+    log_config_to_file(cfg, logger=logger)
+
+    if args.fix_random_seed:
+        common_utils.set_random_seed(666)
+
+    dataset, dataloader, sampler = build_dataloader(
+        dataset_cfg=cfg.DATA_CONFIG,
+        batch_size=args.batch_size,
+        dist=dist_test, workers=args.workers, logger=logger, training=False, dataset_type=args.dataset_type
+    )
+
+    cfg.MODEL.GENERATE_EMBEDDING = cfg.DATA_CONFIG.GENERATE_EMBEDDING
+    model = model_utils.MotionTransformer(config=cfg.MODEL)
+    with torch.no_grad():
+        generate_embedding_and_context(model, dataloader, args, logger, dist_test=dist_test)
+
+
+if __name__ == "__main__":
+    main()
@@ -37,6 +37,11 @@ def parse_config():
     parser.add_argument('--start_epoch', type=int, default=0, help='')
     parser.add_argument('--ckpt_dir', type=str, default=None, help='specify a ckpt directory to be evaluated if needed')
     parser.add_argument('--save_to_file', action='store_true', default=False, help='')
+    parser.add_argument('--pca_dim', type=int, default=None, help='fit a PCA projection of the map channels of the embedding to pca_dim dims')
+    parser.add_argument('--embedding_cache_root', type=str, default=None, help='keep the encoder embeddings in {root}/{ckpt_hash}/{dataset_type}')
+    parser.add_argument('--dataset_type', choices=["train", "valid", "test"], default='test', type=str,
+                        help='encode which part of dataset (SPLIT_DIR / INFO_FILE of the config), also the name of the embedding cache dir')
+    parser.add_argument('--database_dtype', choices=['float16', 'float32'], default='float32', help='dtype of the embedding matrix in the saved retrieval database')
 
     args = parser.parse_args()
 
@@ -64,7 +69,8 @@ def generate_feature_vector_by_ckpt_encoder(model, test_loader, args, log_dir, l
     # start iterate and generate feature vector
     generate_feature_vector_utils.generate_feature_vector(
         cfg, model, test_loader, epoch_id, logger, dist_test=dist_test,
-        result_dir=log_dir, save_to_file=args.save_to_file, extra_tag = args.extra_tag
+        result_dir=log_dir, save_to_file=args.save_to_file, extra_tag = args.extra_tag, database_dtype=args.database_dtype, pca_dim=args.pca_dim,
+        embedding_cache_root=args.embedding_cache_root, ckpt_path=args.ckpt, dataset_type=args.dataset_type
     )
 
 def main():
@@ -114,7 +120,7 @@ def main():
     test_set, test_loader, sampler = build_dataloader(
         dataset_cfg=cfg.DATA_CONFIG,
         batch_size=args.batch_size,
-        dist=dist_test, workers=args.workers, logger=logger, training=False
+        dist=dist_test, workers=args.workers, logger=logger, training=False, dataset_type=args.dataset_type
     )
     # before we inistialize MTR, we need tell him there is no need to init decoder and use it
     cfg.MODEL.GENERATE_EMBEDDING = cfg.DATA_CONFIG.GENERATE_EMBEDDING
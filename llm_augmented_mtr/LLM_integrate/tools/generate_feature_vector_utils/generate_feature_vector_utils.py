@@ -1,89 +1,47 @@
-import pickle
 import time
 
-import numpy as np
 import torch
 import tqdm
 import os
 import torch.distributed as dist
+from mtr.datasets.llm_context.context_codec import one_hot_to_codes
 from mtr.utils import common_utils
-from LLM_integrate.embedding.embedding_format import embedding_dict, intention_type_decode_dict, affordance_type_decode_dict, scenario_type_decode_dict
-
-def save_feature_vector(embedding_dict, embedding_file_dir, extra_tag):
-    embedding_file_path = os.path.join(embedding_file_dir, f"llm_output_context_with_{extra_tag}.pkl")
-    
-    with open(embedding_file_path, 'wb') as embedding_file:
-        pickle.dump(embedding_dict,embedding_file)
-
-def find_k_nearest_map_embedding(k, map_feature, map_pos, map_mask):
-    # map_feature shape (#agent, #polyline, 256)
-    # map_pos     shape (#agent, #polyline, 3)
-    # map_mask    shape (#agent, #polyline)
-    # set the invaild map polyline's coordinate to infinity
-    map_pos[~map_mask] = 100000000
-    num_of_agent, num_of_polyline, _ = map_pos.shape
-    # (#agent, #polyline)
-    # distance = (map_pos[:,:,:2] - torch.zeros(num_of_agent, num_of_polyline, 2).to(map_pos.device)).norm(dim=-1)
-    distance = map_pos[:,:,:2].to(map_pos.device).norm(dim=-1)
-    # (#agent, k)
-    topk_dist, polyline_idxs = distance.topk(k=k, dim=-1, largest=False)
-    # bool matrix of shape (#agent, k)
-    polyline_mask = (topk_dist > 100000000)
-    # (#num_of_agent,) => (#num_of_agent, 1) => (#num_of_agent, k)
-    agent_idx = torch.arange(num_of_agent).view(-1, 1).expand(-1, k)
-    # (#agent, k, 256)
-    need_map_feature = map_feature[agent_idx, polyline_idxs]
-    
-    need_map_feature[polyline_mask.unsqueeze(-1).expand(-1, -1, 256)] = 0.0
-    # (#agent, k*256)
-    need_map_feature = need_map_feature.view(num_of_agent, -1)
-    
-    return need_map_feature
-
-def covert_onehot_context_into_text(track_intentions, track_affordances, track_scenarios):
-    track_intentions_text = []
-    track_affordances_text = []
-    track_scenarios_text = []
-    
-    # we use weighted one hot encode for intention
-    # encoded_data[encode_dict[value]] = len(data) - index
-    for onehot_intention in track_intentions:
-        # get the number of intentions
-        num_of_intention = 0
-        for code in onehot_intention:
-            if int(code) != 0:
-                num_of_intention += 1
-        track_intention_text_single = ["" for _ in range(num_of_intention)]
-        
-        # decode the code and get intention text
-        for index, code in enumerate(onehot_intention):
-            if int(code) != 0:
-                rank = num_of_intention - code
-                track_intention_text_single[rank] = intention_type_decode_dict[index]
-        
-        # insert this decode vector
-        track_intentions_text.append(track_intention_text_single)
-    
-    # we use one hot encode for affordance and scenario
-    # encoded_data[encode_dict[value]] = 1
-    for onehot_affordance in track_affordances:
-        track_affordance_text_single = []
-        # decode the code and get affordance text
-        for index, code in enumerate(onehot_affordance):
-            if int(code) != 0:
-                track_affordance_text_single.append(affordance_type_decode_dict[index])
-        # insert this decode vector
-        track_affordances_text.append(track_affordance_text_single)
-    
-    for onehot_scenario in track_scenarios:
-        track_scenario_text_single = []
-        for index, code in enumerate(onehot_scenario):
-            if int(code) != 0:
-                track_scenario_text_single.append(scenario_type_decode_dict[index])
-        track_scenarios_text.append(track_scenario_text_single)
-        
-    return track_intentions_text, track_affordances_text, track_scenarios_text
-    
+from LLM_integrate.embedding.embedding_format import embedding_dict
+from LLM_integrate.retrieval.embedding_cache import create_embedding_cache_writer, get_embedding_cache_source
+from LLM_integrate.retrieval.pca_projection import fit_and_save_pca_projection
+from LLM_integrate.retrieval.retrieval_database import save_retrieval_database
+
+def save_feature_vector(embedding_dict, embedding_file_dir, extra_tag, database_dtype='float32'):
+    # the retrieval database is saved as a binary dir (see LLM_integrate/retrieval/retrieval_database.py)
+    embedding_file_path = os.path.join(embedding_file_dir, f"llm_output_context_with_{extra_tag}")
+    return save_retrieval_database(embedding_dict, embedding_file_path, dtype=database_dtype)
+
+def find_k_nearest_map_embedding(features, pos, mask, k):
+    """
+    Gather the features of the k nearest valid map polylines of each agent (in the agent-centric frame),
+    the input tensors are not modified
+
+    Args:
+        features (num_agents, num_polylines, C):
+        pos (num_agents, num_polylines, 3): the center of each polyline
+        mask (num_agents, num_polylines): valid polylines
+        k (int):
+
+    Returns:
+        need_map_feature (num_agents, k * C): ordered by distance, zeros for invalid polylines (or when num_polylines < k)
+    """
+    num_of_agent, num_of_polyline, num_of_channel = features.shape
+    # squared distance to the agent, the invalid polylines are never selected before the valid ones
+    sqr_dist = pos[:, :, 0:2].pow(2).sum(dim=-1).masked_fill(~mask.bool(), float('inf'))
+    topk_sqr_dist, polyline_idxs = sqr_dist.topk(k=min(k, num_of_polyline), dim=-1, largest=False)
+
+    # (#agent, k, C)
+    need_map_feature = features.gather(dim=1, index=polyline_idxs[:, :, None].expand(-1, -1, num_of_channel))
+    need_map_feature = need_map_feature * torch.isfinite(topk_sqr_dist)[:, :, None].type_as(need_map_feature)
+    if num_of_polyline < k:
+        need_map_feature = torch.cat((need_map_feature, need_map_feature.new_zeros(num_of_agent, k - num_of_polyline, num_of_channel)), dim=1)
+    # (#agent, k*C)
+    return need_map_feature.view(num_of_agent, -1)
 
 def insert_all_info_into_result(embedding, scenario_id_list, objects_type_list, track_index_to_predict, 
                                 track_intentions, track_affordances, track_scenarios):
@@ -92,13 +50,13 @@ def insert_all_info_into_result(embedding, scenario_id_list, objects_type_list,
         agent_type = objects_type_list[agent_index]
         embedding_dict[agent_type]["scenario_id"].append(scenario_id_list[agent_index])
         embedding_dict[agent_type]["track_index"].append(track_index_to_predict[agent_index].item())
-        embedding_dict[agent_type]["embedding"].append(embedding[agent_index].tolist())
+        embedding_dict[agent_type]["embedding"].append(embedding[agent_index].cpu().numpy())
         embedding_dict[agent_type]["intention"].append(track_intentions[agent_index])
         embedding_dict[agent_type]["affordance"].append(track_affordances[agent_index])
         embedding_dict[agent_type]["scenario"].append(track_scenarios[agent_index])
         
 
-def save_batch_embedding(batch_dict):
+def save_batch_embedding(batch_dict, cache_writer=None):
     # Here we generate the embedding for each batch
     # ==================Needed data===================
     # batch_dict['center_objects_feature'] shape (#agent, 256)
@@ -123,19 +81,24 @@ def save_batch_embedding(batch_dict):
     track_affordances = batch_dict['input_dict']['track_affordances']
     track_scenarios = batch_dict['input_dict']['track_scenarios']
     
-    k_nearset_map_feature = find_k_nearest_map_embedding(32, map_feature, map_pos, map_mask)
+    k_nearset_map_feature = find_k_nearest_map_embedding(map_feature, map_pos, map_mask, k=32)
     
     final_embedding = torch.cat([center_objects_feature, k_nearset_map_feature], dim=1) # type: ignore
+    if cache_writer is not None:
+        cache_writer.add(scenario_id_list, track_index_to_predict, center_objects_type, final_embedding)
     
-    # decode one hot to text
-    track_intentions_text, track_affordances_text, track_scenarios_text = covert_onehot_context_into_text(track_intentions, track_affordances, track_scenarios) # type: ignore
+    # convert one hot to the label codes, shape (#agent, 8), (#agent), (#agent)
+    track_intentions_code = one_hot_to_codes(track_intentions, 'intention')
+    track_affordances_code = one_hot_to_codes(track_affordances, 'affordance')
+    track_scenarios_code = one_hot_to_codes(track_scenarios, 'scenario')
     
     # insert embedding into embedding file
     insert_all_info_into_result(final_embedding, scenario_id_list, center_objects_type, track_index_to_predict, 
-                                track_intentions_text, track_affordances_text, track_scenarios_text)
+                                track_intentions_code, track_affordances_code, track_scenarios_code)
     
 
-def generate_feature_vector(cfg, model, dataloader, epoch_id, logger, dist_test=False, save_to_file=False, result_dir=None, logger_iter_interval=50, extra_tag=""):
+def generate_feature_vector(cfg, model, dataloader, epoch_id, logger, dist_test=False, save_to_file=False, result_dir=None, logger_iter_interval=50, extra_tag="", database_dtype='float32', pca_dim=None,
+                            embedding_cache_root=None, ckpt_path=None, dataset_type='test'):
     cur_dir_name = os.path.dirname(os.path.abspath(__file__))
     tools_dir_name = os.path.dirname(cur_dir_name)
     llm_integrate_dir_name = os.path.dirname(tools_dir_name)
@@ -153,6 +116,13 @@ def generate_feature_vector(cfg, model, dataloader, epoch_id, logger, dist_test=
             )
     model.eval()
 
+    cache_writer = None
+    if embedding_cache_root is not None:
+        cache_writer = create_embedding_cache_writer(
+            embedding_cache_root, ckpt_path, dataset_type, source=get_embedding_cache_source(cfg.DATA_CONFIG, dataset_type)
+        )
+        logger.info(f'Write the encoder embeddings into {cache_writer.cache_dir}')
+
     if cfg.LOCAL_RANK == 0:
         progress_bar = tqdm.tqdm(total=len(dataloader), leave=True, desc='gen fv', dynamic_ncols=True)
     start_time = time.time()
@@ -160,7 +130,7 @@ def generate_feature_vector(cfg, model, dataloader, epoch_id, logger, dist_test=
     for i, batch_dict in enumerate(dataloader):
         with torch.no_grad():
             encode_batch_dict = model(batch_dict)
-            save_batch_embedding(encode_batch_dict)
+            save_batch_embedding(encode_batch_dict, cache_writer=cache_writer)
             dist.barrier()
 
         disp_dict = {}
@@ -175,13 +145,19 @@ def generate_feature_vector(cfg, model, dataloader, epoch_id, logger, dist_test=
                         f'time_cost: {progress_bar.format_interval(past_time)}/{progress_bar.format_interval(remaining_time)}, '
                         f'{disp_str}')
 
+    if cache_writer is not None:
+        cache_writer.close()
+
     if dist_test:
         logger.info(f'Number of different ego car before merging from multiple GPUs: VEHICLE({len(embedding_dict["TYPE_VEHICLE"]["embedding"])}), PEDESTRIAN({len(embedding_dict["TYPE_PEDESTRIAN"]["embedding"])}), CYCLIST({len(embedding_dict["TYPE_CYCLIST"]["embedding"])})')
         merged_embedding_dict = common_utils.merge_embedding_dict_dist(embedding_dict, tmpdir=os.path.join(embedding_file_dir, "tmpdir"))
 
     if cfg.LOCAL_RANK == 0:
         logger.info(f'Number of different ego car after merging from multiple GPUs: VEHICLE({len(merged_embedding_dict["TYPE_VEHICLE"]["embedding"])}), PEDESTRIAN({len(merged_embedding_dict["TYPE_PEDESTRIAN"]["embedding"])}), CYCLIST({len(merged_embedding_dict["TYPE_CYCLIST"]["embedding"])})') # type: ignore
-        save_feature_vector(merged_embedding_dict, embedding_file_dir, extra_tag)
+        database_dir = save_feature_vector(merged_embedding_dict, embedding_file_dir, extra_tag, database_dtype=database_dtype)
+        if pca_dim is not None:
+            # the projected embeddings are saved next to the full embeddings, see generate_context.py --use_pca_projection
+            fit_and_save_pca_projection(database_dir, pca_dim, logger, device=torch.cuda.current_device())
         logger.info('****************GENERATE FEATURE VECTOR FINISHED.*****************')
         
     if cfg.LOCAL_RANK == 0:
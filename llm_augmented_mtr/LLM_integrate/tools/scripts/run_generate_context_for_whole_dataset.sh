@@ -8,7 +8,7 @@ do
     --ckpt ../../output/waymo/mtr+100_percent_data/mtr+100/ckpt/checkpoint_epoch_29.pth \
     --extra_tag encoder_100 \
     --batch_size 2 \
-    --retrieval_database ../LLM_output/context_file/llm_output_context_with_encoder_100.pkl \
+    --retrieval_database ../LLM_output/context_file/llm_output_context_with_encoder_100 \
     --retrieval_window_size 4 \
     --dataset_type $dataset_type
 done
@@ -9,6 +9,7 @@ import torch
 from torch.utils.data import DataLoader
 from mtr.utils import common_utils
 
+from . import samplers
 from .waymo.waymo_dataset import WaymoDataset
 
 
@@ -17,6 +18,28 @@ __all__ = {
 }
 
 
+def build_batch_sampler(sampler_cfg, dataset, batch_size, num_replicas=1, rank=0, drop_last=False):
+    num_center_objects, num_objects = dataset.get_sample_sizes()
+    # group by the number of agents if it is known, otherwise by the number of center objects
+    sample_sizes = num_objects if num_objects is not None else num_center_objects
+
+    common_kwargs = dict(
+        sample_sizes=sample_sizes, num_replicas=num_replicas, rank=rank, shuffle=True,
+        seed=sampler_cfg.get('SEED', 0), drop_last=drop_last,
+        bucket_size_multiplier=sampler_cfg.get('BUCKET_SIZE_MULTIPLIER', 50)
+    )
+    if sampler_cfg.NAME == 'BucketBatchSampler':
+        batch_sampler = samplers.BucketBatchSampler(batch_size=batch_size, **common_kwargs)
+    elif sampler_cfg.NAME == 'CenterObjectBatchSampler':
+        batch_sampler = samplers.CenterObjectBatchSampler(
+            num_center_objects=num_center_objects, max_center_objects=sampler_cfg.MAX_CENTER_OBJECTS_PER_BATCH,
+            max_scenarios=sampler_cfg.get('MAX_SCENARIOS_PER_BATCH', None), **common_kwargs
+        )
+    else:
+        raise NotImplementedError(sampler_cfg.NAME)
+    return batch_sampler
+
+
 def build_dataloader(dataset_cfg, batch_size, dist, workers=4,
                      logger=None, training=True, merge_all_iters_to_one_epoch=False, total_epochs=0, add_worker_init_fn=False, dataset_type=""):
     
@@ -36,6 +59,23 @@ def build_dataloader(dataset_cfg, batch_size, dist, workers=4,
         assert hasattr(dataset, 'merge_all_iters_to_one_epoch')
         dataset.merge_all_iters_to_one_epoch(merge=True, epochs=total_epochs)
 
+    drop_last = dataset_cfg.get('DATALOADER_DROP_LAST', False) and training
+
+    batch_sampler_cfg = dataset_cfg.get('BATCH_SAMPLER', None)
+    if batch_sampler_cfg is not None and training:
+        # the evaluation keeps the default sampler, since merge_results_dist relies on its interleaved order
+        rank, world_size = common_utils.get_dist_info()
+        batch_sampler = build_batch_sampler(
+            batch_sampler_cfg, dataset, batch_size=batch_size, num_replicas=world_size, rank=rank, drop_last=drop_last
+        )
+        dataloader = DataLoader(
+            dataset, batch_sampler=batch_sampler, pin_memory=True, num_workers=workers,
+            collate_fn=dataset.collate_batch, timeout=0,
+            worker_init_fn=worker_init_fn_ if add_worker_init_fn else None
+        )
+        # returned as the sampler, so that set_epoch is called at the beginning of each epoch
+        return dataset, dataloader, batch_sampler
+
     if dist:
         if training:
             sampler = torch.utils.data.distributed.DistributedSampler(dataset)
@@ -45,7 +85,6 @@ def build_dataloader(dataset_cfg, batch_size, dist, workers=4,
     else:
         sampler = None
 
-    drop_last = dataset_cfg.get('DATALOADER_DROP_LAST', False) and training
     dataloader = DataLoader(
         dataset, batch_size=batch_size, pin_memory=True, num_workers=workers,
         shuffle=(sampler is None) and training, collate_fn=dataset.collate_batch,
@@ -66,6 +66,10 @@ class DatasetTemplate(torch_data.Dataset):
             center_gt_trajs (num_center_objects, num_future_timestamps, 4): [x, y, vx, vy]
             center_gt_trajs_mask (num_center_objects, num_future_timestamps):
             center_gt_final_valid_idx (num_center_objects): the final valid timestamp in num_future_timestamps
+
+            obj_trajs_world, obj_onehot_shared, obj_timestamps, obj_trajs_future_world: (1, ...)
+                center-invariant agent features with SHARE_CENTER_INVARIANT_FEATURES, which replace obj_trajs, obj_trajs_mask,
+                obj_trajs_pos, obj_trajs_last_pos, obj_trajs_future_state and obj_trajs_future_mask
         """
         batch_size = len(batch_list)
         key_to_list = {}
@@ -76,7 +80,8 @@ class DatasetTemplate(torch_data.Dataset):
         for key, val_list in key_to_list.items():
 
             if key in ['obj_trajs', 'obj_trajs_mask', 'map_polylines', 'map_polylines_mask', 'map_polylines_center',
-                'obj_trajs_pos', 'obj_trajs_last_pos', 'obj_trajs_future_state', 'obj_trajs_future_mask']:
+                'obj_trajs_pos', 'obj_trajs_last_pos', 'obj_trajs_future_state', 'obj_trajs_future_mask',
+                'obj_trajs_world', 'obj_onehot_shared', 'obj_trajs_future_world']:
                 val_list = [torch.from_numpy(x) for x in val_list]
                 input_dict[key] = common_utils.merge_batch_by_padding_2nd_dim(val_list)
             elif key in ['scenario_id', 'obj_types', 'obj_ids', 'center_objects_type', 'center_objects_id']:
@@ -86,5 +91,17 @@ class DatasetTemplate(torch_data.Dataset):
                 input_dict[key] = torch.cat(val_list, dim=0)
 
         batch_sample_count = [len(x['track_index_to_predict']) for x in batch_list]
+        if 'obj_trajs_world' in input_dict:
+            # the center-invariant agent features are shared by all center objects of a scene
+            input_dict['center_scene_idx'] = torch.cat([torch.full((cnt,), bs_idx, dtype=torch.int64) for bs_idx, cnt in enumerate(batch_sample_count)], dim=0)
+        if self.dataset_cfg.get('COMPACT_TRANSPORT', False):
+            # ship float16 features and bit-packed masks to the GPU, they are unpacked and upcast in MTREncoder.forward
+            for key in ['obj_trajs', 'map_polylines']:
+                if key in input_dict:
+                    input_dict[key] = input_dict[key].half()
+            for key in ['obj_trajs_mask', 'map_polylines_mask']:
+                if key in input_dict:
+                    input_dict[key] = common_utils.pack_bool_mask(input_dict[key])
+
         batch_dict = {'batch_size': batch_size, 'input_dict': input_dict, 'batch_sample_count': batch_sample_count}
         return batch_dict
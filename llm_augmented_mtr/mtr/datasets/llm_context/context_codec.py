@@ -0,0 +1,131 @@
+# Integer codes of the LLM context labels
+# intention: (..., 8) int8, the intention type ids in the order given by the LLM (the first one is the most likely), padded with -1
+# affordance / scenario: (...) uint8 bitmask, bit k is set if the k-th type of context_types.py is present
+# The labels are encoded with context_types.py and decoded with the *_type_decode_dict of LLM_integrate/embedding/embedding_format.py
+# (the same type ids), and the one-hot vectors fed to the model are the same as before: weighted one-hot for the intention (the k-th of n intentions has weight n - k)
+# and one-hot for the affordance / scenario
+
+
+import numpy as np
+
+from LLM_integrate.embedding.embedding_format import intention_type_decode_dict, affordance_type_decode_dict, scenario_type_decode_dict
+from mtr.datasets.llm_context.context_types import context_types_dict
+
+
+MAX_NUM_INTENTIONS = len(context_types_dict['intention'])
+CONTEXT_DECODE_DICT = {
+    context_type: np.array([decode_dict[type_id] for type_id in range(len(decode_dict))])
+    for context_type, decode_dict in zip(
+        ['intention', 'affordance', 'scenario'], [intention_type_decode_dict, affordance_type_decode_dict, scenario_type_decode_dict]
+    )
+}
+
+
+def get_code_shape(context_type):
+    return (MAX_NUM_INTENTIONS,) if context_type == 'intention' else ()
+
+
+def get_empty_codes(num, context_type):
+    """
+    Returns:
+        codes (num, 8) int8 filled with -1 for intention, (num) uint8 zeros for affordance / scenario
+    """
+    if context_type == 'intention':
+        return np.full((num, MAX_NUM_INTENTIONS), -1, dtype=np.int8)
+    return np.zeros(num, dtype=np.uint8)
+
+
+def encode_label_lists(label_lists, context_type):
+    """
+    Args:
+        label_lists (list): N lists of type names, e.g. [['STRAIGHT', 'LEFT_TURN'], ['STATIONARY'], ...]
+
+    Returns:
+        codes (N, 8) int8 for intention, (N) uint8 for affordance / scenario
+    """
+    type_dict = context_types_dict[context_type]
+    num_labels = np.array([len(x) for x in label_lists], dtype=np.int64)
+    type_ids = np.array([type_dict[x] for labels in label_lists for x in labels], dtype=np.int64)
+    rows = np.repeat(np.arange(len(label_lists)), num_labels)
+
+    codes = get_empty_codes(len(label_lists), context_type)
+    if context_type == 'intention':
+        assert num_labels.max(initial=0) <= MAX_NUM_INTENTIONS, f'more than {MAX_NUM_INTENTIONS} intentions of one agent'
+        positions = np.arange(len(type_ids)) - np.repeat(np.cumsum(num_labels) - num_labels, num_labels)
+        codes[rows, positions] = type_ids
+    else:
+        np.bitwise_or.at(codes, rows, (1 << type_ids).astype(np.uint8))
+    return codes
+
+
+def codes_to_one_hot(codes, context_type, dtype=np.uint8):
+    """
+    Args:
+        codes (..., 8) for intention or (...) for affordance / scenario
+
+    Returns:
+        one_hot (..., num_types): weighted one-hot for intention, one-hot for affordance / scenario
+    """
+    num_types = len(context_types_dict[context_type])
+    codes = np.asarray(codes)
+    if context_type != 'intention':
+        return ((codes[..., None] >> np.arange(num_types)) & 1).astype(dtype)
+
+    flat_codes = codes.reshape(-1, MAX_NUM_INTENTIONS)
+    valid_mask = flat_codes >= 0
+    rows, positions = np.nonzero(valid_mask)
+    one_hot = np.zeros((len(flat_codes), num_types), dtype=dtype)
+    one_hot[rows, flat_codes[rows, positions]] = valid_mask.sum(axis=-1)[rows] - positions
+    return one_hot.reshape(codes.shape[:-1] + (num_types,))
+
+
+def one_hot_to_codes(one_hot, context_type):
+    """
+    The inverse of codes_to_one_hot
+
+    Args:
+        one_hot (..., num_types): numpy array or tensor
+
+    Returns:
+        codes (..., 8) int8 for intention, (...) uint8 for affordance / scenario
+    """
+    if hasattr(one_hot, 'detach'):
+        one_hot = one_hot.detach().cpu().numpy()
+    one_hot = np.rint(np.asarray(one_hot)).astype(np.int64)
+    num_types = one_hot.shape[-1]
+    if context_type != 'intention':
+        return ((one_hot != 0).astype(np.int64) << np.arange(num_types)).sum(axis=-1).astype(np.uint8)
+
+    flat_one_hot = one_hot.reshape(-1, num_types)
+    codes = get_empty_codes(len(flat_one_hot), context_type)
+    rows, type_ids = np.nonzero(flat_one_hot)
+    # the intention of weight w is at position (number of intentions - w)
+    positions = (flat_one_hot != 0).sum(axis=-1)[rows] - flat_one_hot[rows, type_ids]
+    codes[rows, positions] = type_ids
+    return codes.reshape(one_hot.shape[:-1] + (MAX_NUM_INTENTIONS,))
+
+
+def encode_one_hot(label_lists, context_type, dtype=np.uint8):
+    return codes_to_one_hot(encode_label_lists(label_lists, context_type), context_type, dtype=dtype)
+
+
+def decode_codes(codes, context_type):
+    """
+    Args:
+        codes (N, 8) for intention or (N) for affordance / scenario
+
+    Returns:
+        label_lists (list): N lists of type names
+    """
+    type_names = CONTEXT_DECODE_DICT[context_type]
+    codes = np.asarray(codes)
+    if len(codes) == 0:
+        return []
+    if context_type == 'intention':
+        valid_mask = codes >= 0
+        flat_names = type_names[codes[valid_mask]]
+    else:
+        valid_mask = codes_to_one_hot(codes, context_type, dtype=bool)
+        flat_names = np.broadcast_to(type_names, valid_mask.shape)[valid_mask]
+    split_idxs = np.cumsum(valid_mask.sum(axis=-1))[:-1]
+    return [x.tolist() for x in np.split(flat_names, split_idxs)]
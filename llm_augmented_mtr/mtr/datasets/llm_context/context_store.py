@@ -0,0 +1,341 @@
+# Columnar store of the LLM context data
+# The context pickle (scenario_id => lists of intention/affordance/scenario strings of each agent) is converted once
+# into contiguous integer codes of all agents (see context_codec.py): track_intentions (num_agents_total, window, 8) int8,
+# track_affordances / track_scenarios (num_agents_total, window) uint8 bitmasks, and a sorted scenario_id => row offset
+# index, saved as .npy files and loaded with mmap, so the dataloader workers share the pages of one copy
+# The codes are expanded into the one-hot vectors of the model when a scenario is read
+# generate_context.py writes the same codes incrementally into per-rank shards (ContextShardWriter),
+# which are merged into the store by merge_context_shards without building the context pickle
+
+
+import os
+import json
+import pickle
+import shutil
+
+import glob
+
+import numpy as np
+import torch.distributed as dist
+from tqdm import tqdm
+
+from mtr.datasets.llm_context.context_codec import codes_to_one_hot, encode_label_lists, get_code_shape
+from mtr.utils import common_utils
+
+
+CONTEXT_KEYS = {
+    'track_intentions': 'intention',
+    'track_affordances': 'affordance',
+    'track_scenarios': 'scenario'
+}
+CONTEXT_STORE_META_FILE = 'meta.json'
+CONTEXT_STORE_ENCODING = 'codes'
+
+
+def get_context_store_path(context_path):
+    return os.path.splitext(str(context_path))[0] + '_store'
+
+
+def get_context_source_stat(context_path):
+    """
+    Returns:
+        the size and mtime of the context pickle recorded in the meta of the store converted from it, None if it does not exist
+    """
+    if not os.path.exists(context_path):
+        return None
+    stat = os.stat(context_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_context_store_up_to_date(store_path, context_path):
+    """
+    A store is outdated if the context pickle changed after the conversion (e.g. rewritten by LLM_output/format_convert.py),
+    a store without its pickle (written by generate_context.py) is always up to date
+    """
+    meta_file = os.path.join(store_path, CONTEXT_STORE_META_FILE)
+    if not os.path.exists(meta_file):
+        return False
+    source_stat = get_context_source_stat(context_path)
+    if source_stat is None:
+        return True
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    return meta.get('source', None) == source_stat
+
+
+def set_context_store_source(store_path, context_path):
+    """
+    Record the context pickle written together with the store (by generate_context.py) as its source
+    """
+    meta_file = os.path.join(store_path, CONTEXT_STORE_META_FILE)
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    meta['source'] = get_context_source_stat(context_path)
+    with open(meta_file, 'w') as f:
+        json.dump(meta, f)
+
+
+def save_context_store(store_path, scenario_id, offsets, track_index, context_arrays, has_retrieval_window, source=None):
+    """
+    Args:
+        store_path (str):
+        scenario_id (num_scenarios): sorted scenario ids
+        offsets (num_scenarios + 1): the agents of the k-th scenario are the rows offsets[k]:offsets[k + 1]
+        track_index (num_agents_total): track index of each agent
+        context_arrays (dict): track_intentions (num_agents_total, window, 8) int8, track_affordances (num_agents_total, window) uint8,
+            track_scenarios (num_agents_total, window) uint8, the codes of context_codec.py
+        has_retrieval_window (bool): False if the context of each agent is not a retrieval window (LLM output context),
+            then window is 1
+        source (dict): get_context_source_stat of the converted context pickle
+    """
+    # write into a temporary dir first, the store only appears when it is complete
+    tmp_store_path = store_path + '.tmp'
+    shutil.rmtree(tmp_store_path, ignore_errors=True)
+    os.makedirs(tmp_store_path)
+    np.save(os.path.join(tmp_store_path, 'scenario_id.npy'), np.array(scenario_id))
+    np.save(os.path.join(tmp_store_path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_store_path, 'track_index.npy'), np.array(track_index, dtype=np.int64))
+    for key in CONTEXT_KEYS.keys():
+        np.save(os.path.join(tmp_store_path, f'{key}.npy'), np.ascontiguousarray(context_arrays[key]))
+
+    save_context_store_meta(
+        tmp_store_path, len(scenario_id), int(offsets[-1]), int(context_arrays['track_intentions'].shape[1]), has_retrieval_window, source=source
+    )
+
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(tmp_store_path, store_path)
+
+
+def save_context_store_meta(store_path, num_scenarios, num_agents, window_size, has_retrieval_window, source=None):
+    meta = {
+        'num_scenarios': num_scenarios,
+        'num_agents': num_agents,
+        'window_size': window_size,
+        'has_retrieval_window': has_retrieval_window,
+        'encoding': CONTEXT_STORE_ENCODING,
+        'source': source
+    }
+    with open(os.path.join(store_path, CONTEXT_STORE_META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def create_context_store(context_path, store_path=None):
+    """
+    Convert the context pickle into the columnar store, the decoded one-hot vectors are the same as WaymoDataset.format_context_infos
+
+    Args:
+        context_path (str): context pickle generated by generate_context.py (or LLM_output/format_convert.py)
+        store_path (str): default is {context_path without .pkl}_store
+    """
+    if store_path is None:
+        store_path = get_context_store_path(context_path)
+
+    # taken before reading, a pickle rewritten during the conversion is converted again next time
+    source = get_context_source_stat(context_path)
+    with open(context_path, 'rb') as f:
+        context_infos = pickle.load(f)
+
+    check_assistant = list(context_infos.values())[0]
+    has_retrieval_window = isinstance(check_assistant['track_intentions'][0][0], list)
+    window_size = len(check_assistant['track_intentions'][0]) if has_retrieval_window else 1
+
+    scenario_id = sorted(context_infos.keys())
+    track_index = []
+    label_lists = {key: [] for key in CONTEXT_KEYS.keys()}
+    for cur_scenario_id in tqdm(scenario_id, desc='convert context'):
+        context_data = context_infos[cur_scenario_id]
+        track_index.append(np.array(context_data['track_indexes'], dtype=np.int64))
+        for key in CONTEXT_KEYS.keys():
+            if has_retrieval_window:
+                assert all([len(x) >= window_size for x in context_data[key]]), f'{cur_scenario_id} has a retrieval window smaller than {window_size}'
+                for agent_context in context_data[key]:
+                    label_lists[key].extend(agent_context[:window_size])
+            else:
+                label_lists[key].extend(context_data[key])
+
+    # the labels of all agents are encoded at once
+    context_arrays = {
+        key: encode_label_lists(val, context_type).reshape((-1, window_size) + get_code_shape(context_type))
+        for (key, val), context_type in zip(label_lists.items(), CONTEXT_KEYS.values())
+    }
+    offsets = np.concatenate(([0], np.cumsum([len(x) for x in track_index]))).astype(np.int64)
+    save_context_store(
+        store_path, scenario_id, offsets, np.concatenate(track_index, axis=0), context_arrays, has_retrieval_window=has_retrieval_window,
+        source=source
+    )
+    return store_path
+
+
+def create_context_shard_writer(shard_dir, window_size):
+    """
+    The shards are regenerated: rank 0 removes the old ones and every rank writes its own shards
+    """
+    rank, world_size = common_utils.get_dist_info()
+    if rank == 0:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    if world_size > 1:
+        dist.barrier()
+    return ContextShardWriter(shard_dir, window_size, rank=rank)
+
+
+class ContextShardWriter(object):
+    """
+    Write the context codes of the agents incrementally into shards (the same arrays as the store),
+    the agents of one scenario should be added together
+    """
+    def __init__(self, shard_dir, window_size, rank=0, shard_size=65536):
+        self.shard_dir = shard_dir
+        self.window_size = window_size
+        self.rank = rank
+        self.shard_size = shard_size
+        self.num_shards = 0
+        self.num_agents = 0
+        self.buffer = None
+        self.num_buffered = 0
+        self.reset_buffer()
+        os.makedirs(shard_dir, exist_ok=True)
+
+    def reset_buffer(self):
+        self.buffer = {'scenario_id': [], 'track_index': []}
+        self.buffer.update({key: [] for key in CONTEXT_KEYS.keys()})
+        self.num_buffered = 0
+
+    def add(self, scenario_ids, track_indexes, context_arrays):
+        """
+        Args:
+            scenario_ids (num_agents): str
+            track_indexes (num_agents): int
+            context_arrays (dict): track_intentions (num_agents, window, 8) int8, track_affordances (num_agents, window) uint8,
+                track_scenarios (num_agents, window) uint8, the codes of context_codec.py
+        """
+        self.buffer['scenario_id'].append(np.array(scenario_ids))
+        self.buffer['track_index'].append(np.array(track_indexes, dtype=np.int64))
+        for key in CONTEXT_KEYS.keys():
+            assert context_arrays[key].shape[1] == self.window_size
+            self.buffer[key].append(np.asarray(context_arrays[key]))
+        self.num_buffered += len(scenario_ids)
+        if self.num_buffered >= self.shard_size:
+            self.flush()
+
+    def flush(self):
+        if self.num_buffered == 0:
+            return
+        cur_shard_dir = os.path.join(self.shard_dir, f'shard_{self.rank:03d}_{self.num_shards:05d}')
+        tmp_shard_dir = cur_shard_dir + '.tmp'
+        shutil.rmtree(tmp_shard_dir, ignore_errors=True)
+        os.makedirs(tmp_shard_dir)
+        for key, value in self.buffer.items():
+            np.save(os.path.join(tmp_shard_dir, f'{key}.npy'), np.concatenate(value, axis=0))
+        os.replace(tmp_shard_dir, cur_shard_dir)
+
+        self.num_shards += 1
+        self.num_agents += self.num_buffered
+        self.reset_buffer()
+
+    def close(self):
+        self.flush()
+
+
+def merge_context_shards(shard_dir, store_path, has_retrieval_window=True, chunk_size=65536):
+    """
+    Merge the shards of ContextShardWriter into the context store, the arrays are copied chunk by chunk (bounded memory)
+    An agent written several times (padding samples of the distributed sampler, on the same or on different ranks)
+    is only kept once by its (scenario_id, track_index), the first row in the order of the shards
+
+    Returns:
+        num_scenarios (int), num_agents (int)
+    """
+    shard_dirs = sorted([x for x in glob.glob(os.path.join(shard_dir, 'shard_*')) if not x.endswith('.tmp')])
+    assert len(shard_dirs) > 0, f'no context shards in {shard_dir}'
+    shards = [
+        {key: np.load(os.path.join(x, f'{key}.npy'), mmap_mode='r') for key in ['scenario_id', 'track_index'] + list(CONTEXT_KEYS.keys())}
+        for x in shard_dirs
+    ]
+    shard_offsets = np.cumsum([0] + [len(x['scenario_id']) for x in shards])
+
+    # the first row of each agent, sorted by scenario_id (stable, the agents of a scenario keep their order)
+    scenario_id, row_inverse = np.unique(np.concatenate([np.array(x['scenario_id']) for x in shards]), return_inverse=True)
+    row_track_index = np.concatenate([np.array(x['track_index'], dtype=np.int64) for x in shards])
+    _, first_rows = np.unique(np.stack((row_inverse, row_track_index), axis=-1), axis=0, return_index=True)
+    first_rows = np.sort(first_rows)
+    # global row (over the concatenated shards) of each agent in the store
+    src_rows = first_rows[np.argsort(row_inverse[first_rows], kind='stable')]
+    num_agents_each_scenario = np.bincount(row_inverse[src_rows], minlength=len(scenario_id))
+    offsets = np.concatenate(([0], np.cumsum(num_agents_each_scenario))).astype(np.int64)
+
+    tmp_store_path = store_path + '.tmp'
+    shutil.rmtree(tmp_store_path, ignore_errors=True)
+    os.makedirs(tmp_store_path)
+    np.save(os.path.join(tmp_store_path, 'scenario_id.npy'), scenario_id)
+    np.save(os.path.join(tmp_store_path, 'offsets.npy'), offsets)
+    for key in ['track_index'] + list(CONTEXT_KEYS.keys()):
+        shape = (len(src_rows),) + shards[0][key].shape[1:]
+        out_array = np.lib.format.open_memmap(os.path.join(tmp_store_path, f'{key}.npy'), mode='w+', dtype=shards[0][key].dtype, shape=shape)
+        for start_idx in range(0, len(src_rows), chunk_size):
+            cur_rows = src_rows[start_idx:start_idx + chunk_size]
+            shard_idxs = np.searchsorted(shard_offsets, cur_rows, side='right') - 1
+            for shard_idx in np.unique(shard_idxs):
+                mask = shard_idxs == shard_idx
+                out_array[start_idx:start_idx + chunk_size][mask] = shards[shard_idx][key][cur_rows[mask] - shard_offsets[shard_idx]]
+        out_array.flush()
+        del out_array
+    window_size = shards[0]['track_intentions'].shape[1]
+    save_context_store_meta(tmp_store_path, len(scenario_id), len(src_rows), int(window_size), has_retrieval_window)
+
+    shutil.rmtree(store_path, ignore_errors=True)
+    os.replace(tmp_store_path, store_path)
+    return len(scenario_id), len(src_rows)
+
+
+class ContextStore(object):
+    def __init__(self, store_path):
+        self.store_path = str(store_path)
+        with open(os.path.join(self.store_path, CONTEXT_STORE_META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        assert self.meta.get('encoding', None) == CONTEXT_STORE_ENCODING, \
+            f'{self.store_path} is a one-hot context store of an older version, delete it to convert the context again'
+        self.window_size = self.meta['window_size']
+        self.has_retrieval_window = self.meta['has_retrieval_window']
+
+        self.scenario_id = np.load(os.path.join(self.store_path, 'scenario_id.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(self.store_path, 'offsets.npy'))
+        self.track_index = np.load(os.path.join(self.store_path, 'track_index.npy'), mmap_mode='r')
+        self.context_arrays = {
+            key: np.load(os.path.join(self.store_path, f'{key}.npy'), mmap_mode='r') for key in CONTEXT_KEYS.keys()
+        }
+
+    def __len__(self):
+        return len(self.scenario_id)
+
+    def get_scenario_rows(self, scenario_id):
+        pos = np.searchsorted(self.scenario_id, scenario_id)
+        if pos >= len(self.scenario_id) or self.scenario_id[pos] != scenario_id:
+            raise KeyError(f'scenario {scenario_id} is not in the context store {self.store_path}')
+        return slice(self.offsets[pos], self.offsets[pos + 1])
+
+    def __contains__(self, scenario_id):
+        try:
+            self.get_scenario_rows(scenario_id)
+        except KeyError:
+            return False
+        return True
+
+    def get_context(self, scenario_id, window_size=None):
+        """
+        Args:
+            scenario_id (str):
+            window_size (int): the retrieval window to use, None for the context without retrieval window
+
+        Returns:
+            context (dict): track_indexes (num_agents), track_intentions (num_agents, window_size, 8) or (num_agents, 8),
+                track_affordances and track_scenarios in the same way, float32 as the output of format_context_infos
+        """
+        rows = self.get_scenario_rows(scenario_id)
+        context = {'track_indexes': np.array(self.track_index[rows])}
+        for key, context_type in CONTEXT_KEYS.items():
+            if window_size is None:
+                codes = self.context_arrays[key][rows, 0]
+            else:
+                codes = self.context_arrays[key][rows, :window_size]
+            context[key] = codes_to_one_hot(codes, context_type, dtype=np.float32)
+        return context
@@ -0,0 +1,160 @@
+# Batch samplers that group scenarios of similar sizes
+# collate_batch pads the agents and polylines of a batch to its largest member, so batching scenarios of similar
+# sizes saves the compute and memory wasted on padded tokens in the encoder
+
+
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Length-grouped batch sampler: the (shuffled) samples are split into mega-chunks of
+    `batch_size * num_replicas * bucket_size_multiplier` samples, each mega-chunk is sorted by the sample sizes
+    and cut into batches, and the order of batches is shuffled again.
+
+    All ranks build the same list of batches from `seed + epoch` (call `set_epoch` at the beginning of each epoch),
+    the list is padded to a multiple of num_replicas and each rank takes every num_replicas-th batch,
+    so every rank has the same number of batches.
+    """
+    def __init__(self, sample_sizes, batch_size, num_replicas=1, rank=0, shuffle=True, seed=0, drop_last=False,
+                 bucket_size_multiplier=50):
+        """
+        Args:
+            sample_sizes (num_samples): the sorting key of each sample, e.g. the number of agents
+            batch_size (int): number of scenarios of each batch
+        """
+        self.sample_sizes = np.asarray(sample_sizes)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.epoch = 0
+
+        self.batches = self.split_batches_for_current_rank(self.generate_global_batches())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.batches = self.split_batches_for_current_rank(self.generate_global_batches())
+
+    def get_generator(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        return generator
+
+    def get_sorted_chunks(self, generator):
+        num_samples = len(self.sample_sizes)
+        if self.shuffle:
+            indices = torch.randperm(num_samples, generator=generator).numpy()
+        else:
+            indices = np.arange(num_samples)
+
+        chunk_size = self.batch_size * self.num_replicas * self.bucket_size_multiplier
+        chunk_list = []
+        for k in range(0, num_samples, chunk_size):
+            chunk = indices[k:k + chunk_size]
+            chunk_list.append(chunk[np.argsort(-self.sample_sizes[chunk], kind='stable')])
+        return chunk_list
+
+    def generate_global_batches(self):
+        generator = self.get_generator()
+
+        batches = []
+        for chunk in self.get_sorted_chunks(generator):
+            for k in range(0, len(chunk), self.batch_size):
+                if self.drop_last and k + self.batch_size > len(chunk):
+                    continue
+                batches.append(chunk[k:k + self.batch_size].tolist())
+
+        if self.shuffle:
+            batches = [batches[k] for k in torch.randperm(len(batches), generator=generator).tolist()]
+        return batches
+
+    def split_batches_for_current_rank(self, batches):
+        if self.drop_last:
+            num_batches = len(batches) // self.num_replicas * self.num_replicas
+            batches = batches[:num_batches]
+        else:
+            num_batches = int(math.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+            batches = batches + batches[:num_batches - len(batches)]
+        return batches[self.rank:num_batches:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class CenterObjectBatchSampler(BucketBatchSampler):
+    """
+    Batch sampler that caps the total number of center objects of each batch instead of the number of scenarios,
+    since the memory of the decoder scales with the number of center objects.
+    The samples are grouped by sizes in the same way as BucketBatchSampler, and the batches are filled greedily
+    (a scenario with more center objects than the cap is a batch on its own).
+
+    The number of greedy batches depends on the permutation, so the batches of each epoch are padded (by repeating
+    its first batches) or truncated to the number of batches of epoch 0, and the length of the sampler (the iterations
+    of each epoch, the lr scheduler and the resumed iteration within an epoch) does not change with `set_epoch`.
+    """
+    def __init__(self, sample_sizes, num_center_objects, max_center_objects, num_replicas=1, rank=0, shuffle=True,
+                 seed=0, drop_last=False, max_scenarios=None, bucket_size_multiplier=50):
+        """
+        Args:
+            sample_sizes (num_samples): the sorting key of each sample, e.g. the number of agents
+            num_center_objects (num_samples): number of center objects of each sample
+            max_center_objects (int): max number of center objects of each batch
+            max_scenarios (int): optional max number of scenarios of each batch
+        """
+        self.num_center_objects = np.asarray(num_center_objects)
+        self.max_center_objects = max_center_objects
+        self.max_scenarios = max_scenarios
+        self.num_global_batches = None  # set by the batches of epoch 0
+
+        # the size of mega-chunks is measured by the average number of scenarios of each batch
+        avg_batch_size = max(1, int(max_center_objects // max(self.num_center_objects.mean(), 1)))
+        super().__init__(
+            sample_sizes=sample_sizes, batch_size=avg_batch_size, num_replicas=num_replicas, rank=rank, shuffle=shuffle,
+            seed=seed, drop_last=drop_last, bucket_size_multiplier=bucket_size_multiplier
+        )
+
+    def generate_global_batches(self):
+        generator = self.get_generator()
+
+        batches = []
+        for chunk in self.get_sorted_chunks(generator):
+            cur_batch, cur_num_center_objects = [], 0
+            for idx in chunk.tolist():
+                num_center_objects = self.num_center_objects[idx]
+                is_full = cur_num_center_objects + num_center_objects > self.max_center_objects or \
+                    (self.max_scenarios is not None and len(cur_batch) >= self.max_scenarios)
+                if len(cur_batch) > 0 and is_full:
+                    batches.append(cur_batch)
+                    cur_batch, cur_num_center_objects = [], 0
+                cur_batch.append(idx)
+                cur_num_center_objects += num_center_objects
+
+            if len(cur_batch) > 0:
+                batches.append(cur_batch)
+
+        if self.shuffle:
+            batches = [batches[k] for k in torch.randperm(len(batches), generator=generator).tolist()]
+
+        if self.num_global_batches is None:
+            # the first call is from __init__ with epoch 0
+            self.num_global_batches = len(batches)
+        elif len(batches) != self.num_global_batches:
+            batches = (batches * int(math.ceil(self.num_global_batches / len(batches))))[:self.num_global_batches]
+        return batches
+
+
+__all__ = {
+    'BucketBatchSampler': BucketBatchSampler,
+    'CenterObjectBatchSampler': CenterObjectBatchSampler,
+}
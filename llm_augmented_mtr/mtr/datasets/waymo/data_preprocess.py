@@ -5,6 +5,8 @@
 
 
 import sys, os
+import json
+import time
 import numpy as np
 import pickle
 import tensorflow as tf
@@ -13,24 +15,22 @@ import glob
 from tqdm import tqdm
 from waymo_open_dataset.protos import scenario_pb2
 from waymo_types import object_type, lane_type, road_line_type, road_edge_type, signal_state, polyline_type
+from scenario_store import pack_scenario_shard, write_packed_scenario_store_index
 
     
 def decode_tracks_from_proto(tracks):
     track_infos = {
-        'object_id': [],  # {0: unset, 1: vehicle, 2: pedestrian, 3: cyclist, 4: others}
-        'object_type': [],
-        'trajs': []
+        'object_id': [cur_data.id for cur_data in tracks],  # {0: unset, 1: vehicle, 2: pedestrian, 3: cyclist, 4: others}
+        'object_type': [object_type[cur_data.object_type] for cur_data in tracks],
     }
-    for cur_data in tracks:  # number of objects
-        cur_traj = [np.array([x.center_x, x.center_y, x.center_z, x.length, x.width, x.height, x.heading,
-                              x.velocity_x, x.velocity_y, x.valid], dtype=np.float32) for x in cur_data.states]
-        cur_traj = np.stack(cur_traj, axis=0)  # (num_timestamp, 10)
 
-        track_infos['object_id'].append(cur_data.id)
-        track_infos['object_type'].append(object_type[cur_data.object_type])
-        track_infos['trajs'].append(cur_traj)
-
-    track_infos['trajs'] = np.stack(track_infos['trajs'], axis=0)  # (num_objects, num_timestamp, 9)
+    # all states of all objects are gathered into one flat array, instead of one small array per state
+    num_objects, num_timestamps = len(tracks), len(tracks[0].states)
+    trajs = np.array([
+        (x.center_x, x.center_y, x.center_z, x.length, x.width, x.height, x.heading, x.velocity_x, x.velocity_y, x.valid)
+        for cur_data in tracks for x in cur_data.states
+    ], dtype=np.float32)
+    track_infos['trajs'] = trajs.reshape(num_objects, num_timestamps, 10)  # (num_objects, num_timestamp, 10)
     return track_infos
 
 
@@ -42,6 +42,21 @@ def get_polyline_dir(polyline):
     return polyline_dir
 
 
+def decode_polyline_from_points(points, global_type):
+    """
+    Args:
+        points: repeated MapPoint of the proto
+        global_type (int):
+
+    Returns:
+        polyline (num_points, 7): [x, y, z, dir_x, dir_y, dir_z, global_type]
+    """
+    polyline = np.array([(point.x, point.y, point.z) for point in points], dtype=np.float64).reshape(-1, 3)
+    polyline_dir = get_polyline_dir(polyline)
+    polyline_type = np.full((len(polyline), 1), global_type, dtype=np.float64)
+    return np.concatenate((polyline, polyline_dir, polyline_type), axis=-1)
+
+
 def decode_map_features_from_proto(map_features):
     map_infos = {
         'lane': [],
@@ -79,9 +94,7 @@ def decode_map_features_from_proto(map_features):
             ]
 
             global_type = polyline_type[cur_info['type']]
-            cur_polyline = np.stack([np.array([point.x, point.y, point.z, global_type]) for point in cur_data.lane.polyline], axis=0)
-            cur_polyline_dir = get_polyline_dir(cur_polyline[:, 0:3])
-            cur_polyline = np.concatenate((cur_polyline[:, 0:3], cur_polyline_dir, cur_polyline[:, 3:]), axis=-1)
+            cur_polyline = decode_polyline_from_points(cur_data.lane.polyline, global_type)
 
             map_infos['lane'].append(cur_info)
 
@@ -89,9 +102,7 @@ def decode_map_features_from_proto(map_features):
             cur_info['type'] = road_line_type[cur_data.road_line.type]
 
             global_type = polyline_type[cur_info['type']]
-            cur_polyline = np.stack([np.array([point.x, point.y, point.z, global_type]) for point in cur_data.road_line.polyline], axis=0)
-            cur_polyline_dir = get_polyline_dir(cur_polyline[:, 0:3])
-            cur_polyline = np.concatenate((cur_polyline[:, 0:3], cur_polyline_dir, cur_polyline[:, 3:]), axis=-1)
+            cur_polyline = decode_polyline_from_points(cur_data.road_line.polyline, global_type)
 
             map_infos['road_line'].append(cur_info)
 
@@ -99,9 +110,7 @@ def decode_map_features_from_proto(map_features):
             cur_info['type'] = road_edge_type[cur_data.road_edge.type]
 
             global_type = polyline_type[cur_info['type']]
-            cur_polyline = np.stack([np.array([point.x, point.y, point.z, global_type]) for point in cur_data.road_edge.polyline], axis=0)
-            cur_polyline_dir = get_polyline_dir(cur_polyline[:, 0:3])
-            cur_polyline = np.concatenate((cur_polyline[:, 0:3], cur_polyline_dir, cur_polyline[:, 3:]), axis=-1)
+            cur_polyline = decode_polyline_from_points(cur_data.road_edge.polyline, global_type)
 
             map_infos['road_edge'].append(cur_info)
 
@@ -116,17 +125,13 @@ def decode_map_features_from_proto(map_features):
             map_infos['stop_sign'].append(cur_info)
         elif cur_data.crosswalk.ByteSize() > 0:
             global_type = polyline_type['TYPE_CROSSWALK']
-            cur_polyline = np.stack([np.array([point.x, point.y, point.z, global_type]) for point in cur_data.crosswalk.polygon], axis=0)
-            cur_polyline_dir = get_polyline_dir(cur_polyline[:, 0:3])
-            cur_polyline = np.concatenate((cur_polyline[:, 0:3], cur_polyline_dir, cur_polyline[:, 3:]), axis=-1)
+            cur_polyline = decode_polyline_from_points(cur_data.crosswalk.polygon, global_type)
 
             map_infos['crosswalk'].append(cur_info)
 
         elif cur_data.speed_bump.ByteSize() > 0:
             global_type = polyline_type['TYPE_SPEED_BUMP']
-            cur_polyline = np.stack([np.array([point.x, point.y, point.z, global_type]) for point in cur_data.speed_bump.polygon], axis=0)
-            cur_polyline_dir = get_polyline_dir(cur_polyline[:, 0:3])
-            cur_polyline = np.concatenate((cur_polyline[:, 0:3], cur_polyline_dir, cur_polyline[:, 3:]), axis=-1)
+            cur_polyline = decode_polyline_from_points(cur_data.speed_bump.polygon, global_type)
 
             map_infos['speed_bump'].append(cur_info)
 
@@ -167,9 +172,13 @@ def decode_dynamic_map_states_from_proto(dynamic_map_states):
     return dynamic_map_infos
 
 
-def process_waymo_data_with_scenario_proto(data_file, output_path=None):
+def decode_scenarios_from_tfrecord(data_file):
+    """
+    Yields:
+        info (dict): the info of each scenario saved in the info file
+        save_infos (dict): the content of sample_{scenario_id}.pkl
+    """
     dataset = tf.data.TFRecordDataset(data_file, compression_type='')
-    ret_infos = []
     for cnt, data in enumerate(dataset):
         info = {}
         scenario = scenario_pb2.Scenario()
@@ -199,8 +208,13 @@ def process_waymo_data_with_scenario_proto(data_file, output_path=None):
             'map_infos': map_infos
         }
         save_infos.update(info)
+        yield info, save_infos
+
 
-        output_file = os.path.join(output_path, f'sample_{scenario.scenario_id}.pkl')
+def process_waymo_data_with_scenario_proto(data_file, output_path=None):
+    ret_infos = []
+    for info, save_infos in decode_scenarios_from_tfrecord(data_file):
+        output_file = os.path.join(output_path, f'sample_{info["scenario_id"]}.pkl')
         with open(output_file, 'wb') as f:
             pickle.dump(save_infos, f)
 
@@ -208,31 +222,117 @@ def process_waymo_data_with_scenario_proto(data_file, output_path=None):
     return ret_infos
 
 
-def get_infos_from_protos(data_path, output_path=None, num_workers=8):
-    from functools import partial
-    if output_path is not None:
-        os.makedirs(output_path, exist_ok=True)
+def get_shard_name(data_file):
+    return os.path.basename(data_file)
 
-    func = partial(
-        process_waymo_data_with_scenario_proto, output_path=output_path
-    )
+
+def process_tfrecord_shard(data_file, output_path, shard_info_path, packed_store_path=None):
+    """
+    Process one tfrecord file as a shard: the sample_{scenario_id}.pkl files (and optionally one shard of the packed store)
+    are written first, and the shard info file is written last (atomically), so a shard with an info file is complete
+
+    Returns:
+        shard_record (dict): the line of this shard in the manifest
+    """
+    start_time = time.time()
+    shard_name = get_shard_name(data_file)
+
+    ret_infos, scenario_infos = [], []
+    for info, save_infos in decode_scenarios_from_tfrecord(data_file):
+        output_file = os.path.join(output_path, f'sample_{info["scenario_id"]}.pkl')
+        with open(output_file, 'wb') as f:
+            pickle.dump(save_infos, f)
+
+        ret_infos.append(info)
+        if packed_store_path is not None:
+            scenario_infos.append(save_infos)
+
+    packed_shard_meta = None
+    if packed_store_path is not None and len(scenario_infos) > 0:
+        packed_shard_meta = pack_scenario_shard(scenario_infos, os.path.join(packed_store_path, f'{shard_name}.bin'))
+
+    shard_info_file = os.path.join(shard_info_path, f'{shard_name}.pkl')
+    with open(shard_info_file + '.tmp', 'wb') as f:
+        pickle.dump({'infos': ret_infos, 'packed_shard_meta': packed_shard_meta}, f)
+    os.replace(shard_info_file + '.tmp', shard_info_file)
+
+    shard_record = {
+        'shard': shard_name,
+        'num_scenarios': len(ret_infos),
+        'time_cost': time.time() - start_time
+    }
+    return shard_record
+
+
+def load_finished_shards(manifest_file, shard_info_path):
+    finished_shards = set()
+    if not os.path.exists(manifest_file):
+        return finished_shards
+
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            try:
+                shard_record = json.loads(line)
+            except json.JSONDecodeError:  # the last line may be truncated if the previous run was killed
+                continue
+            if os.path.exists(os.path.join(shard_info_path, f'{shard_record["shard"]}.pkl')):
+                finished_shards.add(shard_record['shard'])
+    return finished_shards
+
+
+def get_infos_from_protos(data_path, output_path=None, num_workers=8, pack_scenarios=False):
+    """
+    Each tfrecord file is processed as a shard in parallel, the finished shards are recorded in
+    {output_path}_shard_infos/manifest.jsonl as soon as they are done and skipped when the preprocessing is restarted.
+    With pack_scenarios, each tfrecord file is also packed into one shard of the packed store {output_path}_packed
+    """
+    from functools import partial
+    os.makedirs(output_path, exist_ok=True)
+    shard_info_path = output_path + '_shard_infos'
+    os.makedirs(shard_info_path, exist_ok=True)
+    manifest_file = os.path.join(shard_info_path, 'manifest.jsonl')
+    packed_store_path = output_path + '_packed' if pack_scenarios else None
+    if packed_store_path is not None:
+        os.makedirs(packed_store_path, exist_ok=True)
 
     src_files = glob.glob(os.path.join(data_path, '*.tfrecord*'))
     src_files.sort()
 
-    # func(src_files[0])
-    with multiprocessing.Pool(num_workers) as p:
-        data_infos = list(tqdm(p.imap(func, src_files), total=len(src_files)))
+    finished_shards = load_finished_shards(manifest_file, shard_info_path)
+    todo_files = [x for x in src_files if get_shard_name(x) not in finished_shards]
+    print(f'{len(src_files) - len(todo_files)} / {len(src_files)} shards of {data_path} are already processed')
 
-    all_infos = [item for infos in data_infos for item in infos]
+    func = partial(
+        process_tfrecord_shard, output_path=output_path, shard_info_path=shard_info_path, packed_store_path=packed_store_path
+    )
+    with multiprocessing.Pool(num_workers) as p, open(manifest_file, 'a') as manifest:
+        for shard_record in tqdm(p.imap_unordered(func, todo_files), total=len(todo_files)):
+            manifest.write(json.dumps(shard_record) + '\n')
+            manifest.flush()
+            tqdm.write(f'{shard_record["shard"]}: {shard_record["num_scenarios"]} scenarios in {shard_record["time_cost"]:.1f}s '
+                       f'({shard_record["num_scenarios"] / max(shard_record["time_cost"], 1e-6):.2f} scenarios/s)')
+
+    # assemble the infos in the sorted order of the tfrecord files
+    all_infos, packed_shard_meta_list = [], []
+    for data_file in src_files:
+        with open(os.path.join(shard_info_path, f'{get_shard_name(data_file)}.pkl'), 'rb') as f:
+            shard_infos = pickle.load(f)
+        assert packed_store_path is None or shard_infos['packed_shard_meta'] is not None or len(shard_infos['infos']) == 0, \
+            f'{get_shard_name(data_file)} was processed without --pack_scenarios, remove its shard info file to process it again'
+        all_infos.extend(shard_infos['infos'])
+        packed_shard_meta_list.append(shard_infos['packed_shard_meta'])
+
+    if packed_store_path is not None:
+        write_packed_scenario_store_index(packed_shard_meta_list, packed_store_path)
+        print(f'----------------Packed {len(all_infos)} scenarios at {packed_store_path}----------------')
     return all_infos
 
 
-def create_infos_from_protos(raw_data_path, output_path, num_workers=16):
+def create_infos_from_protos(raw_data_path, output_path, num_workers=16, pack_scenarios=False):
     train_infos = get_infos_from_protos(
         data_path=os.path.join(raw_data_path, 'training'),
         output_path=os.path.join(output_path, 'processed_scenarios_training'),
-        num_workers=num_workers
+        num_workers=num_workers, pack_scenarios=pack_scenarios
     )
     train_filename = os.path.join(output_path, 'processed_scenarios_training_infos.pkl')
     with open(train_filename, 'wb') as f:
@@ -242,16 +342,17 @@ def create_infos_from_protos(raw_data_path, output_path, num_workers=16):
     val_infos = get_infos_from_protos(
         data_path=os.path.join(raw_data_path, 'validation'),
         output_path=os.path.join(output_path, 'processed_scenarios_validation'),
-        num_workers=num_workers
+        num_workers=num_workers, pack_scenarios=pack_scenarios
     )
     val_filename = os.path.join(output_path, 'processed_scenarios_val_infos.pkl')
     with open(val_filename, 'wb') as f:
         pickle.dump(val_infos, f)
     print('----------------Waymo info val file is saved to %s----------------' % val_filename)
-    
+
 
 if __name__ == '__main__':
     create_infos_from_protos(
         raw_data_path=sys.argv[1],
-        output_path=sys.argv[2]
+        output_path=sys.argv[2],
+        pack_scenarios='--pack_scenarios' in sys.argv[3:]
     )
@@ -0,0 +1,165 @@
+# Binary index of the info file
+# The info file (list of dicts) is converted once into flat arrays (scenario ids, track offsets and the track_index,
+# object_type and difficulty of all tracks_to_predict), saved as .npy files next to the info file and loaded with mmap,
+# SAMPLE_INTERVAL and the info filters are applied on these arrays, and the info dicts are only built when indexed
+
+
+import os
+import json
+import pickle
+import shutil
+
+import numpy as np
+
+from mtr.datasets.waymo.scenario_store import OBJECT_TYPE_NAMES, OBJECT_TYPE_TO_CODE
+
+
+INFO_INDEX_META_FILE = 'meta.json'
+INFO_INDEX_COLUMNS = ['scenario_id', 'track_offsets', 'track_index', 'object_type', 'difficulty', 'sdc_track_index', 'current_time_index']
+
+
+def get_info_index_path(info_path):
+    return os.path.splitext(str(info_path))[0] + '_index'
+
+
+def get_info_source_stat(info_path):
+    """
+    Returns:
+        the size and mtime of the info file recorded in the meta of the index built from it, None if it does not exist
+    """
+    if not os.path.exists(info_path):
+        return None
+    stat = os.stat(info_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_info_index_up_to_date(index_path, info_path):
+    """
+    An index is outdated if the info file changed after it was built (e.g. data_preprocess.py re-run,
+    or llm_used_dataset_info.pkl rewritten by LLM_output/format_convert.py)
+    """
+    meta_file = os.path.join(index_path, INFO_INDEX_META_FILE)
+    if not os.path.exists(meta_file):
+        return False
+    source_stat = get_info_source_stat(info_path)
+    if source_stat is None:
+        return True
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    return meta.get('source', None) == source_stat
+
+
+def create_info_index(info_path, index_path=None):
+    """
+    Args:
+        info_path (str): the info file written by data_preprocess.py (or LLM_output/format_convert.py)
+        index_path (str): default is {info_path without .pkl}_index
+    """
+    if index_path is None:
+        index_path = get_info_index_path(info_path)
+
+    # taken before reading, an info file rewritten during the conversion is converted again next time
+    source = get_info_source_stat(info_path)
+    with open(info_path, 'rb') as f:
+        infos = pickle.load(f)
+
+    num_tracks = np.array([len(info['tracks_to_predict']['track_index']) for info in infos], dtype=np.int64)
+    columns = {
+        'scenario_id': np.array([info['scenario_id'] for info in infos]),
+        'track_offsets': np.concatenate(([0], num_tracks.cumsum())).astype(np.int64),
+        'track_index': np.array([x for info in infos for x in info['tracks_to_predict']['track_index']], dtype=np.int32),
+        'object_type': np.array([OBJECT_TYPE_TO_CODE[x] for info in infos for x in info['tracks_to_predict']['object_type']], dtype=np.int8),
+        'difficulty': np.array([x for info in infos for x in info['tracks_to_predict']['difficulty']], dtype=np.int8),
+        'sdc_track_index': np.array([info.get('sdc_track_index', -1) for info in infos], dtype=np.int32),
+        'current_time_index': np.array([info.get('current_time_index', -1) for info in infos], dtype=np.int32),
+    }
+
+    # write into a temporary dir first, the index only appears when it is complete
+    tmp_index_path = index_path + '.tmp'
+    shutil.rmtree(tmp_index_path, ignore_errors=True)
+    os.makedirs(tmp_index_path)
+    for key, value in columns.items():
+        np.save(os.path.join(tmp_index_path, f'{key}.npy'), value)
+    with open(os.path.join(tmp_index_path, INFO_INDEX_META_FILE), 'w') as f:
+        json.dump({
+            'object_type_names': OBJECT_TYPE_NAMES, 'num_scenarios': len(infos), 'num_tracks': int(num_tracks.sum()), 'source': source
+        }, f)
+
+    shutil.rmtree(index_path, ignore_errors=True)
+    os.replace(tmp_index_path, index_path)
+    return index_path
+
+
+class InfoIndex(object):
+    """
+    A list-like view of the info file: the selected scenarios and tracks are kept as index arrays over the columns,
+    and `info_index[k]` returns the same dict as the k-th info in WaymoDataset.get_all_infos (the keys used by the dataset)
+    """
+    def __init__(self, index_path, columns=None, scenario_rows=None, track_mask=None):
+        self.index_path = str(index_path)
+        if columns is None:
+            with open(os.path.join(self.index_path, INFO_INDEX_META_FILE), 'r') as f:
+                meta = json.load(f)
+            assert meta['object_type_names'] == OBJECT_TYPE_NAMES, f'{self.index_path} is built with other object types'
+            columns = {key: np.load(os.path.join(self.index_path, f'{key}.npy'), mmap_mode='r') for key in INFO_INDEX_COLUMNS}
+        self.columns = columns
+        self.object_type_names = np.array(OBJECT_TYPE_NAMES)
+
+        num_scenarios, num_tracks = len(columns['scenario_id']), len(columns['track_index'])
+        self.scenario_rows = np.arange(num_scenarios) if scenario_rows is None else scenario_rows
+        self.track_mask = np.ones(num_tracks, dtype=np.bool_) if track_mask is None else track_mask
+
+    def select(self, scenario_rows=None, track_mask=None):
+        return InfoIndex(
+            self.index_path, columns=self.columns,
+            scenario_rows=self.scenario_rows if scenario_rows is None else scenario_rows,
+            track_mask=self.track_mask if track_mask is None else track_mask
+        )
+
+    def apply_sample_interval(self, sample_interval):
+        return self.select(scenario_rows=self.scenario_rows[::sample_interval])
+
+    def get_num_tracks(self):
+        """
+        Returns:
+            num_tracks (num_selected_scenarios): number of the selected tracks_to_predict of each selected scenario
+        """
+        track_offsets = self.columns['track_offsets']
+        cumsum_mask = np.concatenate(([0], np.cumsum(self.track_mask)))
+        return cumsum_mask[track_offsets[self.scenario_rows + 1]] - cumsum_mask[track_offsets[self.scenario_rows]]
+
+    def filter_info_by_object_type(self, valid_object_types=None):
+        valid_codes = [OBJECT_TYPE_TO_CODE[x] for x in valid_object_types]
+        track_mask = self.track_mask & np.isin(self.columns['object_type'], valid_codes)
+        ret_index = self.select(track_mask=track_mask)
+        return ret_index.select(scenario_rows=ret_index.scenario_rows[ret_index.get_num_tracks() > 0])
+
+    def __len__(self):
+        return len(self.scenario_rows)
+
+    def get_info(self, idx):
+        row = self.scenario_rows[idx]
+        track_offsets = self.columns['track_offsets']
+        track_ids = np.arange(track_offsets[row], track_offsets[row + 1])
+        track_ids = track_ids[self.track_mask[track_ids]]
+
+        info = {
+            'scenario_id': str(self.columns['scenario_id'][row]),
+            'sdc_track_index': int(self.columns['sdc_track_index'][row]),
+            'current_time_index': int(self.columns['current_time_index'][row]),
+            'tracks_to_predict': {
+                'track_index': self.columns['track_index'][track_ids].tolist(),
+                'object_type': self.object_type_names[self.columns['object_type'][track_ids]].tolist(),
+                'difficulty': self.columns['difficulty'][track_ids].tolist()
+            }
+        }
+        return info
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.get_info(k) for k in range(len(self))[idx]]
+        return self.get_info(idx)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.get_info(k)
@@ -0,0 +1,121 @@
+# On-disk cache of the batched map polylines
+# generate_batch_polylines_from_map only depends on the scenario and the map config
+# (POINT_SAMPLED_INTERVAL, VECTOR_BREAK_DIST_THRESH, NUM_POINTS_EACH_POLYLINE),
+# so the batched polylines, masks and polyline centers are computed once offline and memory-mapped at runtime
+# (optionally together with the pickled KD-tree of the polyline centers for the top-k polyline selection)
+
+
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+from mtr.datasets.waymo.scenario_store import write_column_shard, write_store_index, ScenarioIndexedStore
+
+
+def get_map_polyline_cache_name(point_sampled_interval, vector_break_dist_thresh, num_points_each_polyline):
+    return f'i{point_sampled_interval}_d{vector_break_dist_thresh}_n{num_points_each_polyline}'
+
+
+def pack_map_polyline_shard(scenario_ids, batch_polylines_list, batch_polylines_mask_list, polyline_center_list, shard_file,
+                            polyline_kdtree_list=None):
+    """
+    Args:
+        scenario_ids (list of str):
+        batch_polylines_list (list of np.ndarray): (num_polylines, num_points_each_polyline, 7)
+        batch_polylines_mask_list (list of np.ndarray): (num_polylines, num_points_each_polyline)
+        polyline_center_list (list of np.ndarray): (num_polylines, 2)
+        shard_file (str):
+        polyline_kdtree_list (list of bytes): the pickled KD-tree of the polyline centers of each scenario
+
+    Returns:
+        shard_meta (dict):
+    """
+    num_polylines = np.array([len(x) for x in batch_polylines_list], dtype=np.int64)
+    polyline_start = np.concatenate(([0], num_polylines.cumsum()[:-1])).astype(np.int64)
+
+    columns = OrderedDict([
+        ('polylines', np.concatenate(batch_polylines_list, axis=0).astype(np.float32)),
+        ('polylines_mask', np.concatenate(batch_polylines_mask_list, axis=0).astype(np.bool_)),
+        ('polylines_center', np.concatenate(polyline_center_list, axis=0).astype(np.float32)),
+    ])
+    scenario_table = {
+        'scenario_id': np.array(scenario_ids),
+        'polyline_start': polyline_start,
+        'num_polylines': num_polylines
+    }
+
+    if polyline_kdtree_list is not None:
+        kdtree_nbytes = np.array([len(x) for x in polyline_kdtree_list], dtype=np.int64)
+        columns['polylines_kdtree'] = np.frombuffer(b''.join(polyline_kdtree_list), dtype=np.uint8)
+        scenario_table['kdtree_start'] = np.concatenate(([0], kdtree_nbytes.cumsum()[:-1])).astype(np.int64)
+        scenario_table['kdtree_nbytes'] = kdtree_nbytes
+
+    column_layout = write_column_shard(columns, shard_file)
+
+    shard_meta = {
+        'file': os.path.basename(shard_file),
+        'columns': column_layout,
+        'scenarios': scenario_table
+    }
+    return shard_meta
+
+
+def write_map_polyline_cache_index(shard_meta_list, cache_path, map_cfg):
+    write_store_index(shard_meta_list, cache_path, meta={'map_cfg': map_cfg})
+
+
+class MapPolylineCache(ScenarioIndexedStore):
+    def __init__(self, cache_path, map_cfg, max_open_shards=64, max_cached_kdtrees=256):
+        """
+        Args:
+            cache_path (str):
+            map_cfg (dict): the values of POINT_SAMPLED_INTERVAL, VECTOR_BREAK_DIST_THRESH and NUM_POINTS_EACH_POLYLINE
+            max_cached_kdtrees (int): number of unpickled KD-trees kept in each dataloader worker
+        """
+        super().__init__(store_path=cache_path, max_open_shards=max_open_shards)
+        self.max_cached_kdtrees = max_cached_kdtrees
+        self._kdtree_cache = OrderedDict()
+        assert self.index['map_cfg'] == map_cfg, \
+            f'the map polyline cache {cache_path} is built with {self.index["map_cfg"]}, but {map_cfg} is required'
+
+    def load_polylines(self, scenario_id):
+        """
+        Returns:
+            map_infos (dict):
+                batch_polylines (num_polylines, num_points_each_polyline, 7):
+                batch_polylines_mask (num_polylines, num_points_each_polyline): int32 as the output of generate_batch_polylines_from_map
+                polyline_center (num_polylines, 2):
+                polyline_kdtree (scipy.spatial.cKDTree): only if the KD-trees are cached
+        """
+        row = self.get_scenario_row(scenario_id)
+        index = self.index
+        columns = self.get_shard_columns(index['shard_idx'][row])
+        polyline_slice = slice(index['polyline_start'][row], index['polyline_start'][row] + index['num_polylines'][row])
+
+        batch_polylines = columns['polylines'][polyline_slice]
+        batch_polylines_mask = columns['polylines_mask'][polyline_slice].astype(np.int32)
+        polyline_center = np.array(columns['polylines_center'][polyline_slice])
+
+        map_infos = {
+            'batch_polylines': batch_polylines,
+            'batch_polylines_mask': batch_polylines_mask,
+            'polyline_center': polyline_center
+        }
+        if 'polylines_kdtree' in columns:
+            map_infos['polyline_kdtree'] = self.get_polyline_kdtree(row, columns)
+        return map_infos
+
+    def get_polyline_kdtree(self, row, columns):
+        if row in self._kdtree_cache:
+            self._kdtree_cache.move_to_end(row)
+            return self._kdtree_cache[row]
+
+        kdtree_start, kdtree_nbytes = self.index['kdtree_start'][row], self.index['kdtree_nbytes'][row]
+        polyline_kdtree = pickle.loads(columns['polylines_kdtree'][kdtree_start:kdtree_start + kdtree_nbytes].tobytes())
+
+        self._kdtree_cache[row] = polyline_kdtree
+        if len(self._kdtree_cache) > self.max_cached_kdtrees:
+            self._kdtree_cache.popitem(last=False)
+        return polyline_kdtree
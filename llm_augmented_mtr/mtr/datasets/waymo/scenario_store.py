@@ -0,0 +1,297 @@
+# Packed scenario store for the processed Waymo scenarios
+# Every shard is one binary file holding the columns of many scenarios back to back,
+# a global index maps scenario_id => (shard, row offsets), and the dataset reads
+# trajectories and map polylines through np.memmap views instead of unpickling sample_xxx.pkl
+
+
+import os
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    from waymo_types import object_type  # executed as a script from this directory (data_preprocess.py)
+except ImportError:
+    from mtr.datasets.waymo.waymo_types import object_type
+
+
+OBJECT_TYPE_NAMES = [object_type[k] for k in sorted(object_type.keys())]
+OBJECT_TYPE_TO_CODE = {name: code for code, name in enumerate(OBJECT_TYPE_NAMES)}
+
+STORE_INDEX_FILE = 'scenario_index.pkl'
+COLUMN_ALIGNMENT = 64
+
+
+def write_column_shard(columns, shard_file):
+    """
+    Write the given arrays back to back (aligned) into one binary file
+
+    Args:
+        columns (OrderedDict): name => np.ndarray
+        shard_file (str):
+
+    Returns:
+        column_layout (dict): name => (byte offset, dtype str, shape)
+    """
+    column_layout = {}
+    offset = 0
+    with open(shard_file, 'wb') as f:
+        for name, value in columns.items():
+            value = np.ascontiguousarray(value)
+            padding = (-offset) % COLUMN_ALIGNMENT
+            f.write(b'\0' * padding)
+            offset += padding
+            column_layout[name] = (offset, value.dtype.str, value.shape)
+            f.write(value.tobytes())
+            offset += value.nbytes
+    return column_layout
+
+
+def map_column_shard(shard_file, column_layout):
+    """
+    Returns the read-only np.memmap views of all columns in a shard written by write_column_shard
+    """
+    buffer = np.memmap(shard_file, dtype=np.uint8, mode='r')
+    columns = {}
+    for name, (offset, dtype, shape) in column_layout.items():
+        dtype = np.dtype(dtype)
+        columns[name] = np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    return columns
+
+
+def pack_scenario_shard(scenario_infos, shard_file):
+    """
+    Args:
+        scenario_infos (list of dict): the content of sample_{scenario_id}.pkl written by data_preprocess.py
+        shard_file (str): path of the binary shard file to write
+
+    Returns:
+        shard_meta (dict): column layout of the shard and the per-scenario row table
+    """
+    num_scenarios = len(scenario_infos)
+    num_timestamps = scenario_infos[0]['track_infos']['trajs'].shape[1]
+
+    scenario_table = {
+        'scenario_id': [], 'obj_start': [], 'num_objects': [], 'point_start': [], 'num_points': [],
+        'track_start': [], 'num_tracks': [], 'sdc_track_index': [], 'current_time_index': []
+    }
+    trajs, object_ids, object_types, polylines, tracks_to_predict = [], [], [], [], []
+    timestamps = np.zeros((num_scenarios, num_timestamps), dtype=np.float64)
+
+    obj_cnt = point_cnt = track_cnt = 0
+    for k, info in enumerate(scenario_infos):
+        track_infos = info['track_infos']
+        cur_trajs = track_infos['trajs'].astype(np.float32)
+        assert cur_trajs.shape[1] == num_timestamps, f'scenario {info["scenario_id"]} has {cur_trajs.shape[1]} timestamps, but {num_timestamps} is expected'
+        cur_polylines = info['map_infos']['all_polylines'].astype(np.float32).reshape(-1, 7)
+        cur_tracks = np.array(info['tracks_to_predict']['track_index'], dtype=np.int32)
+
+        trajs.append(cur_trajs)
+        object_ids.append(np.array(track_infos['object_id'], dtype=np.int64))
+        object_types.append(np.array([OBJECT_TYPE_TO_CODE[x] for x in track_infos['object_type']], dtype=np.int8))
+        polylines.append(cur_polylines)
+        tracks_to_predict.append(cur_tracks)
+        timestamps[k, :len(info['timestamps_seconds'])] = info['timestamps_seconds']
+
+        scenario_table['scenario_id'].append(info['scenario_id'])
+        scenario_table['obj_start'].append(obj_cnt)
+        scenario_table['num_objects'].append(len(cur_trajs))
+        scenario_table['point_start'].append(point_cnt)
+        scenario_table['num_points'].append(len(cur_polylines))
+        scenario_table['track_start'].append(track_cnt)
+        scenario_table['num_tracks'].append(len(cur_tracks))
+        scenario_table['sdc_track_index'].append(info['sdc_track_index'])
+        scenario_table['current_time_index'].append(info['current_time_index'])
+        obj_cnt += len(cur_trajs)
+        point_cnt += len(cur_polylines)
+        track_cnt += len(cur_tracks)
+
+    columns = OrderedDict([
+        ('trajs', np.concatenate(trajs, axis=0)),  # (num_objects_in_shard, num_timestamps, 10)
+        ('object_id', np.concatenate(object_ids, axis=0)),
+        ('object_type', np.concatenate(object_types, axis=0)),
+        ('polylines', np.concatenate(polylines, axis=0)),  # (num_points_in_shard, 7)
+        ('tracks_to_predict', np.concatenate(tracks_to_predict, axis=0)),
+        ('timestamps', timestamps),
+    ])
+
+    column_layout = write_column_shard(columns, shard_file)
+
+    for key in scenario_table.keys():
+        scenario_table[key] = np.array(scenario_table[key]) if key == 'scenario_id' else np.array(scenario_table[key], dtype=np.int64)
+
+    shard_meta = {
+        'file': os.path.basename(shard_file),
+        'num_timestamps': num_timestamps,
+        'columns': column_layout,
+        'scenarios': scenario_table
+    }
+    return shard_meta
+
+
+def write_store_index(shard_meta_list, store_path, meta=None):
+    """
+    Merge the row tables of all shards into the global scenario index of the store
+
+    Args:
+        shard_meta_list (list of dict): file, columns and the per-scenario row table of each shard
+        store_path (str):
+        meta (dict): extra store-level information saved in the index
+    """
+    shard_meta_list = [x for x in shard_meta_list if x is not None]
+
+    index = {
+        'shards': [{'file': x['file'], 'columns': x['columns']} for x in shard_meta_list],
+    }
+    if meta is not None:
+        index.update(meta)
+    for key in shard_meta_list[0]['scenarios'].keys():
+        index[key] = np.concatenate([x['scenarios'][key] for x in shard_meta_list], axis=0)
+    index['shard_idx'] = np.concatenate([
+        np.full(len(x['scenarios']['scenario_id']), shard_idx, dtype=np.int32) for shard_idx, x in enumerate(shard_meta_list)
+    ], axis=0)
+    index['row_in_shard'] = np.concatenate([np.arange(len(x['scenarios']['scenario_id'])) for x in shard_meta_list], axis=0)
+    index['sort_idx'] = np.argsort(index['scenario_id'], kind='stable')
+
+    with open(os.path.join(store_path, STORE_INDEX_FILE), 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return index
+
+
+def write_packed_scenario_store_index(shard_meta_list, store_path):
+    shard_meta_list = [x for x in shard_meta_list if x is not None]
+    assert len(set([x['num_timestamps'] for x in shard_meta_list])) == 1, 'all shards should have the same number of timestamps'
+    write_store_index(shard_meta_list, store_path, meta={
+        'object_type_names': OBJECT_TYPE_NAMES,
+        'num_timestamps': shard_meta_list[0]['num_timestamps']
+    })
+
+
+def create_packed_scenario_store(data_path, info_path, store_path, scenarios_per_shard=1000):
+    """
+    Pack the existing sample_{scenario_id}.pkl files of one split into a sharded binary store
+
+    Args:
+        data_path (str): the dir of sample_{scenario_id}.pkl, e.g. mtr_processed/processed_scenarios_training
+        info_path (str): the info file of this split, only used to get the scenario ids (in order)
+        store_path (str): output dir of the packed store
+        scenarios_per_shard (int): number of scenarios in each shard
+    """
+    os.makedirs(store_path, exist_ok=True)
+    with open(info_path, 'rb') as f:
+        infos = pickle.load(f)
+    scenario_id_list = [info['scenario_id'] for info in infos]
+
+    shard_meta_list = []
+    for shard_idx, start_idx in enumerate(tqdm(range(0, len(scenario_id_list), scenarios_per_shard), desc='pack scenarios')):
+        scenario_infos = []
+        for scenario_id in scenario_id_list[start_idx:start_idx + scenarios_per_shard]:
+            with open(os.path.join(data_path, f'sample_{scenario_id}.pkl'), 'rb') as f:
+                scenario_infos.append(pickle.load(f))
+        shard_file = os.path.join(store_path, f'shard_{shard_idx:05d}.bin')
+        shard_meta_list.append(pack_scenario_shard(scenario_infos, shard_file))
+
+    write_packed_scenario_store_index(shard_meta_list, store_path)
+    print(f'----------------Packed {len(scenario_id_list)} scenarios into {len(shard_meta_list)} shards at {store_path}----------------')
+
+
+class ScenarioIndexedStore(object):
+    """
+    Base reader of the sharded binary stores, the index maps each scenario_id to its shard and row offsets
+    """
+    def __init__(self, store_path, max_open_shards=64):
+        self.store_path = str(store_path)
+        with open(os.path.join(self.store_path, STORE_INDEX_FILE), 'rb') as f:
+            self.index = pickle.load(f)
+        self.sorted_scenario_id = self.index['scenario_id'][self.index['sort_idx']]
+
+        # shards are mapped lazily in each dataloader worker and only a bounded number of them
+        # is kept open, so the number of file descriptors does not grow with the number of shards
+        self.max_open_shards = max_open_shards
+        self._open_shards = OrderedDict()
+
+    def __len__(self):
+        return len(self.index['scenario_id'])
+
+    def get_scenario_row(self, scenario_id):
+        pos = np.searchsorted(self.sorted_scenario_id, scenario_id)
+        if pos >= len(self.sorted_scenario_id) or self.sorted_scenario_id[pos] != scenario_id:
+            raise KeyError(f'scenario {scenario_id} is not in the store {self.store_path}')
+        return self.index['sort_idx'][pos]
+
+    def __contains__(self, scenario_id):
+        try:
+            self.get_scenario_row(scenario_id)
+        except KeyError:
+            return False
+        return True
+
+    def get_shard_columns(self, shard_idx):
+        if shard_idx in self._open_shards:
+            self._open_shards.move_to_end(shard_idx)
+            return self._open_shards[shard_idx]
+
+        shard = self.index['shards'][shard_idx]
+        columns = map_column_shard(os.path.join(self.store_path, shard['file']), shard['columns'])
+
+        self._open_shards[shard_idx] = columns
+        if len(self._open_shards) > self.max_open_shards:
+            self._open_shards.popitem(last=False)
+        return columns
+
+
+class PackedScenarioStore(ScenarioIndexedStore):
+    def __init__(self, store_path, max_open_shards=64):
+        super().__init__(store_path=store_path, max_open_shards=max_open_shards)
+        self.object_type_names = np.array(self.index['object_type_names'])
+
+    def load_scenario(self, scenario_id):
+        """
+        Returns a dict with the same layout as sample_{scenario_id}.pkl (only the keys used by WaymoDataset),
+        all_polylines is a read-only view of the memory-mapped shard
+        """
+        row = self.get_scenario_row(scenario_id)
+        index = self.index
+        columns = self.get_shard_columns(index['shard_idx'][row])
+
+        obj_slice = slice(index['obj_start'][row], index['obj_start'][row] + index['num_objects'][row])
+        point_slice = slice(index['point_start'][row], index['point_start'][row] + index['num_points'][row])
+        track_slice = slice(index['track_start'][row], index['track_start'][row] + index['num_tracks'][row])
+
+        info = {
+            'scenario_id': scenario_id,
+            'timestamps_seconds': columns['timestamps'][index['row_in_shard'][row]],
+            'current_time_index': int(index['current_time_index'][row]),
+            'sdc_track_index': int(index['sdc_track_index'][row]),
+            'tracks_to_predict': {
+                'track_index': columns['tracks_to_predict'][track_slice].tolist()
+            },
+            'track_infos': {
+                'object_id': columns['object_id'][obj_slice],
+                'object_type': self.object_type_names[columns['object_type'][obj_slice]],
+                # trajs are copied out of the page cache once, as torch cannot wrap read-only buffers
+                'trajs': np.array(columns['trajs'][obj_slice]),
+            },
+            'map_infos': {
+                'all_polylines': columns['polylines'][point_slice]
+            }
+        }
+        return info
+
+
+if __name__ == '__main__':
+    import sys
+
+    # python scenario_store.py <mtr_processed_dir> [scenarios_per_shard]
+    processed_path = sys.argv[1]
+    scenarios_per_shard = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    for split_dir, info_file in [('processed_scenarios_training', 'processed_scenarios_training_infos.pkl'),
+                                 ('processed_scenarios_validation', 'processed_scenarios_val_infos.pkl')]:
+        create_packed_scenario_store(
+            data_path=os.path.join(processed_path, split_dir),
+            info_path=os.path.join(processed_path, info_file),
+            store_path=os.path.join(processed_path, f'{split_dir}_packed'),
+            scenarios_per_shard=scenarios_per_shard
+        )
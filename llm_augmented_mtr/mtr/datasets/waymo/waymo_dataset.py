@@ -12,7 +12,15 @@ import torch
 from tqdm import tqdm
 
 from mtr.datasets.dataset import DatasetTemplate
-from mtr.datasets.llm_context.context_types import context_types_dict
+from mtr.datasets.waymo.scenario_store import PackedScenarioStore
+from mtr.datasets.waymo.info_index import InfoIndex, create_info_index, get_info_index_path, is_info_index_up_to_date
+from mtr.datasets.waymo.map_polyline_cache import (
+    MapPolylineCache, get_map_polyline_cache_name, pack_map_polyline_shard, write_map_polyline_cache_index
+)
+from mtr.datasets.llm_context.context_codec import encode_one_hot
+from mtr.datasets.llm_context.context_store import (
+    CONTEXT_KEYS, ContextStore, create_context_store, get_context_store_path, is_context_store_up_to_date
+)
 from mtr.utils import common_utils
 from mtr.config import cfg
 
@@ -23,13 +31,26 @@ class WaymoDataset(DatasetTemplate):
         self.data_root = cfg.ROOT_DIR / self.dataset_cfg.DATA_ROOT
         self.data_path = self.data_root / self.dataset_cfg.SPLIT_DIR[self.mode]
 
+        self.scenario_store = None
+        if self.dataset_cfg.get('USE_PACKED_SCENARIO_STORE', False):
+            # the packed store is created by data_preprocess.py (or scenario_store.py) in {SPLIT_DIR}_packed by default
+            packed_split_dir = self.dataset_cfg.get('PACKED_SPLIT_DIR', {}).get(self.mode, f'{self.dataset_cfg.SPLIT_DIR[self.mode]}_packed')
+            self.scenario_store = PackedScenarioStore(self.data_root / packed_split_dir)
+            self.logger.info(f'Load scenarios from packed store {self.data_root / packed_split_dir} ({len(self.scenario_store)} scenarios)')
+
+        self.map_polyline_cache = None
+        if self.dataset_cfg.get('USE_MAP_POLYLINE_CACHE', False) and not self.dataset_cfg.get('WITHOUT_HDMAP', False):
+            # built offline by `python waymo_dataset.py --cfg_file xxx --func create_map_polyline_cache`
+            self.map_polyline_cache = MapPolylineCache(self.get_map_polyline_cache_path(), map_cfg=self.get_map_polyline_cfg())
+            self.logger.info(f'Load batched map polylines from cache {self.get_map_polyline_cache_path()}')
+
         self.infos = self.get_all_infos(self.data_root / self.dataset_cfg.INFO_FILE[self.mode])
         self.logger.info(f'Total scenes after filters: {len(self.infos)}')
         
+        self.context_store = None
         if self.dataset_cfg.LOAD_CONTEXT_DATA:
             if self.dataset_cfg.GENERATE_EMBEDDING:
-                self.context_infos = self.get_context_infos(self.dataset_cfg.LLM_OUTPUT_CONTEXT_PATH)
-                self.format_context_infos(has_retrieval_window=False)
+                context_path = self.dataset_cfg.LLM_OUTPUT_CONTEXT_PATH
             else:
                 # here, we need to choose which context data we need, train, valid, or test?
                 # dir_root is project dir
@@ -39,13 +60,23 @@ class WaymoDataset(DatasetTemplate):
                 root_dir = "/".join(cur_dir.split("/")[:-3])
                 context_dir = os.path.join(root_dir, "LLM_integrate", "context_data")
                 if training:
-                    self.context_infos = self.get_context_infos(os.path.join(context_dir, "train", f"context_data_encoder_{dataset_cfg.ENCODER_FOR_CONTEXT}.pkl"))
+                    context_path = os.path.join(context_dir, "train", f"context_data_encoder_{dataset_cfg.ENCODER_FOR_CONTEXT}.pkl")
                 else: 
-                    self.context_infos = self.get_context_infos(os.path.join(context_dir, dataset_type, f"context_data_encoder_{dataset_cfg.ENCODER_FOR_CONTEXT}.pkl"))
-                
+                    context_path = os.path.join(context_dir, dataset_type, f"context_data_encoder_{dataset_cfg.ENCODER_FOR_CONTEXT}.pkl")
+
+            if self.dataset_cfg.get('USE_CONTEXT_MMAP_STORE', False):
+                self.context_store = self.get_context_store(context_path)
+            elif self.dataset_cfg.GENERATE_EMBEDDING:
+                self.context_infos = self.get_context_infos(context_path)
+                self.format_context_infos(has_retrieval_window=False)
+            else:
+                self.context_infos = self.get_context_infos(context_path)
                 self.format_context_infos(has_retrieval_window=True, retrieval_window_size=self.dataset_cfg.RETRIEVAL_WINDOW_SIZE)
 
     def get_all_infos(self, info_path):
+        if self.dataset_cfg.get('USE_INFO_INDEX', False):
+            return self.get_all_infos_from_index(info_path)
+
         self.logger.info(f'Start to load infos from {info_path}')
         with open(info_path, 'rb') as f:
             src_infos = pickle.load(f)
@@ -58,6 +89,27 @@ class WaymoDataset(DatasetTemplate):
 
         return infos
     
+    def get_all_infos_from_index(self, info_path):
+        """
+        Same as get_all_infos, but the infos are loaded from the binary index of the info file (built on rank 0 if not exist)
+        and filtered by the vectorized filters of InfoIndex, the index is rebuilt if the info file changed since it was built
+        """
+        index_path = get_info_index_path(info_path)
+        common_utils.ensure_file_built_on_rank0(
+            index_path, lambda: create_info_index(info_path, index_path),
+            is_up_to_date_func=lambda: is_info_index_up_to_date(index_path, info_path)
+        )
+        self.logger.info(f'Start to load infos from {index_path}')
+
+        infos = InfoIndex(index_path).apply_sample_interval(self.dataset_cfg.SAMPLE_INTERVAL[self.mode])
+        self.logger.info(f'Total scenes before filters: {len(infos)}')
+
+        for func_name, val in self.dataset_cfg.INFO_FILTER_DICT.items():
+            infos = getattr(infos, func_name)(val)
+            self.logger.info(f'Total scenes after {func_name}: {len(infos)}')
+
+        return infos
+
     def get_context_infos(self, context_path):
         self.logger.info(f'Start to load context from {context_path}')
         with open(context_path, 'rb') as context_file:
@@ -65,79 +117,71 @@ class WaymoDataset(DatasetTemplate):
         self.logger.info(f'Total scenes in context info file: {len(list(context_infos.keys()))}')
         return context_infos
     
-    def weighted_one_hot_encode(self, data, context_type):
-        encode_dict = context_types_dict[context_type]
-        encoded_data = [0 for _, _ in enumerate(encode_dict)]
-        for index, value in enumerate(data):
-            # The closer the element near to the first element, the bigger their weight will be.
-            encoded_data[encode_dict[value]] = len(data) - index
-        return encoded_data
-
-    def one_hot_encode(self, data, context_type):
-        encode_dict = context_types_dict[context_type]
-        encoded_data = [0 for _, _ in enumerate(encode_dict)]
-        for _, value in enumerate(data):
-            # all elements holds the same weight
-            encoded_data[encode_dict[value]] = 1
-        return encoded_data
-        
+    def get_context_store(self, context_path):
+        """
+        Load the columnar context store converted from the context pickle, it is converted (on rank 0) if it does not exist
+        or the pickle changed since the conversion (size / mtime recorded in the meta of the store)
+        """
+        store_path = get_context_store_path(context_path)
+        common_utils.ensure_file_built_on_rank0(
+            store_path, lambda: create_context_store(context_path, store_path),
+            is_up_to_date_func=lambda: is_context_store_up_to_date(store_path, context_path)
+        )
+        context_store = ContextStore(store_path)
+        self.logger.info(f'Load context from {store_path} ({len(context_store)} scenes, window size {context_store.window_size})')
+
+        if self.dataset_cfg.GENERATE_EMBEDDING:
+            assert not context_store.has_retrieval_window, "retrieval window size is not 1, but only provide 1"
+        else:
+            assert context_store.has_retrieval_window, f"retrieval window size is 1, but provide {self.dataset_cfg.RETRIEVAL_WINDOW_SIZE}"
+            assert context_store.window_size >= self.dataset_cfg.RETRIEVAL_WINDOW_SIZE, \
+                f"provided max retrieval window size is {context_store.window_size}, but set {self.dataset_cfg.RETRIEVAL_WINDOW_SIZE}"
+        return context_store
+
+    def get_scene_context(self, scene_id):
+        if self.context_store is not None:
+            window_size = None if self.dataset_cfg.GENERATE_EMBEDDING else self.dataset_cfg.RETRIEVAL_WINDOW_SIZE
+            return self.context_store.get_context(scene_id, window_size=window_size)
+        return self.context_infos[scene_id]
+
     def format_context_infos(self, has_retrieval_window=False, retrieval_window_size=1):
         """
         As the context_info are not structured (different ego car has context infos with different length)
         Here unify the context info into "length equal" format
         More specifically, we use one hot encode to format these context data
+        The labels of all scenarios are encoded at once (see context_codec.py), the one-hot arrays of the scenarios are views of one array
         """
+        check_assistant = list(self.context_infos.values())[0]
         if not has_retrieval_window:
-            check_assistant = list(self.context_infos.values())[0]
             assert type(check_assistant['track_intentions'][0][0]) == str, "retrieval window size is not 1, but only provide 1"
-            for scenario_id, context_data in self.context_infos.items(): # type: ignore
-                track_intentions_formatted = []
-                track_affordances_formatted = []
-                track_scenarios_formatted = []
-                for track_number, _ in enumerate(context_data['track_indexes']):
-                    track_intentions_formatted.append(self.weighted_one_hot_encode(context_data['track_intentions'][track_number], "intention"))
-                    track_affordances_formatted.append(self.one_hot_encode(context_data['track_affordances'][track_number], "affordance"))
-                    track_scenarios_formatted.append(self.one_hot_encode(context_data['track_scenarios'][track_number], "scenario"))
-                self.context_infos[scenario_id]['track_intentions'] = np.array(track_intentions_formatted, dtype=np.float32) # type: ignore
-                self.context_infos[scenario_id]['track_affordances'] = np.array(track_affordances_formatted, dtype=np.float32) # type: ignore
-                self.context_infos[scenario_id]['track_scenarios'] = np.array(track_scenarios_formatted, dtype=np.float32) # type: ignore
         else:
-            check_assistant = list(self.context_infos.values())[0]
             assert type(check_assistant['track_intentions'][0][0]) == list, f"retrieval window size is 1, but provide {retrieval_window_size}"
             assert len(check_assistant['track_intentions'][0]) >= retrieval_window_size, f"provided max retrieval window size is {len(check_assistant['track_intentions'][0])}, but set {retrieval_window_size}"
-            
-            rank = int(os.environ["LOCAL_RANK"])
-            if rank == 0:
-                total_data = len(self.context_infos)
-                processed_bar = tqdm(total=total_data)
-            
-            for scenario_id, context_data in self.context_infos.items(): # type: ignore
-                # this for loop process scenario level
-                track_intentions_formatted = []
-                track_affordances_formatted = []
-                track_scenarios_formatted = []
-                for track_number, _ in enumerate(context_data['track_indexes']):
-                    # this for loop process agent level
-                    track_intentions_formatted_agent = []
-                    track_affordances_formatted_agent = []
-                    track_scenarios_formatted_agent = []
-                    for context_data_index in range(retrieval_window_size):
-                        # this for loop process context data of one single agent
-                        track_intentions_formatted_agent.append(self.weighted_one_hot_encode(context_data['track_intentions'][track_number][context_data_index], "intention"))
-                        track_affordances_formatted_agent.append(self.one_hot_encode(context_data['track_affordances'][track_number][context_data_index], "affordance"))
-                        track_scenarios_formatted_agent.append(self.one_hot_encode(context_data['track_scenarios'][track_number][context_data_index], "scenario"))
-                    track_intentions_formatted.append(track_intentions_formatted_agent)
-                    track_affordances_formatted.append(track_affordances_formatted_agent)
-                    track_scenarios_formatted.append(track_scenarios_formatted_agent)
-                # shape (#agent, #window_size, [8|4|5])
-                self.context_infos[scenario_id]['track_intentions'] = np.array(track_intentions_formatted, dtype=np.float32) # type: ignore
-                self.context_infos[scenario_id]['track_affordances'] = np.array(track_affordances_formatted, dtype=np.float32) # type: ignore
-                self.context_infos[scenario_id]['track_scenarios'] = np.array(track_scenarios_formatted, dtype=np.float32) # type: ignore
-                
-                if rank == 0:
-                    processed_bar.update(1)
-            if rank == 0:
-                processed_bar.close()
+        window_size = retrieval_window_size if has_retrieval_window else 1
+
+        scenario_ids = list(self.context_infos.keys())
+        num_agents_each_scenario = []
+        label_lists = {key: [] for key in CONTEXT_KEYS.keys()}
+        for scenario_id in scenario_ids:
+            context_data = self.context_infos[scenario_id]
+            num_agents_each_scenario.append(len(context_data['track_indexes']))
+            for key in CONTEXT_KEYS.keys():
+                if has_retrieval_window:
+                    for agent_context in context_data[key]:
+                        assert len(agent_context) >= window_size, f'{scenario_id} has a retrieval window smaller than {window_size}'
+                        label_lists[key].extend(agent_context[:window_size])
+                else:
+                    label_lists[key].extend(context_data[key])
+
+        split_idxs = np.cumsum(num_agents_each_scenario)[:-1]
+        for key, context_type in CONTEXT_KEYS.items():
+            # shape (#agent_total, #window_size, [8|4|5]), or (#agent_total, [8|4|5]) without retrieval window
+            one_hot = encode_one_hot(label_lists[key], context_type, dtype=np.float32)
+            one_hot = one_hot.reshape(sum(num_agents_each_scenario), window_size, -1)
+            if not has_retrieval_window:
+                one_hot = one_hot[:, 0]
+            for scenario_id, scenario_one_hot in zip(scenario_ids, np.split(one_hot, split_idxs)):
+                self.context_infos[scenario_id][key] = scenario_one_hot # type: ignore
 
     def filter_info_by_object_type(self, infos, valid_object_types=None):
         ret_infos = []
@@ -166,6 +210,78 @@ class WaymoDataset(DatasetTemplate):
     def __len__(self):
         return len(self.infos)
 
+    def get_sample_sizes(self):
+        """
+        The sizes of each scenario for the size-bucketed batch samplers
+
+        Returns:
+            num_center_objects (num_samples):
+            num_objects (num_samples): the number of agents, only available with the packed scenario store
+                (otherwise it is None, since the scenario files would have to be loaded)
+        """
+        if isinstance(self.infos, InfoIndex):
+            num_center_objects = self.infos.get_num_tracks().astype(np.int64)
+            scenario_id_list = self.infos.columns['scenario_id'][self.infos.scenario_rows]
+        else:
+            num_center_objects = np.array([len(info['tracks_to_predict']['track_index']) for info in self.infos], dtype=np.int64)
+            scenario_id_list = [info['scenario_id'] for info in self.infos]
+
+        num_objects = None
+        if self.scenario_store is not None:
+            rows = np.array([self.scenario_store.get_scenario_row(scenario_id) for scenario_id in scenario_id_list], dtype=np.int64)
+            num_objects = self.scenario_store.index['num_objects'][rows]
+        return num_center_objects, num_objects
+
+    def get_map_polyline_cfg(self):
+        return {
+            'POINT_SAMPLED_INTERVAL': self.dataset_cfg.get('POINT_SAMPLED_INTERVAL', 1),
+            'VECTOR_BREAK_DIST_THRESH': self.dataset_cfg.get('VECTOR_BREAK_DIST_THRESH', 1.0),
+            'NUM_POINTS_EACH_POLYLINE': self.dataset_cfg.get('NUM_POINTS_EACH_POLYLINE', 20),
+        }
+
+    def get_map_polyline_cache_path(self):
+        map_cfg = self.get_map_polyline_cfg()
+        cache_name = get_map_polyline_cache_name(
+            point_sampled_interval=map_cfg['POINT_SAMPLED_INTERVAL'],
+            vector_break_dist_thresh=map_cfg['VECTOR_BREAK_DIST_THRESH'],
+            num_points_each_polyline=map_cfg['NUM_POINTS_EACH_POLYLINE']
+        )
+        cache_root = self.data_root / self.dataset_cfg.get('MAP_POLYLINE_CACHE_DIR', 'map_polyline_cache')
+        return cache_root / f'{self.dataset_cfg.SPLIT_DIR[self.mode]}_{cache_name}'
+
+    def create_map_polyline_cache(self, num_workers=16, scenarios_per_shard=1000):
+        """
+        Offline pass to build the batched polylines, masks and polyline centers of all scenarios in the info file of current split
+        """
+        import multiprocessing
+        from functools import partial
+
+        cache_path = self.get_map_polyline_cache_path()
+        os.makedirs(cache_path, exist_ok=True)
+        with open(self.data_root / self.dataset_cfg.INFO_FILE[self.mode], 'rb') as f:
+            scenario_id_list = [info['scenario_id'] for info in pickle.load(f)]
+
+        chunk_list = [scenario_id_list[k:k + scenarios_per_shard] for k in range(0, len(scenario_id_list), scenarios_per_shard)]
+        shard_file_list = [os.path.join(cache_path, f'shard_{k:05d}.bin') for k in range(len(chunk_list))]
+        func = partial(
+            create_map_polyline_cache_shard, data_path=str(self.data_path), map_cfg=self.get_map_polyline_cfg(),
+            packed_store_path=None if self.scenario_store is None else self.scenario_store.store_path,
+            build_kdtree=self.dataset_cfg.get('USE_MAP_SPATIAL_INDEX', False)
+        )
+        with multiprocessing.Pool(num_workers) as p:
+            shard_meta_list = list(tqdm(p.imap(func, zip(chunk_list, shard_file_list)), total=len(chunk_list)))
+
+        write_map_polyline_cache_index(shard_meta_list, cache_path, map_cfg=self.get_map_polyline_cfg())
+        self.logger.info(f'Map polyline cache of {len(scenario_id_list)} scenarios is saved to {cache_path}')
+
+    def load_scenario_info(self, scene_id):
+        if self.scenario_store is not None:
+            return self.scenario_store.load_scenario(scene_id)
+
+        with open(self.data_path / f'sample_{scene_id}.pkl', 'rb') as f:
+            info = pickle.load(f)
+        return info
+
     def __getitem__(self, index):
         ret_infos = self.create_scene_level_data(index)
 
@@ -181,8 +297,7 @@ class WaymoDataset(DatasetTemplate):
         """
         info = self.infos[index]
         scene_id = info['scenario_id']
-        with open(self.data_path / f'sample_{scene_id}.pkl', 'rb') as f:
-            info = pickle.load(f)
+        info = self.load_scenario_info(scene_id)
 
         sdc_track_index = info['sdc_track_index']
         current_time_index = info['current_time_index']
@@ -209,18 +324,30 @@ class WaymoDataset(DatasetTemplate):
             obj_types=obj_types, scene_id=scene_id
         )
 
-        (obj_trajs_data, obj_trajs_mask, obj_trajs_pos, obj_trajs_last_pos, obj_trajs_future_state, obj_trajs_future_mask, center_gt_trajs,
-            center_gt_trajs_mask, center_gt_final_valid_idx,
-            track_index_to_predict_new, sdc_track_index_new, obj_types, obj_ids) = self.create_agent_data_for_center_objects(
-            center_objects=center_objects, obj_trajs_past=obj_trajs_past, obj_trajs_future=obj_trajs_future,
-            track_index_to_predict=track_index_to_predict, sdc_track_index=sdc_track_index,
-            timestamps=timestamps, obj_types=obj_types, obj_ids=obj_ids
-        )
+        share_center_invariant_features = self.dataset_cfg.get('SHARE_CENTER_INVARIANT_FEATURES', False)
+        if share_center_invariant_features:
+            # the agent features are expanded to each center object by the encoder (see center_frame_utils)
+            (shared_agent_data, center_gt_trajs, center_gt_trajs_mask, center_gt_final_valid_idx,
+                track_index_to_predict_new, sdc_track_index_new, obj_types, obj_ids) = self.create_shared_agent_data_for_center_objects(
+                center_objects=center_objects, obj_trajs_past=obj_trajs_past, obj_trajs_future=obj_trajs_future,
+                track_index_to_predict=track_index_to_predict, sdc_track_index=sdc_track_index,
+                timestamps=timestamps, obj_types=obj_types, obj_ids=obj_ids
+            )
+            obj_trajs_data = obj_trajs_mask = obj_trajs_pos = obj_trajs_last_pos = obj_trajs_future_state = obj_trajs_future_mask = None
+        else:
+            (obj_trajs_data, obj_trajs_mask, obj_trajs_pos, obj_trajs_last_pos, obj_trajs_future_state, obj_trajs_future_mask, center_gt_trajs,
+                center_gt_trajs_mask, center_gt_final_valid_idx,
+                track_index_to_predict_new, sdc_track_index_new, obj_types, obj_ids) = self.create_agent_data_for_center_objects(
+                center_objects=center_objects, obj_trajs_past=obj_trajs_past, obj_trajs_future=obj_trajs_future,
+                track_index_to_predict=track_index_to_predict, sdc_track_index=sdc_track_index,
+                timestamps=timestamps, obj_types=obj_types, obj_ids=obj_ids
+            )
 
         if self.dataset_cfg.LOAD_CONTEXT_DATA:
-            track_intentions = self.context_infos[scene_id]["track_intentions"]
-            track_affordances = self.context_infos[scene_id]["track_affordances"]
-            track_scenarios = self.context_infos[scene_id]["track_scenarios"]
+            scene_context = self.get_scene_context(scene_id)
+            track_intentions = scene_context["track_intentions"]
+            track_affordances = scene_context["track_affordances"]
+            track_scenarios = scene_context["track_scenarios"]
             
             ret_dict = {
                 'scenario_id': np.array([scene_id] * len(track_index_to_predict)),
@@ -272,13 +399,22 @@ class WaymoDataset(DatasetTemplate):
                 'center_gt_trajs_src': obj_trajs_full[track_index_to_predict]
             }
 
+        if share_center_invariant_features:
+            for key in ['obj_trajs', 'obj_trajs_mask', 'obj_trajs_pos', 'obj_trajs_last_pos', 'obj_trajs_future_state', 'obj_trajs_future_mask']:
+                ret_dict.pop(key)
+            ret_dict.update(shared_agent_data)
+
         if not self.dataset_cfg.get('WITHOUT_HDMAP', False):
-            if info['map_infos']['all_polylines'].__len__() == 0:
-                info['map_infos']['all_polylines'] = np.zeros((2, 7), dtype=np.float32)
-                print(f'Warning: empty HDMap {scene_id}')
+            if self.map_polyline_cache is not None:
+                map_infos = self.map_polyline_cache.load_polylines(scene_id)
+            else:
+                if info['map_infos']['all_polylines'].__len__() == 0:
+                    info['map_infos']['all_polylines'] = np.zeros((2, 7), dtype=np.float32)
+                    print(f'Warning: empty HDMap {scene_id}')
+                map_infos = info['map_infos']
 
             map_polylines_data, map_polylines_mask, map_polylines_center = self.create_map_data_for_center_objects(
-                center_objects=center_objects, map_infos=info['map_infos'],
+                center_objects=center_objects, map_infos=map_infos,
                 center_offset=self.dataset_cfg.get('CENTER_OFFSET_OF_MAP', (30.0, 0)),
             )   # (num_center_objects, num_topk_polylines, num_points_each_polyline, 9), (num_center_objects, num_topk_polylines, num_points_each_polyline)
 
@@ -340,6 +476,65 @@ class WaymoDataset(DatasetTemplate):
             obj_trajs_future_state, obj_trajs_future_mask, center_gt_trajs, center_gt_trajs_mask, center_gt_final_valid_idx,
             track_index_to_predict_new, sdc_track_index_new, obj_types, obj_ids)
 
+    def create_shared_agent_data_for_center_objects(
+            self, center_objects, obj_trajs_past, obj_trajs_future, track_index_to_predict, sdc_track_index, timestamps,
+            obj_types, obj_ids
+        ):
+        """
+        Only the center-invariant agent features are generated here (once per scenario), and they are transformed
+        to the frame of each center object by the encoder, see mtr.models.utils.center_frame_utils.generate_centered_agent_data
+
+        Returns:
+            shared_agent_data (dict):
+                obj_trajs_world (1, num_objects, num_timestamps, 10): [cx, cy, cz, dx, dy, dz, heading, vel_x, vel_y, valid]
+                obj_onehot_shared (1, num_objects, 5): the same one-hot as generate_centered_trajs_for_agents except the center column
+                obj_timestamps (1, num_timestamps):
+                obj_trajs_future_world (1, num_objects, num_future_timestamps, 5): [cx, cy, vel_x, vel_y, valid]
+        """
+        num_objects = obj_trajs_past.shape[0]
+
+        object_onehot_mask = np.zeros((num_objects, 5), dtype=np.float32)
+        object_onehot_mask[obj_types == 'TYPE_VEHICLE', 0] = 1
+        object_onehot_mask[obj_types == 'TYPE_PEDESTRAIN', 1] = 1  # TODO: CHECK THIS TYPO (keep the same features as generate_centered_trajs_for_agents)
+        object_onehot_mask[obj_types == 'TYPE_CYCLIST', 2] = 1
+        object_onehot_mask[sdc_track_index, 4] = 1
+
+        # generate the labels of track_objects for training, only the future trajs of center objects are transformed here
+        center_trajs_future = self.transform_trajs_to_center_coords(
+            obj_trajs=torch.from_numpy(obj_trajs_future[track_index_to_predict]).float(),
+            center_xyz=torch.from_numpy(center_objects[:, 0:3]).float(),
+            center_heading=torch.from_numpy(center_objects[:, 6]).float(),
+            heading_index=6, rot_vel_index=[7, 8]
+        )  # (num_center_objects, num_center_objects, num_future_timestamps, 10)
+        center_obj_idxs = np.arange(len(track_index_to_predict))
+        center_trajs_future = center_trajs_future[center_obj_idxs, center_obj_idxs].numpy()
+        center_gt_trajs = center_trajs_future[:, :, [0, 1, 7, 8]]  # (num_center_objects, num_future_timestamps, 4)
+        center_gt_trajs_mask = center_trajs_future[:, :, -1]  # (num_center_objects, num_future_timestamps)
+        center_gt_trajs[center_gt_trajs_mask == 0] = 0
+
+        # filter invalid past trajs
+        valid_past_mask = np.logical_not(obj_trajs_past[:, :, -1].sum(axis=-1) == 0)  # (num_objects (original))
+        obj_types = obj_types[valid_past_mask]
+        obj_ids = obj_ids[valid_past_mask]
+
+        valid_index_cnt = valid_past_mask.cumsum(axis=0)
+        track_index_to_predict_new = valid_index_cnt[track_index_to_predict] - 1
+        sdc_track_index_new = valid_index_cnt[sdc_track_index] - 1  # TODO: CHECK THIS
+
+        center_gt_final_valid_idx = np.zeros((len(track_index_to_predict)), dtype=np.float32)
+        for k in range(center_gt_trajs_mask.shape[1]):
+            cur_valid_mask = center_gt_trajs_mask[:, k] > 0  # (num_center_objects)
+            center_gt_final_valid_idx[cur_valid_mask] = k
+
+        shared_agent_data = {
+            'obj_trajs_world': obj_trajs_past[valid_past_mask][None].astype(np.float32),
+            'obj_onehot_shared': object_onehot_mask[valid_past_mask][None],
+            'obj_timestamps': timestamps[None],
+            'obj_trajs_future_world': obj_trajs_future[valid_past_mask][None][:, :, :, [0, 1, 7, 8, 9]].astype(np.float32),
+        }
+        return (shared_agent_data, center_gt_trajs, center_gt_trajs_mask, center_gt_final_valid_idx,
+            track_index_to_predict_new, sdc_track_index_new, obj_types, obj_ids)
+
     def get_interested_agents(self, track_index_to_predict, obj_trajs_full, current_time_index, obj_types, scene_id):
         center_objects_list = []
         track_index_to_predict_selected = []
@@ -488,27 +683,25 @@ class WaymoDataset(DatasetTemplate):
         buffer_points = np.concatenate((sampled_points[:, 0:2], sampled_points_shift[:, 0:2]), axis=-1) # [ed_x, ed_y, st_x, st_y]
         buffer_points[0, 2:4] = buffer_points[0, 0:2]
 
-        break_idxs = (np.linalg.norm(buffer_points[:, 0:2] - buffer_points[:, 2:4], axis=-1) > vector_break_dist_thresh).nonzero()[0]
-        polyline_list = np.array_split(sampled_points, break_idxs, axis=0)
-        ret_polylines = []
-        ret_polylines_mask = []
-
-        def append_single_polyline(new_polyline):
-            cur_polyline = np.zeros((num_points_each_polyline, point_dim), dtype=np.float32)
-            cur_valid_mask = np.zeros((num_points_each_polyline), dtype=np.int32)
-            cur_polyline[:len(new_polyline)] = new_polyline
-            cur_valid_mask[:len(new_polyline)] = 1
-            ret_polylines.append(cur_polyline)
-            ret_polylines_mask.append(cur_valid_mask)
-
-        for k in range(len(polyline_list)):
-            if polyline_list[k].__len__() <= 0:
-                continue
-            for idx in range(0, len(polyline_list[k]), num_points_each_polyline):
-                append_single_polyline(polyline_list[k][idx: idx + num_points_each_polyline])
+        is_break = np.linalg.norm(buffer_points[:, 0:2] - buffer_points[:, 2:4], axis=-1) > vector_break_dist_thresh
+        is_break[0] = False  # the first point always starts a new polyline
+
+        # split the points by the break indices, and then cut each segment into polylines with num_points_each_polyline points
+        segment_idx = np.cumsum(is_break)  # (num_points), segment id of each point
+        segment_start = np.concatenate(([0], is_break.nonzero()[0]))  # (num_segments)
+        segment_len = np.diff(np.concatenate((segment_start, [len(sampled_points)])))
+        segment_num_polylines = (segment_len + num_points_each_polyline - 1) // num_points_each_polyline
+        segment_polyline_offset = np.cumsum(segment_num_polylines) - segment_num_polylines
+
+        point_idx_in_segment = np.arange(len(sampled_points)) - segment_start[segment_idx]
+        polyline_idx = segment_polyline_offset[segment_idx] + point_idx_in_segment // num_points_each_polyline
+        point_idx_in_polyline = point_idx_in_segment % num_points_each_polyline
 
-        ret_polylines = np.stack(ret_polylines, axis=0)
-        ret_polylines_mask = np.stack(ret_polylines_mask, axis=0)
+        num_polylines = segment_num_polylines.sum()
+        ret_polylines = np.zeros((num_polylines, num_points_each_polyline, point_dim), dtype=np.float32)
+        ret_polylines_mask = np.zeros((num_polylines, num_points_each_polyline), dtype=np.int32)
+        ret_polylines[polyline_idx, point_idx_in_polyline] = sampled_points
+        ret_polylines_mask[polyline_idx, point_idx_in_polyline] = 1
 
         ret_polylines = torch.from_numpy(ret_polylines)
         ret_polylines_mask = torch.from_numpy(ret_polylines_mask)
@@ -519,12 +712,39 @@ class WaymoDataset(DatasetTemplate):
         # assert center_dist.max() < 10
         return ret_polylines, ret_polylines_mask
 
+    @staticmethod
+    def get_polyline_center(batch_polylines, batch_polylines_mask):
+        """
+        Args:
+            batch_polylines (num_polylines, num_points_each_polyline, 7):
+            batch_polylines_mask (num_polylines, num_points_each_polyline):
+
+        Returns:
+            polyline_center (num_polylines, 2):
+        """
+        polyline_center = batch_polylines[:, :, 0:2].sum(dim=1) / torch.clamp_min(batch_polylines_mask.sum(dim=1).float()[:, None], min=1.0)
+        return polyline_center
+
+    @staticmethod
+    def build_polyline_kdtree(polyline_center):
+        """
+        Args:
+            polyline_center (num_polylines, 2):
+
+        Returns:
+            polyline_kdtree (scipy.spatial.cKDTree):
+        """
+        from scipy.spatial import cKDTree
+        # unbalanced trees with larger leaves are much faster to build and as fast to query for a few center objects
+        return cKDTree(polyline_center.numpy(), leafsize=64, balanced_tree=False, compact_nodes=False)
+
     def create_map_data_for_center_objects(self, center_objects, map_infos, center_offset):
         """
         Args:
             center_objects (num_center_objects, 10): [cx, cy, cz, dx, dy, dz, heading, vel_x, vel_y, valid]
             map_infos (dict):
                 all_polylines (num_points, 7): [x, y, z, dir_x, dir_y, dir_z, global_type]
+                or the precomputed batch_polylines, batch_polylines_mask, polyline_center (and polyline_kdtree) from the map polyline cache
             center_offset (2):, [offset_x, offset_y]
         Returns:
             map_polylines (num_center_objects, num_topk_polylines, num_points_each_polyline, 9): [x, y, z, dir_x, dir_y, dir_z, global_type, pre_x, pre_y]
@@ -554,20 +774,28 @@ class WaymoDataset(DatasetTemplate):
             neighboring_polylines[neighboring_polyline_valid_mask == 0] = 0
             return neighboring_polylines, neighboring_polyline_valid_mask
 
-        polylines = torch.from_numpy(map_infos['all_polylines'].copy())
         center_objects = torch.from_numpy(center_objects)
 
-        batch_polylines, batch_polylines_mask = self.generate_batch_polylines_from_map(
-            polylines=polylines.numpy(), point_sampled_interval=self.dataset_cfg.get('POINT_SAMPLED_INTERVAL', 1),
-            vector_break_dist_thresh=self.dataset_cfg.get('VECTOR_BREAK_DIST_THRESH', 1.0),
-            num_points_each_polyline=self.dataset_cfg.get('NUM_POINTS_EACH_POLYLINE', 20),
-        )  # (num_polylines, num_points_each_polyline, 7), (num_polylines, num_points_each_polyline)
+        if 'batch_polylines' in map_infos:
+            batch_polylines = map_infos['batch_polylines']  # read-only view of the cache, gathered by the polyline indices below
+            batch_polylines_mask = torch.from_numpy(map_infos['batch_polylines_mask'])
+            polyline_center = torch.from_numpy(map_infos['polyline_center'])
+            polyline_kdtree = map_infos.get('polyline_kdtree', None)
+        else:
+            polylines = torch.from_numpy(map_infos['all_polylines'].copy())
+            batch_polylines, batch_polylines_mask = self.generate_batch_polylines_from_map(
+                polylines=polylines.numpy(), point_sampled_interval=self.dataset_cfg.get('POINT_SAMPLED_INTERVAL', 1),
+                vector_break_dist_thresh=self.dataset_cfg.get('VECTOR_BREAK_DIST_THRESH', 1.0),
+                num_points_each_polyline=self.dataset_cfg.get('NUM_POINTS_EACH_POLYLINE', 20),
+            )  # (num_polylines, num_points_each_polyline, 7), (num_polylines, num_points_each_polyline)
+            polyline_center = polyline_kdtree = None
 
         # collect a number of closest polylines for each center objects
         num_of_src_polylines = self.dataset_cfg.NUM_OF_SRC_POLYLINES
 
         if len(batch_polylines) > num_of_src_polylines:
-            polyline_center = batch_polylines[:, :, 0:2].sum(dim=1) / torch.clamp_min(batch_polylines_mask.sum(dim=1).float()[:, None], min=1.0)
+            if polyline_center is None:
+                polyline_center = self.get_polyline_center(batch_polylines, batch_polylines_mask)
             center_offset_rot = torch.from_numpy(np.array(center_offset, dtype=np.float32))[None, :].repeat(num_center_objects, 1)
             center_offset_rot = common_utils.rotate_points_along_z(
                 points=center_offset_rot.view(num_center_objects, 1, 2),
@@ -576,13 +804,21 @@ class WaymoDataset(DatasetTemplate):
 
             pos_of_map_centers = center_objects[:, 0:2] + center_offset_rot
 
-            dist = (pos_of_map_centers[:, None, :] - polyline_center[None, :, :]).norm(dim=-1)  # (num_center_objects, num_polylines)
-            topk_dist, topk_idxs = dist.topk(k=num_of_src_polylines, dim=-1, largest=False)
-            map_polylines = batch_polylines[topk_idxs]  # (num_center_objects, num_topk_polylines, num_points_each_polyline, 7)
+            if self.dataset_cfg.get('USE_MAP_SPATIAL_INDEX', False):
+                # k-nearest query on the KD-tree of polyline centers, the results are sorted by distance as topk
+                if polyline_kdtree is None:
+                    polyline_kdtree = self.build_polyline_kdtree(polyline_center)
+                _, topk_idxs = polyline_kdtree.query(pos_of_map_centers.numpy(), k=num_of_src_polylines)
+                topk_idxs = torch.from_numpy(topk_idxs.reshape(num_center_objects, num_of_src_polylines))
+            else:
+                dist = (pos_of_map_centers[:, None, :] - polyline_center[None, :, :]).norm(dim=-1)  # (num_center_objects, num_polylines)
+                topk_dist, topk_idxs = dist.topk(k=num_of_src_polylines, dim=-1, largest=False)
+            map_polylines = torch.as_tensor(batch_polylines[topk_idxs])  # (num_center_objects, num_topk_polylines, num_points_each_polyline, 7)
             map_polylines_mask = batch_polylines_mask[topk_idxs]  # (num_center_objects, num_topk_polylines, num_points_each_polyline)
         else:
-            map_polylines = batch_polylines[None, :, :, :].repeat(num_center_objects, 1, 1, 1)
-            map_polylines_mask = batch_polylines_mask[None, :, :].repeat(num_center_objects, 1, 1)
+            polyline_idxs = torch.arange(len(batch_polylines))[None, :].repeat(num_center_objects, 1)
+            map_polylines = torch.as_tensor(batch_polylines[polyline_idxs])
+            map_polylines_mask = batch_polylines_mask[polyline_idxs]
 
         map_polylines, map_polylines_mask = transform_to_center_coordinates(
             neighboring_polylines=map_polylines,
@@ -673,20 +909,72 @@ class WaymoDataset(DatasetTemplate):
         return metric_result_str, metric_results
 
 
+def create_map_polyline_cache_shard(chunk, data_path, packed_store_path, map_cfg, build_kdtree=False):
+    """
+    Args:
+        chunk (tuple): (scenario_ids, shard_file)
+        data_path (str): the dir of sample_{scenario_id}.pkl
+        packed_store_path (str): load the scenarios from the packed store instead if it is not None
+        map_cfg (dict):
+        build_kdtree (bool): also cache the pickled KD-tree of the polyline centers
+    """
+    scenario_ids, shard_file = chunk
+    scenario_store = PackedScenarioStore(packed_store_path) if packed_store_path is not None else None
+
+    batch_polylines_list, batch_polylines_mask_list, polyline_center_list = [], [], []
+    polyline_kdtree_list = [] if build_kdtree else None
+    for scene_id in scenario_ids:
+        if scenario_store is not None:
+            all_polylines = scenario_store.load_scenario(scene_id)['map_infos']['all_polylines']
+        else:
+            with open(os.path.join(data_path, f'sample_{scene_id}.pkl'), 'rb') as f:
+                all_polylines = pickle.load(f)['map_infos']['all_polylines']
+        if all_polylines.__len__() == 0:
+            all_polylines = np.zeros((2, 7), dtype=np.float32)
+
+        batch_polylines, batch_polylines_mask = WaymoDataset.generate_batch_polylines_from_map(
+            polylines=np.array(all_polylines), point_sampled_interval=map_cfg['POINT_SAMPLED_INTERVAL'],
+            vector_break_dist_thresh=map_cfg['VECTOR_BREAK_DIST_THRESH'],
+            num_points_each_polyline=map_cfg['NUM_POINTS_EACH_POLYLINE'],
+        )
+        polyline_center = WaymoDataset.get_polyline_center(batch_polylines, batch_polylines_mask)
+
+        batch_polylines_list.append(batch_polylines.numpy())
+        batch_polylines_mask_list.append(batch_polylines_mask.numpy())
+        polyline_center_list.append(polyline_center.numpy())
+        if build_kdtree:
+            polyline_kdtree_list.append(pickle.dumps(WaymoDataset.build_polyline_kdtree(polyline_center), protocol=pickle.HIGHEST_PROTOCOL))
+
+    return pack_map_polyline_shard(
+        scenario_ids, batch_polylines_list, batch_polylines_mask_list, polyline_center_list, shard_file,
+        polyline_kdtree_list=polyline_kdtree_list
+    )
+
+
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(description='arg parser')
     parser.add_argument('--cfg_file', type=str, default=None, help='specify the config of dataset')
+    parser.add_argument('--func', type=str, default=None, help='e.g. create_map_polyline_cache')
+    parser.add_argument('--split', type=str, default='train', help='train | valid | test')
+    parser.add_argument('--num_workers', type=int, default=16, help='number of processes to create the cache')
     args = parser.parse_args()
 
     import yaml
     from easydict import EasyDict
-    try:
-        yaml_config = yaml.safe_load(open(args.cfg_file), Loader=yaml.FullLoader)
-    except:
-        yaml_config = yaml.safe_load(open(args.cfg_file))
+    with open(args.cfg_file, 'r') as f:
+        yaml_config = yaml.safe_load(f)
     dataset_cfg = EasyDict(yaml_config)
-
-
-
+    if 'DATA_CONFIG' in dataset_cfg:
+        dataset_cfg = dataset_cfg.DATA_CONFIG
+
+    if args.func == 'create_map_polyline_cache':
+        # python -m mtr.datasets.waymo.waymo_dataset --cfg_file tools/cfgs/waymo/mtr+100_percent_data.yaml --func create_map_polyline_cache --split train
+        dataset_cfg.LOAD_CONTEXT_DATA = False
+        dataset_cfg.USE_MAP_POLYLINE_CACHE = False
+        dataset = WaymoDataset(
+            dataset_cfg=dataset_cfg, training=(args.split == 'train'),
+            logger=common_utils.create_logger(), dataset_type=args.split
+        )
+        dataset.create_map_polyline_cache(num_workers=args.num_workers)
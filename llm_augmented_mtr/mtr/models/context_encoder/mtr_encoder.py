@@ -4,13 +4,12 @@
 # All Rights Reserved
 
 
-import numpy as np
 import torch
 import torch.nn as nn
 
 
 from mtr.models.utils.transformer import transformer_encoder_layer, position_encoding_utils
-from mtr.models.utils import polyline_encoder
+from mtr.models.utils import polyline_encoder, center_frame_utils
 from mtr.utils import common_utils
 from mtr.ops.knn import knn_utils
 
@@ -137,7 +136,7 @@ class MTREncoder(nn.Module):
                 index_pair_batch=batch_idxs
             )
 
-        ret_full_feature = torch.zeros_like(x_stack_full)  # (batch_size * N, d_model)
+        ret_full_feature = output.new_zeros(x_stack_full.shape)  # (batch_size * N, d_model)
         ret_full_feature[x_mask_stack] = output
 
         ret_full_feature = ret_full_feature.view(batch_size, N, d_model)
@@ -150,13 +149,34 @@ class MTREncoder(nn.Module):
               input_dict:
         """
         input_dict = batch_dict['input_dict']
-        obj_trajs, obj_trajs_mask = input_dict['obj_trajs'].cuda(), input_dict['obj_trajs_mask'].cuda() 
-        map_polylines, map_polylines_mask = input_dict['map_polylines'].cuda(), input_dict['map_polylines_mask'].cuda() 
+        # the inputs are moved to the device of the encoder (GPU, or CPU for generate_context.py --device cpu)
+        device = next(self.parameters()).device
+        if 'obj_trajs_world' in input_dict:
+            # expand the center-invariant agent features of each scene to the frame of each center object on the device
+            input_dict.update(center_frame_utils.generate_centered_agent_data(
+                obj_trajs_world=input_dict['obj_trajs_world'].to(device),
+                obj_onehot_shared=input_dict['obj_onehot_shared'].to(device),
+                obj_timestamps=input_dict['obj_timestamps'].to(device),
+                center_objects_world=input_dict['center_objects_world'].to(device),
+                center_scene_idx=input_dict['center_scene_idx'].to(device),
+                track_index_to_predict=input_dict['track_index_to_predict'].to(device),
+                obj_trajs_future_world=input_dict['obj_trajs_future_world'].to(device) if 'obj_trajs_future_world' in input_dict else None
+            ))
+
+        obj_trajs, obj_trajs_mask = input_dict['obj_trajs'].to(device), input_dict['obj_trajs_mask'].to(device) 
+        map_polylines, map_polylines_mask = input_dict['map_polylines'].to(device), input_dict['map_polylines_mask'].to(device) 
 
-        obj_trajs_last_pos = input_dict['obj_trajs_last_pos'].cuda() 
-        map_polylines_center = input_dict['map_polylines_center'].cuda() 
+        obj_trajs_last_pos = input_dict['obj_trajs_last_pos'].to(device) 
+        map_polylines_center = input_dict['map_polylines_center'].to(device) 
         track_index_to_predict = input_dict['track_index_to_predict']
 
+        # compact transport (COMPACT_TRANSPORT): float16 features and bit-packed masks
+        if obj_trajs_mask.dtype == torch.uint8:
+            obj_trajs_mask = common_utils.unpack_bool_mask(obj_trajs_mask, num_elements=obj_trajs.shape[2])
+        if map_polylines_mask.dtype == torch.uint8:
+            map_polylines_mask = common_utils.unpack_bool_mask(map_polylines_mask, num_elements=map_polylines.shape[2])
+        obj_trajs, map_polylines = obj_trajs.float(), map_polylines.float()
+
         assert obj_trajs_mask.dtype == torch.bool and map_polylines_mask.dtype == torch.bool
 
         num_center_objects, num_objects, num_timestamps, _ = obj_trajs.shape
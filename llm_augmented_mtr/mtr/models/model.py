@@ -50,7 +50,7 @@ class MotionTransformer(nn.Module):
 
         return loss, tb_dict, disp_dict
 
-    def load_params_with_optimizer(self, filename, to_cpu=False, optimizer=None, logger=None):
+    def load_params_with_optimizer(self, filename, to_cpu=False, optimizer=None, logger=None, scaler=None):
         if not os.path.isfile(filename):
             raise FileNotFoundError
 
@@ -67,6 +67,11 @@ class MotionTransformer(nn.Module):
                         % (filename, 'CPU' if to_cpu else 'GPU'))
             optimizer.load_state_dict(checkpoint['optimizer_state'])
 
+        # the loss scale of float16 AMP, not in the checkpoints trained without it
+        if scaler is not None and scaler.is_enabled() and checkpoint.get('scaler_state', None) is not None:
+            logger.info('==> Loading AMP grad scaler from checkpoint %s' % filename)
+            scaler.load_state_dict(checkpoint['scaler_state'])
+
         if 'version' in checkpoint:
             print('==> Checkpoint trained from version: %s' % checkpoint['version'])
         # logger.info('==> Done')
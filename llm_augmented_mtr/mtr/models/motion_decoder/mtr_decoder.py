@@ -6,6 +6,7 @@
 
 import copy
 import pickle
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -13,7 +14,7 @@ import torch.nn.functional as F
 from mtr.models.utils.transformer import transformer_decoder_layer
 from mtr.models.utils.transformer import position_encoding_utils
 from mtr.models.utils import common_layers
-from mtr.utils import common_utils, loss_utils, motion_utils
+from mtr.utils import loss_utils, motion_utils
 from mtr.config import cfg
 
 from LLM_integrate.embedding.embedding_format import intention_type_decode_dict, affordance_type_decode_dict, scenario_type_decode_dict
@@ -27,6 +28,7 @@ class MTRDecoder(nn.Module):
         self.num_future_frames = self.model_cfg.NUM_FUTURE_FRAMES
         self.num_motion_modes = self.model_cfg.NUM_MOTION_MODES
         self.use_place_holder = self.model_cfg.get('USE_PLACE_HOLDER', False)
+        self.use_inference_fast_path = self.model_cfg.get('USE_INFERENCE_FAST_PATH', False)
         self.d_model = self.model_cfg.D_MODEL
         self.num_decoder_layers = self.model_cfg.NUM_DECODER_LAYERS
 
@@ -67,9 +69,18 @@ class MTRDecoder(nn.Module):
         )
 
         # define the motion query
-        self.intention_points, self.intention_query, self.intention_query_mlps = self.build_motion_query(
+        intention_points, self.intention_query, self.intention_query_mlps = self.build_motion_query(
             self.d_model, use_place_holder=self.use_place_holder
         )
+        # (num_object_types, num_query, 2) and its sine embedding (num_object_types, num_query, C), indexed by the order of OBJECT_TYPE
+        self.object_type_to_idx = {cur_type: type_idx for type_idx, cur_type in enumerate(self.object_type)}
+        self.register_buffer('intention_points', intention_points, persistent=False)
+        self.register_buffer(
+            'intention_points_sine_embed',
+            position_encoding_utils.gen_sineembed_for_position(intention_points, hidden_dim=self.d_model),
+            persistent=False
+        )
+        self.intention_query_cache = None  # output of intention_query_mlps for each type in eval mode
         
         # define the context proj layer
         if self.model_cfg.LOAD_CONTEXT_DATA:
@@ -84,6 +95,13 @@ class MTRDecoder(nn.Module):
             in_channels=self.d_model, hidden_size=self.d_model, num_decoder_layers=self.num_decoder_layers
         )
 
+        # the output channels of the last linear layers needed by the inference fast path:
+        # (x, y, vel_x, vel_y) of each frame of the dense future head, and (x, y) of each frame of the motion reg heads
+        num_reg_channels = 7 if self.motion_vel_heads is None else 5
+        frame_offsets = torch.arange(self.num_future_frames)[:, None]
+        self.register_buffer('dense_future_channel_idxs', (frame_offsets * 7 + torch.tensor([0, 1, 5, 6])).view(-1), persistent=False)
+        self.register_buffer('waypoint_channel_idxs', (frame_offsets * num_reg_channels + torch.tensor([0, 1])).view(-1), persistent=False)
+
         self.forward_ret_dict = {}
 
     def build_dense_future_prediction_layers(self, hidden_dim, num_future_frames):
@@ -127,11 +145,9 @@ class MTRDecoder(nn.Module):
             with open(intention_points_file, 'rb') as f:
                 intention_points_dict = pickle.load(f)
 
-            intention_points = {}
-            for cur_type in self.object_type:
-                cur_intention_points = intention_points_dict[cur_type]
-                cur_intention_points = torch.from_numpy(cur_intention_points).float().view(-1, 2).cuda()
-                intention_points[cur_type] = cur_intention_points
+            intention_points = torch.stack([
+                torch.from_numpy(intention_points_dict[cur_type]).float().view(-1, 2)
+                for cur_type in self.object_type], dim=0)  # (num_object_types, num_query, 2)
 
             intention_query_mlps = common_layers.build_mlps(
                 c_in=d_model, mlp_channels=[d_model, d_model], ret_before_act=True
@@ -153,6 +169,18 @@ class MTRDecoder(nn.Module):
         motion_vel_heads = None 
         return motion_reg_heads, motion_cls_heads, motion_vel_heads
 
+    @staticmethod
+    def apply_mlps_with_output_channels(mlps, x, channel_idxs):
+        """
+        The output channels channel_idxs of the mlps (built by common_layers.build_mlps with ret_before_act=True),
+        only these rows of the last linear layer are computed
+        """
+        last_layer = mlps[-1]
+        return F.linear(mlps[:-1](x), last_layer.weight[channel_idxs], last_layer.bias[channel_idxs])
+
+    def is_inference_fast_path(self):
+        return self.use_inference_fast_path and not self.training
+
     def apply_dense_future_prediction(self, obj_feature, obj_mask, obj_pos):
         num_center_objects, num_objects, _ = obj_feature.shape
 
@@ -162,6 +190,22 @@ class MTRDecoder(nn.Module):
         obj_pos_feature_valid = self.obj_pos_encoding_layer(obj_pos_valid)
         obj_fused_feature_valid = torch.cat((obj_pos_feature_valid, obj_feature_valid), dim=-1)
 
+        if self.is_inference_fast_path():
+            # the dense future trajectories are only supervised in training, only the channels encoded by future_traj_mlps are computed
+            obj_future_input_valid = self.apply_mlps_with_output_channels(
+                self.dense_future_head, obj_fused_feature_valid, self.dense_future_channel_idxs
+            ).view(-1, self.num_future_frames, 4)
+            obj_future_input_valid = torch.cat((
+                obj_future_input_valid[:, :, 0:2] + obj_pos_valid[:, None, 0:2], obj_future_input_valid[:, :, 2:4]
+            ), dim=-1).flatten(start_dim=1, end_dim=2)  # (num_valid_objects, C)
+            obj_future_feature_valid = self.future_traj_mlps(obj_future_input_valid)
+
+            obj_full_trajs_feature = torch.cat((obj_feature_valid, obj_future_feature_valid), dim=-1)
+            obj_feature_valid = self.traj_fusion_mlps(obj_full_trajs_feature)
+            ret_obj_feature = obj_feature_valid.new_zeros(obj_feature.shape)
+            ret_obj_feature[obj_mask] = obj_feature_valid
+            return ret_obj_feature, None
+
         pred_dense_trajs_valid = self.dense_future_head(obj_fused_feature_valid)
         pred_dense_trajs_valid = pred_dense_trajs_valid.view(pred_dense_trajs_valid.shape[0], self.num_future_frames, 7)
 
@@ -175,27 +219,56 @@ class MTRDecoder(nn.Module):
         obj_full_trajs_feature = torch.cat((obj_feature_valid, obj_future_feature_valid), dim=-1)
         obj_feature_valid = self.traj_fusion_mlps(obj_full_trajs_feature)
 
-        ret_obj_feature = torch.zeros_like(obj_feature)
+        ret_obj_feature = obj_feature_valid.new_zeros(obj_feature.shape)
         ret_obj_feature[obj_mask] = obj_feature_valid
 
-        ret_pred_dense_future_trajs = obj_feature.new_zeros(num_center_objects, num_objects, self.num_future_frames, 7)
+        ret_pred_dense_future_trajs = pred_dense_trajs_valid.new_zeros(num_center_objects, num_objects, self.num_future_frames, 7)
         ret_pred_dense_future_trajs[obj_mask] = pred_dense_trajs_valid
         self.forward_ret_dict['pred_dense_trajs'] = ret_pred_dense_future_trajs
 
         return ret_obj_feature, ret_pred_dense_future_trajs
 
+    def train(self, mode=True):
+        self.intention_query_cache = None
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.intention_query_cache = None
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def get_center_objects_type_idx(self, center_objects_type):
+        """
+        Args:
+            center_objects_type (num_center_objects): numpy array of the type names
+
+        Returns:
+            center_objects_type_idx (num_center_objects): long tensor, the index of each type in OBJECT_TYPE
+        """
+        unique_types, inverse_idxs = np.unique(center_objects_type, return_inverse=True)
+        unique_type_idxs = np.array([self.object_type_to_idx[cur_type] for cur_type in unique_types], dtype=np.int64)
+        return torch.from_numpy(unique_type_idxs[inverse_idxs.reshape(-1)]).to(self.intention_points.device)
+
     def get_motion_query(self, center_objects_type):
         num_center_objects = len(center_objects_type)
         if self.use_place_holder:
             raise NotImplementedError
         else:
-            intention_points = torch.stack([
-                self.intention_points[center_objects_type[obj_idx]]
-                for obj_idx in range(num_center_objects)], dim=0)
-            intention_points = intention_points.permute(1, 0, 2)  # (num_query, num_center_objects, 2)
+            center_objects_type_idx = self.get_center_objects_type_idx(center_objects_type)
+            intention_points = self.intention_points[center_objects_type_idx].permute(1, 0, 2)  # (num_query, num_center_objects, 2)
 
-            intention_query = position_encoding_utils.gen_sineembed_for_position(intention_points, hidden_dim=self.d_model)
-            intention_query = self.intention_query_mlps(intention_query.view(-1, self.d_model)).view(-1, num_center_objects, self.d_model)  # (num_query, num_center_objects, C)
+            if self.training or torch.is_grad_enabled():
+                # the statistics of the BatchNorm in training are computed over all the center objects as before
+                intention_query = self.intention_points_sine_embed[center_objects_type_idx].permute(1, 0, 2)
+                intention_query = self.intention_query_mlps(intention_query.reshape(-1, self.d_model)).view(-1, num_center_objects, self.d_model)  # (num_query, num_center_objects, C)
+            else:
+                if self.intention_query_cache is None or self.intention_query_cache.device != self.intention_points.device:
+                    # always in float32, a cache filled under autocast (AMP) would be reused by the later calls without it
+                    num_types, num_query, _ = self.intention_points_sine_embed.shape
+                    with torch.autocast(device_type=self.intention_points.device.type, enabled=False):
+                        self.intention_query_cache = self.intention_query_mlps(
+                            self.intention_points_sine_embed.view(-1, self.d_model).float()
+                        ).view(num_types, num_query, self.d_model)
+                intention_query = self.intention_query_cache[center_objects_type_idx].permute(1, 0, 2)  # (num_query, num_center_objects, C)
         return intention_query, intention_points
 
     def apply_cross_attention(self, kv_feature, kv_mask, kv_pos, query_content, query_embed, attention_layer,
@@ -298,6 +371,57 @@ class MTRDecoder(nn.Module):
 
         return sorted_idxs.int(), base_map_idxs
 
+    def apply_dynamic_map_collection_fast(self, map_pos, map_mask, pred_waypoints, base_region_offset, num_query, num_waypoint_polylines=128, num_base_polylines=256,
+                                          base_map_idxs=None, waypoint_stride=1):
+        """
+        The same polylines as apply_dynamic_map_collection (if waypoint_stride is 1) without the dense distance tensor of all waypoints and the sort
+
+        Args:
+            map_pos (num_center_objects, num_polylines, 3):
+            map_mask (num_center_objects, num_polylines):
+            pred_waypoints (num_center_objects, num_query, num_timestamps, 2):
+            base_map_idxs (num_center_objects, num_query, num_base_polylines): the base polylines collected by the first layer
+            waypoint_stride (int): only every waypoint_stride-th waypoint (counted back from the last one) is used
+
+        Returns:
+            collected_idxs (num_center_objects, num_query, num_base_polylines + num_waypoint_polylines): int, not sorted, -1 for the invalid and duplicate ones
+            base_map_idxs (num_center_objects, num_query, num_base_polylines):
+        """
+        num_center_objects, num_polylines, _ = map_pos.shape
+        map_xy = map_pos[:, :, 0:2]
+
+        if base_map_idxs is None:
+            base_points = torch.tensor(base_region_offset).type_as(map_pos)
+            base_dist = (map_xy - base_points[None, None, :]).pow(2).sum(dim=-1).masked_fill(~map_mask, float('inf'))  # (num_center_objects, num_polylines)
+            base_topk_dist, base_map_idxs = base_dist.topk(k=min(num_polylines, num_base_polylines), dim=-1, largest=False)
+            base_map_idxs[torch.isinf(base_topk_dist)] = -1
+            base_map_idxs = base_map_idxs[:, None, :].repeat(1, num_query, 1)  # (num_center_objects, num_query, num_base_polylines)
+            if base_map_idxs.shape[-1] < num_base_polylines:
+                base_map_idxs = F.pad(base_map_idxs, pad=(0, num_base_polylines - base_map_idxs.shape[-1]), mode='constant', value=-1)
+
+        # the min squared distance over the waypoints, accumulated waypoint by waypoint to keep the memory at (num_center_objects, num_query, num_polylines)
+        num_timestamps = pred_waypoints.shape[2]
+        dynamic_dist = None
+        for t in range(num_timestamps - 1, -1, -waypoint_stride):
+            cur_dist = (pred_waypoints[:, :, None, t, 0:2] - map_xy[:, None, :, :]).pow(2).sum(dim=-1)  # (num_center_objects, num_query, num_polylines)
+            dynamic_dist = cur_dist if dynamic_dist is None else torch.minimum(dynamic_dist, cur_dist)
+        dynamic_dist = dynamic_dist.masked_fill(~map_mask[:, None, :], float('inf'))
+
+        dynamic_topk_dist, dynamic_map_idxs = dynamic_dist.topk(k=min(num_polylines, num_waypoint_polylines), dim=-1, largest=False)
+        dynamic_map_idxs[torch.isinf(dynamic_topk_dist)] = -1
+        if dynamic_map_idxs.shape[-1] < num_waypoint_polylines:
+            dynamic_map_idxs = F.pad(dynamic_map_idxs, pad=(0, num_waypoint_polylines - dynamic_map_idxs.shape[-1]), mode='constant', value=-1)
+
+        # both topk results have no duplicates, remove the dynamic polylines which are already in the base polylines
+        # (the invalid index -1 is scattered to the extra last column)
+        seen_mask = map_mask.new_zeros(num_center_objects, num_query, num_polylines + 1)
+        seen_mask.scatter_(dim=-1, index=torch.where(base_map_idxs < 0, num_polylines, base_map_idxs), value=True)
+        duplicate_mask = torch.gather(seen_mask, dim=-1, index=torch.where(dynamic_map_idxs < 0, num_polylines, dynamic_map_idxs))
+        dynamic_map_idxs = dynamic_map_idxs.masked_fill(duplicate_mask, -1)
+
+        collected_idxs = torch.cat((base_map_idxs, dynamic_map_idxs), dim=-1)  # (num_center_objects, num_query, num_collected_polylines)
+        return collected_idxs.int(), base_map_idxs
+
     def apply_transformer_decoder(self, center_objects_feature, center_objects_type, obj_feature, obj_mask, obj_pos, map_feature, map_mask, map_pos, context_info):
         intention_query, intention_points = self.get_motion_query(center_objects_type)
         num_center_objects = intention_query.shape[1]
@@ -329,15 +453,27 @@ class MTRDecoder(nn.Module):
             ) 
 
             # query map feature
-            collected_idxs, base_map_idxs = self.apply_dynamic_map_collection(
-                map_pos=map_pos, map_mask=map_mask,
-                pred_waypoints=pred_waypoints,
-                base_region_offset=self.model_cfg.CENTER_OFFSET_OF_MAP,
-                num_waypoint_polylines=self.model_cfg.NUM_WAYPOINT_MAP_POLYLINES,
-                num_base_polylines=self.model_cfg.NUM_BASE_MAP_POLYLINES,
-                base_map_idxs=base_map_idxs,
-                num_query=num_query
-            )
+            if self.model_cfg.get('FAST_MAP_COLLECTION', False):
+                collected_idxs, base_map_idxs = self.apply_dynamic_map_collection_fast(
+                    map_pos=map_pos, map_mask=map_mask,
+                    pred_waypoints=pred_waypoints,
+                    base_region_offset=self.model_cfg.CENTER_OFFSET_OF_MAP,
+                    num_waypoint_polylines=self.model_cfg.NUM_WAYPOINT_MAP_POLYLINES,
+                    num_base_polylines=self.model_cfg.NUM_BASE_MAP_POLYLINES,
+                    base_map_idxs=base_map_idxs,
+                    num_query=num_query,
+                    waypoint_stride=self.model_cfg.get('MAP_COLLECTION_WAYPOINT_STRIDE', 1)
+                )
+            else:
+                collected_idxs, base_map_idxs = self.apply_dynamic_map_collection(
+                    map_pos=map_pos, map_mask=map_mask,
+                    pred_waypoints=pred_waypoints,
+                    base_region_offset=self.model_cfg.CENTER_OFFSET_OF_MAP,
+                    num_waypoint_polylines=self.model_cfg.NUM_WAYPOINT_MAP_POLYLINES,
+                    num_base_polylines=self.model_cfg.NUM_BASE_MAP_POLYLINES,
+                    base_map_idxs=base_map_idxs,
+                    num_query=num_query
+                )
 
             map_query_feature = self.apply_cross_attention(
                 kv_feature=map_feature, kv_mask=map_mask, kv_pos=map_pos,
@@ -358,6 +494,14 @@ class MTRDecoder(nn.Module):
 
             # motion prediction
             query_content_t = query_content.permute(1, 0, 2).contiguous().view(num_center_objects * num_query, -1)
+            if self.is_inference_fast_path() and layer_idx + 1 < self.num_decoder_layers:
+                # only the waypoints of the intermediate layers are used (by the map collection and the query center of the next layer)
+                pred_waypoints = self.apply_mlps_with_output_channels(
+                    self.motion_reg_heads[layer_idx], query_content_t, self.waypoint_channel_idxs
+                ).view(num_center_objects, num_query, self.num_future_frames, 2)
+                dynamic_query_center = pred_waypoints[:, :, -1, 0:2].contiguous().permute(1, 0, 2)  # (num_query, num_center_objects, 2)
+                continue
+
             pred_scores = self.motion_cls_heads[layer_idx](query_content_t).view(num_center_objects, num_query)
             if self.motion_vel_heads is not None:
                 pred_trajs = self.motion_reg_heads[layer_idx](query_content_t).view(num_center_objects, num_query, self.num_future_frames, 5)
@@ -375,7 +519,8 @@ class MTRDecoder(nn.Module):
         if self.use_place_holder:
             raise NotImplementedError
 
-        assert len(pred_list) == self.num_decoder_layers
+        # the inference fast path only keeps the prediction of the last layer
+        assert len(pred_list) == (1 if self.is_inference_fast_path() else self.num_decoder_layers)
         return pred_list
 
     def get_decoder_loss(self, tb_pre_tag=''):
@@ -404,6 +549,7 @@ class MTRDecoder(nn.Module):
                 raise NotImplementedError
 
             pred_scores, pred_trajs = pred_list[layer_idx]
+            pred_scores, pred_trajs = pred_scores.float(), pred_trajs.float()  # the losses are computed in float32 with AMP
             assert pred_trajs.shape[-1] == 7
             pred_trajs_gmm, pred_vel = pred_trajs[:, :, :, 0:5], pred_trajs[:, :, :, 5:7]
 
@@ -451,7 +597,7 @@ class MTRDecoder(nn.Module):
     def get_dense_future_prediction_loss(self, tb_pre_tag='', tb_dict=None, disp_dict=None):
         obj_trajs_future_state = self.forward_ret_dict['obj_trajs_future_state'].cuda()
         obj_trajs_future_mask = self.forward_ret_dict['obj_trajs_future_mask'].cuda()
-        pred_dense_trajs = self.forward_ret_dict['pred_dense_trajs']  # (num_center_objects, num_objects, num_future_frames, 7)
+        pred_dense_trajs = self.forward_ret_dict['pred_dense_trajs'].float()  # (num_center_objects, num_objects, num_future_frames, 7)
         assert pred_dense_trajs.shape[-1] == 7
         assert obj_trajs_future_state.shape[-1] == 4
 
@@ -501,6 +647,7 @@ class MTRDecoder(nn.Module):
 
     def generate_final_prediction(self, pred_list, batch_dict):
         pred_scores, pred_trajs = pred_list[-1]
+        pred_scores, pred_trajs = pred_scores.float(), pred_trajs.float()  # the outputs of the heads are float16 / bfloat16 with AMP
         pred_scores = torch.softmax(pred_scores, dim=-1)  # (num_center_objects, num_query)
 
         num_center_objects, num_query, num_future_timestamps, num_feat = pred_trajs.shape
@@ -528,11 +675,11 @@ class MTRDecoder(nn.Module):
         # input projection
         center_objects_feature = self.in_proj_center_obj(center_objects_feature)
         obj_feature_valid = self.in_proj_obj(obj_feature[obj_mask])
-        obj_feature = obj_feature.new_zeros(num_center_objects, num_objects, obj_feature_valid.shape[-1])
+        obj_feature = obj_feature_valid.new_zeros(num_center_objects, num_objects, obj_feature_valid.shape[-1])
         obj_feature[obj_mask] = obj_feature_valid
 
         map_feature_valid = self.in_proj_map(map_feature[map_mask])
-        map_feature = map_feature.new_zeros(num_center_objects, num_polylines, map_feature_valid.shape[-1])
+        map_feature = map_feature_valid.new_zeros(num_center_objects, num_polylines, map_feature_valid.shape[-1])
         map_feature[map_mask] = map_feature_valid
         
         context_info = None
@@ -542,7 +689,7 @@ class MTRDecoder(nn.Module):
             track_affordances = input_dict["track_affordances"]
             track_scenarios = input_dict["track_scenarios"]
             num_of_agent, window_size, _ = track_intentions.shape
-            num_of_query, _ = self.intention_points["TYPE_VEHICLE"].shape
+            num_of_query = self.intention_points.shape[1]
             context_info = torch.cat([track_intentions, track_affordances, track_scenarios], dim=-1)
             # shape (#agent, #window_size, 8+4+5) => (#agent, #query, 17)
             assert num_of_query % window_size == 0, "num_of_query cannot divided by window_size"
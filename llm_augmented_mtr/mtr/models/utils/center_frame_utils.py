@@ -0,0 +1,136 @@
+# Motion Transformer (MTR): https://arxiv.org/abs/2209.13508
+# Published at NeurIPS 2022
+# The center-frame transform of the agent trajectories, derived from
+# transform_trajs_to_center_coords / generate_centered_trajs_for_agents of MTR's mtr/datasets/waymo/waymo_dataset.py
+
+
+import torch
+
+from mtr.utils import common_utils
+
+
+def transform_trajs_to_center_coords(obj_trajs, center_xyz, center_heading, heading_index=None, rot_vel_index=None):
+    """
+    Same as WaymoDataset.transform_trajs_to_center_coords, but the trajs are already gathered for each center object
+
+    Args:
+        obj_trajs (num_center_objects, num_objects, num_timestamps, num_attrs):
+            first three values of num_attrs are [x, y, z] or [x, y]
+        center_xyz (num_center_objects, 3 or 2): [x, y, z] or [x, y]
+        center_heading (num_center_objects):
+        heading_index: the index of heading angle in the num_attr-axis of obj_trajs
+    """
+    num_center_objects, num_objects, num_timestamps, num_attrs = obj_trajs.shape
+    assert center_xyz.shape[0] == center_heading.shape[0] == num_center_objects
+    assert center_xyz.shape[1] in [3, 2]
+
+    obj_trajs = obj_trajs.clone()
+    obj_trajs[:, :, :, 0:center_xyz.shape[1]] -= center_xyz[:, None, None, :]
+    obj_trajs[:, :, :, 0:2] = common_utils.rotate_points_along_z(
+        points=obj_trajs[:, :, :, 0:2].view(num_center_objects, -1, 2),
+        angle=-center_heading
+    ).view(num_center_objects, num_objects, num_timestamps, 2)
+
+    if heading_index is not None:
+        obj_trajs[:, :, :, heading_index] -= center_heading[:, None, None]
+
+    # rotate direction of velocity
+    if rot_vel_index is not None:
+        assert len(rot_vel_index) == 2
+        obj_trajs[:, :, :, rot_vel_index] = common_utils.rotate_points_along_z(
+            points=obj_trajs[:, :, :, rot_vel_index].view(num_center_objects, -1, 2),
+            angle=-center_heading
+        ).view(num_center_objects, num_objects, num_timestamps, 2)
+
+    return obj_trajs
+
+
+def generate_centered_agent_data(obj_trajs_world, obj_onehot_shared, obj_timestamps, center_objects_world,
+                                 center_scene_idx, track_index_to_predict, obj_trajs_future_world=None):
+    """
+    Expand the center-invariant agent features of each scenario into the frame of each center object,
+    this gives the same outputs as WaymoDataset.create_agent_data_for_center_objects (after padding in collate_batch)
+
+    Args:
+        obj_trajs_world (num_scenes, num_objects, num_timestamps, 10): [cx, cy, cz, dx, dy, dz, heading, vel_x, vel_y, valid]
+        obj_onehot_shared (num_scenes, num_objects, 5): the object type and sdc one-hot, column 3 (center object) is empty
+        obj_timestamps (num_scenes, num_timestamps):
+        center_objects_world (num_center_objects, 10):
+        center_scene_idx (num_center_objects): the scene index of each center object
+        track_index_to_predict (num_center_objects): the index of center objects in num_objects
+        obj_trajs_future_world (num_scenes, num_objects, num_future_timestamps, 5): [cx, cy, vel_x, vel_y, valid]
+
+    Returns:
+        ret_dict:
+            obj_trajs (num_center_objects, num_objects, num_timestamps, 29):
+            obj_trajs_mask (num_center_objects, num_objects, num_timestamps):
+            obj_trajs_pos (num_center_objects, num_objects, num_timestamps, 3):
+            obj_trajs_last_pos (num_center_objects, num_objects, 3):
+            obj_trajs_future_state (num_center_objects, num_objects, num_future_timestamps, 4): [x, y, vx, vy]
+            obj_trajs_future_mask (num_center_objects, num_objects, num_future_timestamps):
+    """
+    num_center_objects = center_objects_world.shape[0]
+    num_objects, num_timestamps = obj_trajs_world.shape[1:3]
+    center_xyz, center_heading = center_objects_world[:, 0:3].float(), center_objects_world[:, 6].float()
+
+    # transform coordinates to the centered objects
+    obj_trajs = transform_trajs_to_center_coords(
+        obj_trajs=obj_trajs_world[center_scene_idx], center_xyz=center_xyz, center_heading=center_heading,
+        heading_index=6, rot_vel_index=[7, 8]
+    )
+
+    ## generate the attributes for each object
+    object_onehot_mask = obj_onehot_shared[center_scene_idx]  # (num_center_objects, num_objects, 5)
+    object_onehot_mask[torch.arange(num_center_objects, device=obj_trajs.device), track_index_to_predict, 3] = 1
+    object_onehot_mask = object_onehot_mask[:, :, None, :].expand(-1, -1, num_timestamps, -1)
+
+    object_time_embedding = obj_trajs.new_zeros((num_center_objects, num_objects, num_timestamps, num_timestamps + 1))
+    object_time_embedding[:, :, torch.arange(num_timestamps), torch.arange(num_timestamps)] = 1
+    object_time_embedding[:, :, :, -1] = obj_timestamps[center_scene_idx][:, None, :]
+
+    object_heading_embedding = torch.stack((torch.sin(obj_trajs[:, :, :, 6]), torch.cos(obj_trajs[:, :, :, 6])), dim=-1)
+
+    vel = obj_trajs[:, :, :, 7:9]  # (num_centered_objects, num_objects, num_timestamps, 2)
+    vel_pre = torch.roll(vel, shifts=1, dims=2)
+    acce = (vel - vel_pre) / 0.1  # (num_centered_objects, num_objects, num_timestamps, 2)
+    acce[:, :, 0, :] = acce[:, :, 1, :]
+
+    ret_obj_trajs = torch.cat((
+        obj_trajs[:, :, :, 0:6],
+        object_onehot_mask,
+        object_time_embedding,
+        object_heading_embedding,
+        obj_trajs[:, :, :, 7:9],
+        acce,
+    ), dim=-1)
+
+    ret_obj_valid_mask = obj_trajs[:, :, :, -1]  # (num_center_obejcts, num_objects, num_timestamps)
+    ret_obj_trajs[ret_obj_valid_mask == 0] = 0
+
+    # generate the final valid position of each object
+    obj_trajs_pos = ret_obj_trajs[:, :, :, 0:3]
+    time_idxs = torch.arange(num_timestamps, device=obj_trajs.device)
+    last_valid_idx = ((ret_obj_valid_mask > 0).long() * time_idxs).argmax(dim=-1)  # objects without valid frames are all zeros
+    obj_trajs_last_pos = torch.gather(obj_trajs_pos, dim=2, index=last_valid_idx[:, :, None, None].repeat(1, 1, 1, 3)).squeeze(dim=2)
+
+    ret_dict = {
+        'obj_trajs': ret_obj_trajs,
+        'obj_trajs_mask': ret_obj_valid_mask > 0,
+        'obj_trajs_pos': obj_trajs_pos,
+        'obj_trajs_last_pos': obj_trajs_last_pos,
+    }
+
+    ##  generate label for future trajectories
+    if obj_trajs_future_world is not None:
+        obj_trajs_future = transform_trajs_to_center_coords(
+            obj_trajs=obj_trajs_future_world[center_scene_idx], center_xyz=center_xyz[:, 0:2], center_heading=center_heading,
+            rot_vel_index=[2, 3]
+        )
+        ret_obj_trajs_future = obj_trajs_future[:, :, :, 0:4]  # (x, y, vx, vy)
+        ret_obj_valid_mask_future = obj_trajs_future[:, :, :, -1]  # (num_center_obejcts, num_objects, num_timestamps_future)
+        ret_obj_trajs_future[ret_obj_valid_mask_future == 0] = 0
+
+        ret_dict['obj_trajs_future_state'] = ret_obj_trajs_future
+        ret_dict['obj_trajs_future_mask'] = ret_obj_valid_mask_future
+
+    return ret_dict
@@ -43,7 +43,7 @@ class PointNetPolylineEncoder(nn.Module):
 
         # pre-mlp
         polylines_feature_valid = self.pre_mlps(polylines[polylines_mask])  # (N, C)
-        polylines_feature = polylines.new_zeros(batch_size, num_polylines,  num_points_each_polylines, polylines_feature_valid.shape[-1])
+        polylines_feature = polylines_feature_valid.new_zeros(batch_size, num_polylines,  num_points_each_polylines, polylines_feature_valid.shape[-1])
         polylines_feature[polylines_mask] = polylines_feature_valid
 
         # get global feature
@@ -52,7 +52,7 @@ class PointNetPolylineEncoder(nn.Module):
 
         # mlp
         polylines_feature_valid = self.mlps(polylines_feature[polylines_mask])
-        feature_buffers = polylines_feature.new_zeros(batch_size, num_polylines, num_points_each_polylines, polylines_feature_valid.shape[-1])
+        feature_buffers = polylines_feature_valid.new_zeros(batch_size, num_polylines, num_points_each_polylines, polylines_feature_valid.shape[-1])
         feature_buffers[polylines_mask] = polylines_feature_valid
 
         # max-pooling
@@ -62,6 +62,6 @@ class PointNetPolylineEncoder(nn.Module):
         if self.out_mlps is not None:
             valid_mask = (polylines_mask.sum(dim=-1) > 0)
             feature_buffers_valid = self.out_mlps(feature_buffers[valid_mask])  # (N, C)
-            feature_buffers = feature_buffers.new_zeros(batch_size, num_polylines, feature_buffers_valid.shape[-1])
+            feature_buffers = feature_buffers_valid.new_zeros(batch_size, num_polylines, feature_buffers_valid.shape[-1])
             feature_buffers[valid_mask] = feature_buffers_valid
         return feature_buffers
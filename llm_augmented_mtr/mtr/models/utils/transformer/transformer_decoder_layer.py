@@ -142,16 +142,16 @@ class TransformerDecoderLayer(nn.Module):
             valid_memory = memory[memory_valid_mask]
 
             k_content_valid = self.ca_kcontent_proj(valid_memory)
-            k_content = memory.new_zeros(memory.shape[0], k_content_valid.shape[-1])
+            k_content = k_content_valid.new_zeros(memory.shape[0], k_content_valid.shape[-1])
             k_content[memory_valid_mask] = k_content_valid
 
             v_valid = self.ca_v_proj(valid_memory)
-            v = memory.new_zeros(memory.shape[0], v_valid.shape[-1])
+            v = v_valid.new_zeros(memory.shape[0], v_valid.shape[-1])
             v[memory_valid_mask] = v_valid
 
             valid_pos = pos[memory_valid_mask]
             k_pos_valid = self.ca_kpos_proj(valid_pos)
-            k_pos = pos.new_zeros(memory.shape[0], k_pos_valid.shape[-1])
+            k_pos = k_pos_valid.new_zeros(memory.shape[0], k_pos_valid.shape[-1])
             k_pos[memory_valid_mask] = k_pos_valid
         else:
             k_content = self.ca_kcontent_proj(memory)
@@ -6,7 +6,14 @@ import torch
 import torch.nn as nn
 from torch.autograd import Function, Variable
 
-from . import attention_cuda
+from mtr.utils.common_utils import cuda_custom_bwd, cuda_custom_fwd
+from . import attention_utils_torch
+
+try:
+    from . import attention_cuda
+except ImportError:
+    # CPU-only host without the compiled extension, only the tensors on CPU are supported (attention_utils_torch.py)
+    attention_cuda = None
 
 
 """ Attention computation code v1."""
@@ -21,6 +28,7 @@ class AttentionWeightComputation(Function):
     """
 
     @staticmethod
+    @cuda_custom_fwd(cast_inputs=torch.float32)
     def forward(ctx,
                 query_batch_cnt: torch.Tensor,
                 key_batch_cnt: torch.Tensor,
@@ -41,6 +49,7 @@ class AttentionWeightComputation(Function):
         :return:
             output: A float tensor with shape [total_query_num, local_size, nhead]
         """
+        assert attention_cuda is not None, 'attention_cuda is not compiled'
         assert query_batch_cnt.is_contiguous()
         assert key_batch_cnt.is_contiguous()
         assert index_pair_batch.is_contiguous()
@@ -70,6 +79,7 @@ class AttentionWeightComputation(Function):
         return output
 
     @staticmethod
+    @cuda_custom_bwd
     def backward(ctx, grad_out: torch.Tensor):
         """
         Args:
@@ -97,7 +107,14 @@ class AttentionWeightComputation(Function):
         return None, None, None, None, grad_query_features, grad_key_features
 
 
-attention_weight_computation = AttentionWeightComputation.apply
+def attention_weight_computation(query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair, query_features, key_features):
+    if query_features.is_cuda:
+        return AttentionWeightComputation.apply(
+            query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair, query_features, key_features
+        )
+    return attention_utils_torch.attention_weight_computation(
+        query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair, query_features, key_features
+    )
 
 
 class AttentionValueComputation(Function):
@@ -111,6 +128,7 @@ class AttentionValueComputation(Function):
     """
 
     @staticmethod
+    @cuda_custom_fwd(cast_inputs=torch.float32)
     def forward(ctx,
                 query_batch_cnt: torch.Tensor,
                 key_batch_cnt: torch.Tensor,
@@ -131,6 +149,7 @@ class AttentionValueComputation(Function):
         :return:
             output: A float tensor with shape [total_query_num, nhead, hdim]
         """
+        assert attention_cuda is not None, 'attention_cuda is not compiled'
         assert query_batch_cnt.is_contiguous()
         assert key_batch_cnt.is_contiguous()
         assert index_pair_batch.is_contiguous()
@@ -160,6 +179,7 @@ class AttentionValueComputation(Function):
         return output
 
     @staticmethod
+    @cuda_custom_bwd
     def backward(ctx, grad_out: torch.Tensor):
         """
         Args:
@@ -187,4 +207,11 @@ class AttentionValueComputation(Function):
         return None, None, None, None, grad_attn_weight, grad_value_features
 
 
-attention_value_computation = AttentionValueComputation.apply
\ No newline at end of file
+def attention_value_computation(query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair, attn_weight, value_features):
+    if value_features.is_cuda:
+        return AttentionValueComputation.apply(
+            query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair, attn_weight, value_features
+        )
+    return attention_utils_torch.attention_value_computation(
+        query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair, attn_weight, value_features
+    )
\ No newline at end of file
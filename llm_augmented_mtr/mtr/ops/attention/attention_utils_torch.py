@@ -0,0 +1,73 @@
+"""
+Pure PyTorch implementation of the attention_cuda ops (v1 and v2 compute the same results), used for the tensors
+on CPU (or without the compiled extension). The backward is computed by autograd.
+The index_pair semantics follow src/attention_*_kernel*.cu: index_pair[q, l] is the index of the key within the keys of
+the batch of query q (index_pair_batch[q]), -1 is ignored (zero attention weight, no contribution to the value).
+"""
+
+import torch
+
+
+def get_global_key_index(key_batch_cnt, index_pair_batch, index_pair):
+    """
+    Returns:
+        key_idxs (total_query_num, local_size): long, the index in the stacked keys (0 for the ignored pairs)
+        valid_mask (total_query_num, local_size): bool
+    """
+    key_batch_cnt = key_batch_cnt.long()
+    key_start_idxs = torch.cumsum(key_batch_cnt, dim=0) - key_batch_cnt
+    valid_mask = index_pair >= 0
+    key_idxs = index_pair.long() + key_start_idxs[index_pair_batch.long()][:, None]
+    key_idxs = torch.where(valid_mask, key_idxs, torch.zeros_like(key_idxs))
+    return key_idxs, valid_mask
+
+
+def attention_weight_computation(query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair,
+                                 query_features, key_features, chunk_size=4096):
+    """
+    Args:
+        query_batch_cnt (bs): int
+        key_batch_cnt (bs): int
+        index_pair_batch (total_query_num): int
+        index_pair (total_query_num, local_size): int
+        query_features (total_query_num, nhead, hdim): float
+        key_features (total_key_num, nhead, hdim): float
+
+    Returns:
+        output (total_query_num, local_size, nhead): float
+    """
+    key_idxs, valid_mask = get_global_key_index(key_batch_cnt, index_pair_batch, index_pair)
+    # the gathered keys are (chunk_size, local_size, nhead, hdim), the queries are processed chunk by chunk
+    output = []
+    for start_idx in range(0, index_pair.shape[0], chunk_size):
+        cur_key_features = key_features[key_idxs[start_idx:start_idx + chunk_size]]
+        cur_output = (query_features[start_idx:start_idx + chunk_size, None, :, :] * cur_key_features).sum(dim=-1)
+        output.append(cur_output.masked_fill(~valid_mask[start_idx:start_idx + chunk_size, :, None], 0))
+    if len(output) == 0:
+        return query_features.new_zeros(index_pair.shape[0], index_pair.shape[1], key_features.shape[1])
+    return torch.cat(output, dim=0)
+
+
+def attention_value_computation(query_batch_cnt, key_batch_cnt, index_pair_batch, index_pair,
+                                attn_weight, value_features, chunk_size=4096):
+    """
+    Args:
+        query_batch_cnt (bs): int
+        key_batch_cnt (bs): int
+        index_pair_batch (total_query_num): int
+        index_pair (total_query_num, local_size): int
+        attn_weight (total_query_num, local_size, nhead): float
+        value_features (total_key_num, nhead, hdim): float
+
+    Returns:
+        output (total_query_num, nhead, hdim): float
+    """
+    key_idxs, valid_mask = get_global_key_index(key_batch_cnt, index_pair_batch, index_pair)
+    attn_weight = attn_weight.masked_fill(~valid_mask[:, :, None], 0)
+    output = []
+    for start_idx in range(0, index_pair.shape[0], chunk_size):
+        cur_value_features = value_features[key_idxs[start_idx:start_idx + chunk_size]]
+        output.append((attn_weight[start_idx:start_idx + chunk_size, :, :, None] * cur_value_features).sum(dim=1))
+    if len(output) == 0:
+        return value_features.new_zeros(index_pair.shape[0], value_features.shape[1], value_features.shape[2])
+    return torch.cat(output, dim=0)
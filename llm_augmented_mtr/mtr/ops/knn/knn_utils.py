@@ -8,11 +8,19 @@ import torch
 import torch.nn as nn
 from torch.autograd import Function
 
-from . import knn_cuda
+from mtr.utils.common_utils import cuda_custom_bwd, cuda_custom_fwd
+from . import knn_utils_torch
+
+try:
+    from . import knn_cuda
+except ImportError:
+    # CPU-only host without the compiled extension, only the tensors on CPU are supported (knn_utils_torch.py)
+    knn_cuda = None
 
 
 class KNNBatch(Function):
     @staticmethod
+    @cuda_custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, xyz, query_xyz, batch_idxs, query_batch_offsets, k):
         '''
         :param ctx:
@@ -27,6 +35,7 @@ class KNNBatch(Function):
         n = xyz.size(0)
         m = query_xyz.size(0)
         assert k <= m
+        assert knn_cuda is not None, 'knn_cuda is not compiled'
         assert xyz.is_contiguous() and xyz.is_cuda
         assert query_xyz.is_contiguous() and query_xyz.is_cuda
         assert batch_idxs.is_contiguous() and batch_idxs.is_cuda
@@ -39,15 +48,20 @@ class KNNBatch(Function):
         return idx
 
     @staticmethod
+    @cuda_custom_bwd
     def backward(ctx, a=None):
         return None, None, None, None, None
     
 
-knn_batch = KNNBatch.apply
+def knn_batch(xyz, query_xyz, batch_idxs, query_batch_offsets, k):
+    if xyz.is_cuda:
+        return KNNBatch.apply(xyz, query_xyz, batch_idxs, query_batch_offsets, k)
+    return knn_utils_torch.knn_batch(xyz, query_xyz, batch_idxs, query_batch_offsets, k)
 
 
 class KNNBatchMlogK(Function):
     @staticmethod
+    @cuda_custom_fwd(cast_inputs=torch.float32)
     def forward(ctx, xyz, query_xyz, batch_idxs, query_batch_offsets, k):
         '''
         :param ctx:
@@ -62,6 +76,7 @@ class KNNBatchMlogK(Function):
         n = xyz.size(0)
         m = query_xyz.size(0)
         # assert k <= m
+        assert knn_cuda is not None, 'knn_cuda is not compiled'
         assert xyz.is_contiguous() and xyz.is_cuda
         assert query_xyz.is_contiguous() and query_xyz.is_cuda
         assert batch_idxs.is_contiguous() and batch_idxs.is_cuda
@@ -74,7 +89,14 @@ class KNNBatchMlogK(Function):
         return idx
 
     @staticmethod
+    @cuda_custom_bwd
     def backward(ctx, a=None):
         return None, None, None, None, None
    
-knn_batch_mlogk = KNNBatchMlogK.apply 
+
+def knn_batch_mlogk(xyz, query_xyz, batch_idxs, query_batch_offsets, k):
+    if xyz.is_cuda:
+        return KNNBatchMlogK.apply(xyz, query_xyz, batch_idxs, query_batch_offsets, k)
+    # the neighbors are sorted on CPU, the GPU kernel returns them in heap order
+    return knn_utils_torch.knn_batch(xyz, query_xyz, batch_idxs, query_batch_offsets, k)
+ 
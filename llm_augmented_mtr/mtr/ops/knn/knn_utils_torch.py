@@ -0,0 +1,33 @@
+# Pure PyTorch implementation of the knn_cuda ops, used for the tensors on CPU (or without the compiled extension)
+# The output follows src/knn_gpu.cu: the index of the neighbor within the queries of the same batch, -1 if the batch
+# has less than k queries. The neighbors are sorted by distance (knn_batch_mlogk on GPU returns them in heap order)
+
+
+import torch
+
+
+def knn_batch(xyz, query_xyz, batch_idxs, query_batch_offsets, k):
+    """
+    Args:
+        xyz (n, 3): float
+        query_xyz (m, 3): float
+        batch_idxs (n): int
+        query_batch_offsets (B + 1): int, offsets[-1] = m
+        k (int):
+
+    Returns:
+        idx (n, k): int
+    """
+    idx = torch.full((xyz.shape[0], k), -1, dtype=torch.int32, device=xyz.device)
+    batch_idxs = batch_idxs.long()
+    query_batch_offsets = query_batch_offsets.long().tolist()
+    for batch_idx in torch.unique(batch_idxs).tolist():
+        pt_idxs = (batch_idxs == batch_idx).nonzero()[:, 0]
+        cur_query_xyz = query_xyz[query_batch_offsets[batch_idx]:query_batch_offsets[batch_idx + 1]]
+        num_neighbors = min(k, cur_query_xyz.shape[0])
+        if num_neighbors == 0:
+            continue
+        # the same squared distance as the kernel (torch.cdist uses a matmul for large inputs)
+        sqr_dist = (xyz[pt_idxs, None, :] - cur_query_xyz[None, :, :]).pow(2).sum(dim=-1)
+        idx[pt_idxs, :num_neighbors] = sqr_dist.topk(num_neighbors, dim=-1, largest=False).indices.int()
+    return idx
@@ -2,6 +2,7 @@
 # Published at NeurIPS 2022
 
 
+import functools
 import numpy as np
 import torch
 import logging
@@ -33,21 +34,23 @@ def rotate_points_along_z(points, angle):
     cosa = torch.cos(angle)
     sina = torch.sin(angle)
     zeros = angle.new_zeros(points.shape[0])
-    if points.shape[-1] == 2:
-        rot_matrix = torch.stack((
-            cosa,  sina,
-            -sina, cosa
-        ), dim=1).view(-1, 2, 2).float()
-        points_rot = torch.matmul(points, rot_matrix)
-    else:
-        ones = angle.new_ones(points.shape[0])
-        rot_matrix = torch.stack((
-            cosa,  sina, zeros,
-            -sina, cosa, zeros,
-            zeros, zeros, ones
-        ), dim=1).view(-1, 3, 3).float()
-        points_rot = torch.matmul(points[:, :, 0:3], rot_matrix)
-        points_rot = torch.cat((points_rot, points[:, :, 3:]), dim=-1)
+    # the positions are rotated in float32 also under autocast
+    with torch.autocast(device_type=points.device.type, enabled=False):
+        if points.shape[-1] == 2:
+            rot_matrix = torch.stack((
+                cosa,  sina,
+                -sina, cosa
+            ), dim=1).view(-1, 2, 2).float()
+            points_rot = torch.matmul(points, rot_matrix)
+        else:
+            ones = angle.new_ones(points.shape[0])
+            rot_matrix = torch.stack((
+                cosa,  sina, zeros,
+                -sina, cosa, zeros,
+                zeros, zeros, ones
+            ), dim=1).view(-1, 3, 3).float()
+            points_rot = torch.matmul(points[:, :, 0:3], rot_matrix)
+            points_rot = torch.cat((points_rot, points[:, :, 3:]), dim=-1)
     return points_rot.numpy() if is_numpy else points_rot
 
 
@@ -86,6 +89,37 @@ def merge_batch_by_padding_2nd_dim(tensor_list, return_pad_mask=False):
     return ret_tensor
 
 
+def pack_bool_mask(mask):
+    """
+    Pack the last dim of a bool mask into bits
+
+    Args:
+        mask (..., N): bool
+    Returns:
+        packed_mask (..., ceil(N / 8)): uint8
+    """
+    num_pad = (-mask.shape[-1]) % 8
+    if num_pad > 0:
+        mask = torch.cat((mask, mask.new_zeros(mask.shape[:-1] + (num_pad,))), dim=-1)
+    bit_weights = torch.tensor([128, 64, 32, 16, 8, 4, 2, 1], dtype=torch.uint8, device=mask.device)
+    packed_mask = (mask.view(mask.shape[:-1] + (-1, 8)).to(torch.uint8) * bit_weights).sum(dim=-1, dtype=torch.uint8)
+    return packed_mask
+
+
+def unpack_bool_mask(packed_mask, num_elements):
+    """
+    Args:
+        packed_mask (..., ceil(N / 8)): uint8 from pack_bool_mask
+        num_elements (int): N
+    Returns:
+        mask (..., N): bool
+    """
+    bit_shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=packed_mask.device)
+    mask = (packed_mask[..., None] >> bit_shifts) & 1
+    mask = mask.view(packed_mask.shape[:-1] + (-1,))[..., :num_elements]
+    return mask.bool()
+
+
 def create_logger(log_file=None, rank=0, log_level=logging.INFO):
     logger = logging.getLogger(__name__)
     logger.setLevel(log_level if rank == 0 else 'ERROR')
@@ -133,13 +167,34 @@ def get_batch_offsets(batch_idxs, bs):
     :param bs: int
     :return: batch_offsets: (bs + 1)
     '''
-    batch_offsets = torch.zeros(bs + 1).int().cuda()
+    batch_offsets = torch.zeros(bs + 1, dtype=torch.int32, device=batch_idxs.device)
     for i in range(bs):
         batch_offsets[i + 1] = batch_offsets[i] + (batch_idxs == i).sum()
     assert batch_offsets[-1] == batch_idxs.shape[0]
     return batch_offsets
 
 
+def get_amp_dtype(optim_cfg):
+    """
+    Returns:
+        the dtype of autocast (OPTIMIZATION.AMP_DTYPE), None if OPTIMIZATION.USE_AMP is disabled
+    """
+    if not optim_cfg.get('USE_AMP', False):
+        return None
+    amp_dtype = optim_cfg.get('AMP_DTYPE', 'bfloat16')
+    assert amp_dtype in ['bfloat16', 'float16'], f'unsupported AMP_DTYPE: {amp_dtype}'
+    return getattr(torch, amp_dtype)
+
+
+# the autocast decorators of the autograd functions of the CUDA ops, torch.cuda.amp.custom_fwd / custom_bwd are deprecated
+# (since torch 2.4) in favor of torch.amp.custom_fwd / custom_bwd with the device type
+if hasattr(torch.amp, 'custom_fwd'):
+    cuda_custom_fwd = functools.partial(torch.amp.custom_fwd, device_type='cuda')
+    cuda_custom_bwd = functools.partial(torch.amp.custom_bwd, device_type='cuda')
+else:
+    cuda_custom_fwd, cuda_custom_bwd = torch.cuda.amp.custom_fwd, torch.cuda.amp.custom_bwd
+
+
 def set_random_seed(seed):
     random.seed(seed)
     np.random.seed(seed)
@@ -179,8 +234,12 @@ def init_dist_slurm(tcp_port, local_rank, backend='nccl'):
 def init_dist_pytorch(tcp_port, local_rank, backend='nccl'):
     # if mp.get_start_method(allow_none=True) is None:
     #     mp.set_start_method('spawn')
-    num_gpus = torch.cuda.device_count()
-    torch.cuda.set_device(local_rank % num_gpus)
+    if backend == 'gloo':
+        # CPU processes, the number of processes is given by the launcher
+        num_gpus = int(os.environ['WORLD_SIZE'])
+    else:
+        num_gpus = torch.cuda.device_count()
+        torch.cuda.set_device(local_rank % num_gpus)
 
     dist.init_process_group(
         backend=backend,
@@ -192,6 +251,24 @@ def init_dist_pytorch(tcp_port, local_rank, backend='nccl'):
     return num_gpus, rank
 
 
+def ensure_file_built_on_rank0(file_path, build_func, is_up_to_date_func=None):
+    """
+    Build a derived file (e.g. a converted store next to the source data) only once on rank 0,
+    the other ranks wait at the barrier until it exists
+
+    Args:
+        file_path (str): the file (or dir) to check
+        build_func (callable): called without arguments to build file_path
+        is_up_to_date_func (callable): optional, called without arguments, an existing file_path is rebuilt if it returns False
+    """
+    rank, world_size = get_dist_info()
+    if rank == 0 and (not os.path.exists(file_path) or (is_up_to_date_func is not None and not is_up_to_date_func())):
+        build_func()
+    if world_size > 1:
+        dist.barrier()
+    assert os.path.exists(file_path), f'{file_path} is not built'
+
+
 def merge_results_dist(result_part, size, tmpdir):
     rank, world_size = get_dist_info()
     os.makedirs(tmpdir, exist_ok=True)
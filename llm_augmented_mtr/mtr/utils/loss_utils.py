@@ -25,6 +25,8 @@ def nll_loss_gmm_direct(pred_scores, pred_trajs, gt_trajs, gt_valid_mask, pre_ne
     else:
         assert pred_trajs.shape[-1] == 5
 
+    # the log-std / rho terms overflow in float16, always computed in float32 (also under autocast)
+    pred_scores, pred_trajs, gt_trajs = pred_scores.float(), pred_trajs.float(), gt_trajs.float()
     batch_size = pred_scores.shape[0]
 
     if pre_nearest_mode_idxs is not None:
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# insert the project path into system path, so that the tests can use `import mtr.xxx`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
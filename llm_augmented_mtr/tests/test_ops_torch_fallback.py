@@ -0,0 +1,107 @@
+# Parity of the pure PyTorch implementations of the knn / attention ops (mtr/ops/*/*_torch.py, used on CPU)
+# with a loop-by-loop reference of the CUDA kernels (src/*.cu), and with the CUDA ops if they are compiled and a GPU is available
+# The timing of both implementations is reported by tools/benchmark/benchmark_ops_torch_fallback.py
+
+import pytest
+import torch
+
+from mtr.ops.attention import attention_utils_torch, attention_utils_v2
+from mtr.ops.knn import knn_utils, knn_utils_torch
+
+
+NUM_BATCHES, MAX_NUM_POINTS, K, NHEAD, HDIM = 4, 64, 16, 8, 32
+
+
+def generate_inputs(seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batch_cnt = torch.randint(1, MAX_NUM_POINTS + 1, (NUM_BATCHES,), generator=generator).int()
+    batch_cnt[0] = K // 2  # less than k points
+    batch_offsets = torch.cat((torch.zeros(1, dtype=torch.int32), torch.cumsum(batch_cnt, dim=0).int()))
+    batch_idxs = torch.repeat_interleave(torch.arange(NUM_BATCHES, dtype=torch.int32), batch_cnt.long())
+    xyz = torch.rand(int(batch_offsets[-1]), 3, generator=generator) * 100
+    features = [torch.randn(int(batch_offsets[-1]), NHEAD, HDIM, generator=generator) for _ in range(3)]
+    return xyz, batch_idxs, batch_cnt, batch_offsets, features
+
+
+def knn_reference(xyz, batch_idxs, batch_offsets, k):
+    # the insertion sort of knn_batch_cuda_ in src/knn_gpu.cu
+    idx = torch.full((xyz.shape[0], k), -1, dtype=torch.int32)
+    for pt_idx in range(xyz.shape[0]):
+        start, end = int(batch_offsets[batch_idxs[pt_idx]]), int(batch_offsets[batch_idxs[pt_idx] + 1])
+        sqr_dist = (xyz[start:end] - xyz[pt_idx]).pow(2).sum(dim=-1)
+        order = sorted(range(end - start), key=lambda x: float(sqr_dist[x]))[:k]
+        idx[pt_idx, :len(order)] = torch.tensor(order, dtype=torch.int32)
+    return idx
+
+
+def attention_reference(batch_cnt, batch_idxs, index_pair, query_features, key_features, value_features):
+    # attention_weight_computation_forward and attention_value_computation_forward in src/*.cu, one query at a time
+    key_start_idxs = torch.cumsum(batch_cnt.long(), dim=0) - batch_cnt.long()
+    total_query_num, local_size = index_pair.shape
+    attn_weight = torch.zeros(total_query_num, local_size, query_features.shape[1])
+    output = torch.zeros_like(query_features)
+    for query_idx in range(total_query_num):
+        for local_idx in range(local_size):
+            if index_pair[query_idx, local_idx] == -1:
+                continue
+            key_idx = key_start_idxs[batch_idxs[query_idx]] + index_pair[query_idx, local_idx]
+            attn_weight[query_idx, local_idx] = (query_features[query_idx] * key_features[key_idx]).sum(dim=-1)
+            output[query_idx] += attn_weight[query_idx, local_idx, :, None] * value_features[key_idx]
+    return attn_weight, output
+
+
+def test_knn_matches_reference():
+    xyz, batch_idxs, batch_cnt, batch_offsets, _ = generate_inputs()
+    index_pair = knn_utils.knn_batch_mlogk(xyz, xyz, batch_idxs, batch_offsets, K)
+    ref_index_pair = knn_reference(xyz, batch_idxs, batch_offsets, K)
+    # the order of equal distances is not compared
+    assert torch.equal(index_pair.sort(dim=-1).values, ref_index_pair.sort(dim=-1).values)
+    # the batch with less than k points is padded with -1
+    assert (index_pair[batch_idxs == 0] == -1).any()
+
+
+def test_attention_matches_reference():
+    xyz, batch_idxs, batch_cnt, batch_offsets, (query_features, key_features, value_features) = generate_inputs()
+    index_pair = knn_utils.knn_batch_mlogk(xyz, xyz, batch_idxs, batch_offsets, K)
+    attn_weight = attention_utils_v2.attention_weight_computation(batch_cnt, batch_cnt, batch_idxs, index_pair, query_features, key_features)
+    output = attention_utils_v2.attention_value_computation(batch_cnt, batch_cnt, batch_idxs, index_pair, attn_weight, value_features)
+    ref_attn_weight, ref_output = attention_reference(batch_cnt, batch_idxs, index_pair, query_features, key_features, value_features)
+    assert torch.allclose(attn_weight, ref_attn_weight, atol=1e-4)
+    assert torch.allclose(output, ref_output, atol=1e-3)
+
+
+def test_attention_gradcheck():
+    xyz, batch_idxs, batch_cnt, batch_offsets, features = generate_inputs()
+    index_pair = knn_utils.knn_batch_mlogk(xyz, xyz, batch_idxs, batch_offsets, K)
+    # the first batch (with the padded pairs) on a few channels in float64, the jacobian is dense
+    num_queries = int(batch_cnt[0])
+    batch_idxs, index_pair = batch_idxs[:num_queries], index_pair[:num_queries]
+    double_inputs = [x[:num_queries, :2, :4].double().requires_grad_() for x in features]
+    assert torch.autograd.gradcheck(
+        lambda q, k, v: attention_utils_torch.attention_value_computation(
+            batch_cnt[:1], batch_cnt[:1], batch_idxs, index_pair,
+            attention_utils_torch.attention_weight_computation(batch_cnt[:1], batch_cnt[:1], batch_idxs, index_pair, q, k),
+            v
+        ),
+        double_inputs
+    )
+
+
+@pytest.mark.skipif(knn_utils.knn_cuda is None or not torch.cuda.is_available(), reason='the CUDA ops are not compiled or no GPU')
+def test_cuda_ops_match_torch():
+    xyz, batch_idxs, batch_cnt, batch_offsets, features = generate_inputs(seed=1)
+    xyz, batch_idxs, batch_cnt, batch_offsets = xyz.cuda(), batch_idxs.cuda(), batch_cnt.cuda(), batch_offsets.cuda()
+    query_features, key_features, value_features = [x.cuda().requires_grad_() for x in features]
+
+    index_pair = knn_utils.knn_batch_mlogk(xyz, xyz, batch_idxs, batch_offsets, K)
+    torch_index_pair = knn_utils_torch.knn_batch(xyz, xyz, batch_idxs, batch_offsets, K)
+    assert torch.equal(index_pair.sort(dim=-1).values, torch_index_pair.sort(dim=-1).values)
+
+    results = {}
+    for name, module in [('cuda', attention_utils_v2), ('torch', attention_utils_torch)]:
+        attn_weight = module.attention_weight_computation(batch_cnt, batch_cnt, batch_idxs, index_pair, query_features, key_features)
+        output = module.attention_value_computation(batch_cnt, batch_cnt, batch_idxs, index_pair, attn_weight, value_features)
+        grads = torch.autograd.grad(output.sum(), (query_features, key_features, value_features))
+        results[name] = [attn_weight, output] + list(grads)
+    for cuda_result, torch_result in zip(results['cuda'], results['torch']):
+        assert torch.allclose(cuda_result, torch_result, atol=1e-3, rtol=1e-4)
@@ -0,0 +1,129 @@
+"""
+Compare the training step (forward, loss, backward, clip and step as in train_utils.train_one_epoch) and the eval forward
+of MTRDecoder in float32 and with AMP (OPTIMIZATION.USE_AMP, bfloat16 / float16) on random encoder outputs:
+reports the throughput and the peak GPU memory, the loss of the first step and the difference of the final predictions to float32
+
+python benchmark_amp.py --cfg_file ../cfgs/waymo/mtr+20_percent_data.yaml --num_center_objects 40
+"""
+
+import _init_path
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+from torch.nn.utils import clip_grad_norm_
+
+from mtr.config import cfg, cfg_from_yaml_file
+from mtr.models.motion_decoder.mtr_decoder import MTRDecoder
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--cfg_file', type=str, default='../cfgs/waymo/mtr+20_percent_data.yaml', help='specify the config of the decoder')
+    parser.add_argument('--num_center_objects', type=int, default=40, help='number of center objects in a batch')
+    parser.add_argument('--num_objects', type=int, default=64, help='number of objects of each center object')
+    parser.add_argument('--num_polylines', type=int, default=768, help='number of map polylines of each center object')
+    parser.add_argument('--amp_dtypes', type=str, nargs='+', default=['bfloat16', 'float16'], help='dtypes of autocast to compare with float32')
+    parser.add_argument('--num_repeats', type=int, default=10, help='number of repeats for timing')
+    args = parser.parse_args()
+    return args
+
+
+def generate_batch_dict(args, in_channels, num_future_frames, object_type, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    num_center_objects, num_objects, num_polylines = args.num_center_objects, args.num_objects, args.num_polylines
+    obj_mask = torch.rand(num_center_objects, num_objects, generator=generator) > 0.3
+    map_mask = torch.rand(num_center_objects, num_polylines, generator=generator) > 0.2
+    obj_mask[:, 0] = map_mask[:, 0] = True
+    gt_trajs = torch.cumsum(torch.randn(num_center_objects, num_objects, num_future_frames, 4, generator=generator), dim=2)
+    gt_trajs_mask = (torch.rand(num_center_objects, num_objects, num_future_frames, generator=generator) > 0.1).float()
+    gt_trajs_mask[:, 0, -1] = 1
+    batch_dict = {
+        'obj_feature': torch.randn(num_center_objects, num_objects, in_channels, generator=generator),
+        'obj_mask': obj_mask,
+        'obj_pos': (torch.rand(num_center_objects, num_objects, 3, generator=generator) - 0.5) * 100,
+        'map_feature': torch.randn(num_center_objects, num_polylines, in_channels, generator=generator),
+        'map_mask': map_mask,
+        'map_pos': (torch.rand(num_center_objects, num_polylines, 3, generator=generator) - 0.5) * 200,
+        'center_objects_feature': torch.randn(num_center_objects, in_channels, generator=generator),
+    }
+    batch_dict = {key: val.cuda() for key, val in batch_dict.items()}
+    batch_dict['input_dict'] = {
+        'center_objects_type': np.array(object_type)[np.arange(num_center_objects) % len(object_type)],
+        'center_gt_trajs': gt_trajs[:, 0].cuda(),
+        'center_gt_trajs_mask': gt_trajs_mask[:, 0].cuda(),
+        'center_gt_final_valid_idx': torch.full((num_center_objects,), num_future_frames - 1, dtype=torch.float32).cuda(),
+        'obj_trajs_future_state': gt_trajs.cuda(),
+        'obj_trajs_future_mask': gt_trajs_mask.cuda(),
+    }
+    return batch_dict
+
+
+def measure(func, num_repeats):
+    func()  # warm up
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base_memory = torch.cuda.memory_allocated()
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        func()
+    torch.cuda.synchronize()
+    peak_memory = (torch.cuda.max_memory_allocated() - base_memory) / 1024 ** 2
+    return (time.perf_counter() - start_time) / num_repeats * 1000, peak_memory
+
+
+def main():
+    args = parse_config()
+    assert torch.cuda.is_available(), 'AMP (torch.cuda.amp) needs a GPU'
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    model_cfg = cfg.MODEL.MOTION_DECODER
+    model_cfg.LOAD_CONTEXT_DATA = False
+    in_channels = cfg.MODEL.CONTEXT_ENCODER.D_MODEL
+    torch.manual_seed(0)
+    init_decoder = MTRDecoder(in_channels=in_channels, config=model_cfg).cuda()
+    batch_dict = generate_batch_dict(args, in_channels, model_cfg.NUM_FUTURE_FRAMES, model_cfg.OBJECT_TYPE)
+
+    ref_pred_trajs = None
+    for dtype_name in ['float32'] + args.amp_dtypes:
+        amp_dtype = None if dtype_name == 'float32' else getattr(torch, dtype_name)
+        decoder = copy.deepcopy(init_decoder)
+        optimizer = torch.optim.AdamW(decoder.parameters(), lr=1e-4, weight_decay=0.01)
+        scaler = torch.cuda.amp.GradScaler(enabled=(amp_dtype == torch.float16))
+
+        def train_step():
+            decoder.train()
+            optimizer.zero_grad()
+            with torch.cuda.amp.autocast(enabled=(amp_dtype is not None), dtype=amp_dtype or torch.float16):
+                decoder(dict(batch_dict))
+                loss, _, _ = decoder.get_loss()
+            scaler.scale(loss).backward()
+            scaler.unscale_(optimizer)
+            clip_grad_norm_(decoder.parameters(), cfg.OPTIMIZATION.GRAD_NORM_CLIP)
+            scaler.step(optimizer)
+            scaler.update()
+            return loss
+
+        def eval_step():
+            decoder.eval()
+            with torch.no_grad(), torch.cuda.amp.autocast(enabled=(amp_dtype is not None), dtype=amp_dtype or torch.float16):
+                return decoder(dict(batch_dict))['pred_trajs']
+
+        pred_trajs = eval_step()
+        assert pred_trajs.dtype == torch.float32
+        if ref_pred_trajs is None:
+            ref_pred_trajs = pred_trajs
+        pred_error = (pred_trajs[..., 0:2] - ref_pred_trajs[..., 0:2]).norm(dim=-1).mean().item()
+        first_loss = train_step().item()
+        assert np.isfinite(first_loss), f'the loss of {dtype_name} is not finite'
+
+        train_ms, train_memory = measure(train_step, args.num_repeats)
+        eval_ms, eval_memory = measure(eval_step, args.num_repeats)
+        print(f'{dtype_name}: train {args.num_center_objects / train_ms * 1000:.1f} center objects/s, peak memory {train_memory:.1f} MB, first loss {first_loss:.3f}; '
+              f'eval {args.num_center_objects / eval_ms * 1000:.1f} center objects/s, peak memory {eval_memory:.1f} MB, '
+              f'mean xy error to float32 {pred_error:.4f} m')
+
+
+if __name__ == '__main__':
+    main()
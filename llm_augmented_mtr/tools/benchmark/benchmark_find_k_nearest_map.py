@@ -0,0 +1,80 @@
+"""
+Compare find_k_nearest_map_embedding (masked squared distances + topk + gather) with the previous implementation
+(in-place write of 1e8 into map_pos, norm + topk, indexing with a hardcoded 256 width) on random batches,
+the results are checked to be identical and the time of each implementation is reported
+
+python benchmark_find_k_nearest_map.py --num_agents 40 --num_polylines 768 --k 32
+"""
+
+import _init_path
+import argparse
+import time
+
+import torch
+
+from LLM_integrate.tools.generate_feature_vector_utils.generate_feature_vector_utils import find_k_nearest_map_embedding
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--num_agents', type=int, nargs='+', default=[8, 40, 160], help='number of center objects in a batch')
+    parser.add_argument('--num_polylines', type=int, default=768, help='number of map polylines of each agent')
+    parser.add_argument('--num_channels', type=int, default=256, help='width of the map feature')
+    parser.add_argument('--k', type=int, default=32, help='number of nearest polylines')
+    parser.add_argument('--invalid_ratio', type=float, default=0.3, help='ratio of invalid polylines')
+    parser.add_argument('--num_repeats', type=int, default=50, help='number of repeats for timing')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    return args
+
+
+def find_k_nearest_map_embedding_legacy(k, map_feature, map_pos, map_mask):
+    map_pos[~map_mask] = 100000000
+    num_of_agent, num_of_polyline, _ = map_pos.shape
+    distance = map_pos[:,:,:2].to(map_pos.device).norm(dim=-1)
+    topk_dist, polyline_idxs = distance.topk(k=k, dim=-1, largest=False)
+    polyline_mask = (topk_dist > 100000000)
+    agent_idx = torch.arange(num_of_agent).view(-1, 1).expand(-1, k)
+    need_map_feature = map_feature[agent_idx, polyline_idxs]
+    need_map_feature[polyline_mask.unsqueeze(-1).expand(-1, -1, 256)] = 0.0
+    need_map_feature = need_map_feature.view(num_of_agent, -1)
+    return need_map_feature
+
+
+def measure(func, num_repeats, device):
+    func()  # warm up
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        func()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / num_repeats * 1000
+
+
+def main():
+    args = parse_config()
+    torch.manual_seed(0)
+    for num_agents in args.num_agents:
+        map_feature = torch.randn(num_agents, args.num_polylines, args.num_channels, device=args.device)
+        map_pos = torch.randn(num_agents, args.num_polylines, 3, device=args.device) * 100
+        map_mask = torch.rand(num_agents, args.num_polylines, device=args.device) > args.invalid_ratio
+        map_mask[0, args.k // 2:] = False  # less than k valid polylines
+
+        new_result = find_k_nearest_map_embedding(map_feature, map_pos, map_mask, k=args.k)
+        # the legacy implementation modifies map_pos, and only supports 256 channels
+        if args.num_channels == 256:
+            legacy_result = find_k_nearest_map_embedding_legacy(args.k, map_feature, map_pos.clone(), map_mask)
+            assert torch.equal(new_result, legacy_result), 'results are different from the legacy implementation'
+            legacy_ms = measure(lambda: find_k_nearest_map_embedding_legacy(args.k, map_feature, map_pos.clone(), map_mask), args.num_repeats, args.device)
+        else:
+            legacy_ms = float('nan')
+        new_ms = measure(lambda: find_k_nearest_map_embedding(map_feature, map_pos, map_mask, k=args.k), args.num_repeats, args.device)
+
+        print(f'device={args.device}, num_agents={num_agents}, num_polylines={args.num_polylines}, k={args.k}: '
+              f'legacy {legacy_ms:.3f} ms, new {new_ms:.3f} ms (x{legacy_ms / new_ms:.2f})')
+
+
+if __name__ == '__main__':
+    main()
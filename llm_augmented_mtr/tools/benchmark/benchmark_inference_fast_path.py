@@ -0,0 +1,97 @@
+"""
+Compare the eval forward of MTRDecoder with and without USE_INFERENCE_FAST_PATH (no dense future trajectories, only the waypoints
+of the intermediate decoder layers) on random encoder outputs: the final predictions are checked to be the same,
+the latency and the peak memory (on GPU) of each batch are reported
+
+python benchmark_inference_fast_path.py --cfg_file ../cfgs/waymo/mtr+20_percent_data.yaml --num_center_objects 8 40
+"""
+
+import _init_path
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from mtr.config import cfg, cfg_from_yaml_file
+from mtr.models.motion_decoder.mtr_decoder import MTRDecoder
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--cfg_file', type=str, default='../cfgs/waymo/mtr+20_percent_data.yaml', help='specify the config of the decoder')
+    parser.add_argument('--num_center_objects', type=int, nargs='+', default=[8, 40], help='number of center objects in a batch')
+    parser.add_argument('--num_objects', type=int, default=64, help='number of objects of each center object')
+    parser.add_argument('--num_polylines', type=int, default=768, help='number of map polylines of each center object')
+    parser.add_argument('--num_repeats', type=int, default=5, help='number of repeats for timing')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    return args
+
+
+def generate_batch_dict(args, num_center_objects, in_channels, object_type, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    obj_mask = torch.rand(num_center_objects, args.num_objects, generator=generator) > 0.3
+    map_mask = torch.rand(num_center_objects, args.num_polylines, generator=generator) > 0.2
+    obj_mask[:, 0] = map_mask[:, 0] = True
+    batch_dict = {
+        'obj_feature': torch.randn(num_center_objects, args.num_objects, in_channels, generator=generator),
+        'obj_mask': obj_mask,
+        'obj_pos': (torch.rand(num_center_objects, args.num_objects, 3, generator=generator) - 0.5) * 100,
+        'map_feature': torch.randn(num_center_objects, args.num_polylines, in_channels, generator=generator),
+        'map_mask': map_mask,
+        'map_pos': (torch.rand(num_center_objects, args.num_polylines, 3, generator=generator) - 0.5) * 200,
+        'center_objects_feature': torch.randn(num_center_objects, in_channels, generator=generator),
+    }
+    batch_dict = {key: val.to(args.device) for key, val in batch_dict.items()}
+    batch_dict['input_dict'] = {'center_objects_type': np.array(object_type)[np.arange(num_center_objects) % len(object_type)]}
+    return batch_dict
+
+
+def measure(func, num_repeats, device):
+    func()  # warm up
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        func()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+        peak_memory = (torch.cuda.max_memory_allocated() - base_memory) / 1024 ** 2
+    else:
+        peak_memory = float('nan')
+    return (time.perf_counter() - start_time) / num_repeats * 1000, peak_memory
+
+
+def main():
+    args = parse_config()
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    model_cfg = cfg.MODEL.MOTION_DECODER
+    model_cfg.LOAD_CONTEXT_DATA = False
+    in_channels = cfg.MODEL.CONTEXT_ENCODER.D_MODEL
+    decoder = MTRDecoder(in_channels=in_channels, config=model_cfg).to(args.device).eval()
+
+    def run(batch_dict, use_inference_fast_path):
+        decoder.use_inference_fast_path = use_inference_fast_path
+        decoder.forward_ret_dict = {}
+        cur_batch_dict = decoder(dict(batch_dict))
+        return cur_batch_dict['pred_scores'], cur_batch_dict['pred_trajs']
+
+    with torch.no_grad():
+        for num_center_objects in args.num_center_objects:
+            batch_dict = generate_batch_dict(args, num_center_objects, in_channels, model_cfg.OBJECT_TYPE)
+            pred_scores, pred_trajs = run(batch_dict, use_inference_fast_path=False)
+            fast_pred_scores, fast_pred_trajs = run(batch_dict, use_inference_fast_path=True)
+            assert torch.allclose(pred_scores, fast_pred_scores, atol=1e-5) and torch.allclose(pred_trajs, fast_pred_trajs, atol=1e-3), \
+                'the predictions of the fast path are different'
+
+            full_ms, full_memory = measure(lambda: run(batch_dict, use_inference_fast_path=False), args.num_repeats, args.device)
+            fast_ms, fast_memory = measure(lambda: run(batch_dict, use_inference_fast_path=True), args.num_repeats, args.device)
+            print(f'device={args.device}, num_center_objects={num_center_objects}, num_objects={args.num_objects}, num_polylines={args.num_polylines}: '
+                  f'full {full_ms:.1f} ms / {full_memory:.1f} MB, fast path {fast_ms:.1f} ms / {fast_memory:.1f} MB (x{full_ms / fast_ms:.2f})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Compare the map collection of the decoder layers: apply_dynamic_map_collection (the distance tensor of all waypoints, sort for the dedup)
+and apply_dynamic_map_collection_fast (FAST_MAP_COLLECTION, running min of squared distances, scatter dedup) with the waypoint strides
+of MAP_COLLECTION_WAYPOINT_STRIDE, on random trajectories. Reports the time, the peak memory (on GPU) and the overlap of the collected
+polylines with the original ones (1.0 for stride 1 up to the ties of the topk). The effect on the validation mAP is evaluated by
+tools/test.py with the flags set in the config
+
+python benchmark_map_collection.py --cfg_file ../cfgs/waymo/mtr+20_percent_data.yaml --num_center_objects 40 --strides 1 2 4 8
+"""
+
+import _init_path
+import argparse
+import time
+
+import torch
+
+from mtr.config import cfg, cfg_from_yaml_file
+from mtr.models.motion_decoder.mtr_decoder import MTRDecoder
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--cfg_file', type=str, default='../cfgs/waymo/mtr+20_percent_data.yaml', help='specify the config of the decoder')
+    parser.add_argument('--num_center_objects', type=int, default=40, help='number of center objects in a batch')
+    parser.add_argument('--num_polylines', type=int, default=768, help='number of map polylines of each center object')
+    parser.add_argument('--invalid_ratio', type=float, default=0.2, help='ratio of invalid polylines')
+    parser.add_argument('--strides', type=int, nargs='+', default=[1, 2, 4, 8], help='waypoint strides of the fast collection')
+    parser.add_argument('--num_repeats', type=int, default=10, help='number of repeats for timing')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+    return args
+
+
+def generate_inputs(args, num_query, num_future_frames, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    map_pos = (torch.rand(args.num_center_objects, args.num_polylines, 3, generator=generator) - 0.5) * 200
+    map_mask = torch.rand(args.num_center_objects, args.num_polylines, generator=generator) > args.invalid_ratio
+    map_mask[0, 100:] = False  # less valid polylines than NUM_BASE_MAP_POLYLINES
+    # random walks from the origin (~1.5m per frame)
+    steps = torch.randn(args.num_center_objects, num_query, num_future_frames, 2, generator=generator) * 1.5
+    pred_waypoints = torch.cumsum(steps, dim=2)
+    return map_pos.to(args.device), map_mask.to(args.device), pred_waypoints.to(args.device)
+
+
+def get_overlap(collected_idxs, ref_collected_idxs, num_polylines):
+    """
+    Returns:
+        the ratio of the valid polylines of ref_collected_idxs which are also in collected_idxs
+    """
+    def to_mask(idxs):
+        idxs = idxs.long()
+        mask = torch.zeros(*idxs.shape[:-1], num_polylines + 1, dtype=torch.bool, device=idxs.device)
+        mask.scatter_(dim=-1, index=torch.where(idxs < 0, num_polylines, idxs), value=True)
+        return mask[..., :num_polylines]
+
+    mask, ref_mask = to_mask(collected_idxs), to_mask(ref_collected_idxs)
+    return float((mask & ref_mask).sum()) / max(float(ref_mask.sum()), 1.0)
+
+
+def measure(func, num_repeats, device):
+    func()  # warm up
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base_memory = torch.cuda.memory_allocated()
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        func()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+        peak_memory = (torch.cuda.max_memory_allocated() - base_memory) / 1024 ** 2
+    else:
+        peak_memory = float('nan')
+    return (time.perf_counter() - start_time) / num_repeats * 1000, peak_memory
+
+
+def main():
+    args = parse_config()
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    model_cfg = cfg.MODEL.MOTION_DECODER
+    model_cfg.LOAD_CONTEXT_DATA = False
+    decoder = MTRDecoder(in_channels=cfg.MODEL.CONTEXT_ENCODER.D_MODEL, config=model_cfg).to(args.device)
+
+    num_query = decoder.intention_points.shape[1]
+    map_pos, map_mask, pred_waypoints = generate_inputs(args, num_query, model_cfg.NUM_FUTURE_FRAMES)
+    collection_kwargs = dict(
+        map_pos=map_pos, map_mask=map_mask, pred_waypoints=pred_waypoints,
+        base_region_offset=model_cfg.CENTER_OFFSET_OF_MAP,
+        num_waypoint_polylines=model_cfg.NUM_WAYPOINT_MAP_POLYLINES,
+        num_base_polylines=model_cfg.NUM_BASE_MAP_POLYLINES,
+        num_query=num_query
+    )
+
+    with torch.no_grad():
+        ref_collected_idxs, _ = decoder.apply_dynamic_map_collection(**collection_kwargs)
+        ref_ms, ref_memory = measure(lambda: decoder.apply_dynamic_map_collection(**collection_kwargs), args.num_repeats, args.device)
+        print(f'device={args.device}, num_center_objects={args.num_center_objects}, num_query={num_query}, '
+              f'num_polylines={args.num_polylines}, num_timestamps={pred_waypoints.shape[2]}')
+        print(f'original: {ref_ms:.3f} ms, peak memory {ref_memory:.1f} MB')
+
+        for stride in args.strides:
+            collected_idxs, _ = decoder.apply_dynamic_map_collection_fast(**collection_kwargs, waypoint_stride=stride)
+            overlap = get_overlap(collected_idxs, ref_collected_idxs, args.num_polylines)
+            if stride == 1:
+                assert overlap > 0.999, f'the fast collection is different from the original one (overlap {overlap:.4f})'
+            fast_ms, fast_memory = measure(
+                lambda: decoder.apply_dynamic_map_collection_fast(**collection_kwargs, waypoint_stride=stride), args.num_repeats, args.device
+            )
+            print(f'fast (stride={stride}): {fast_ms:.3f} ms (x{ref_ms / fast_ms:.2f}), peak memory {fast_memory:.1f} MB, '
+                  f'overlap with the original {overlap:.4f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Compare the vectorized WaymoDataset.generate_batch_polylines_from_map with the previous python loop implementation
+on real scenarios, both the outputs (should be bit-identical) and the time cost are reported
+
+python benchmark_map_polylines.py --cfg_file ../cfgs/waymo/mtr+100_percent_data.yaml --split valid --num_scenarios 500
+"""
+
+import _init_path
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from mtr.config import cfg, cfg_from_yaml_file
+from mtr.datasets.waymo.waymo_dataset import WaymoDataset
+from mtr.utils import common_utils
+
+
+def generate_batch_polylines_from_map_loop(polylines, point_sampled_interval=1, vector_break_dist_thresh=1.0, num_points_each_polyline=20):
+    """
+    The previous implementation of WaymoDataset.generate_batch_polylines_from_map, used as the reference
+    """
+    point_dim = polylines.shape[-1]
+
+    sampled_points = polylines[::point_sampled_interval]
+    sampled_points_shift = np.roll(sampled_points, shift=1, axis=0)
+    buffer_points = np.concatenate((sampled_points[:, 0:2], sampled_points_shift[:, 0:2]), axis=-1) # [ed_x, ed_y, st_x, st_y]
+    buffer_points[0, 2:4] = buffer_points[0, 0:2]
+
+    break_idxs = (np.linalg.norm(buffer_points[:, 0:2] - buffer_points[:, 2:4], axis=-1) > vector_break_dist_thresh).nonzero()[0]
+    polyline_list = np.array_split(sampled_points, break_idxs, axis=0)
+    ret_polylines = []
+    ret_polylines_mask = []
+
+    def append_single_polyline(new_polyline):
+        cur_polyline = np.zeros((num_points_each_polyline, point_dim), dtype=np.float32)
+        cur_valid_mask = np.zeros((num_points_each_polyline), dtype=np.int32)
+        cur_polyline[:len(new_polyline)] = new_polyline
+        cur_valid_mask[:len(new_polyline)] = 1
+        ret_polylines.append(cur_polyline)
+        ret_polylines_mask.append(cur_valid_mask)
+
+    for k in range(len(polyline_list)):
+        if polyline_list[k].__len__() <= 0:
+            continue
+        for idx in range(0, len(polyline_list[k]), num_points_each_polyline):
+            append_single_polyline(polyline_list[k][idx: idx + num_points_each_polyline])
+
+    ret_polylines = np.stack(ret_polylines, axis=0)
+    ret_polylines_mask = np.stack(ret_polylines_mask, axis=0)
+
+    ret_polylines = torch.from_numpy(ret_polylines)
+    ret_polylines_mask = torch.from_numpy(ret_polylines_mask)
+    return ret_polylines, ret_polylines_mask
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--cfg_file', type=str, default=None, help='specify the config of dataset')
+    parser.add_argument('--split', type=str, default='valid', help='train | valid | test')
+    parser.add_argument('--num_scenarios', type=int, default=500, help='number of scenarios to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='repeat times of each implementation')
+    args = parser.parse_args()
+
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    return args, cfg
+
+
+def main():
+    args, cfg = parse_config()
+    logger = common_utils.create_logger()
+
+    dataset_cfg = cfg.DATA_CONFIG
+    dataset_cfg.LOAD_CONTEXT_DATA = False
+    dataset = WaymoDataset(dataset_cfg=dataset_cfg, training=(args.split == 'train'), logger=logger, dataset_type=args.split)
+
+    polylines_list = []
+    for info in dataset.infos[:args.num_scenarios]:
+        all_polylines = np.array(dataset.load_scenario_info(info['scenario_id'])['map_infos']['all_polylines'])
+        if len(all_polylines) > 0:
+            polylines_list.append(all_polylines)
+    map_kwargs = dict(
+        point_sampled_interval=dataset_cfg.get('POINT_SAMPLED_INTERVAL', 1),
+        vector_break_dist_thresh=dataset_cfg.get('VECTOR_BREAK_DIST_THRESH', 1.0),
+        num_points_each_polyline=dataset_cfg.get('NUM_POINTS_EACH_POLYLINE', 20),
+    )
+    logger.info(f'Benchmark on {len(polylines_list)} scenarios, average number of map points: {np.mean([len(x) for x in polylines_list]):.1f}')
+
+    # check the outputs
+    for polylines in polylines_list:
+        ref_polylines, ref_polylines_mask = generate_batch_polylines_from_map_loop(polylines, **map_kwargs)
+        new_polylines, new_polylines_mask = WaymoDataset.generate_batch_polylines_from_map(polylines, **map_kwargs)
+        assert ref_polylines.dtype == new_polylines.dtype and ref_polylines_mask.dtype == new_polylines_mask.dtype
+        assert torch.equal(ref_polylines, new_polylines) and torch.equal(ref_polylines_mask, new_polylines_mask)
+    logger.info('The outputs of the two implementations are bit-identical')
+
+    for name, func in [('loop', generate_batch_polylines_from_map_loop), ('vectorized', WaymoDataset.generate_batch_polylines_from_map)]:
+        time_cost = []
+        for _ in range(args.repeat):
+            start_time = time.perf_counter()
+            for polylines in polylines_list:
+                func(polylines, **map_kwargs)
+            time_cost.append(time.perf_counter() - start_time)
+        logger.info(f'{name:>10s}: {min(time_cost) / len(polylines_list) * 1000:.3f} ms / scenario')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Report the time of the knn / attention ops on random inputs, with the pure PyTorch implementations (mtr/ops/*/*_torch.py) on CPU
+and the CUDA ops if they are compiled and a GPU is available. Their parity is checked by tests/test_ops_torch_fallback.py
+
+python benchmark_ops_torch_fallback.py --num_batches 4 --max_num_points 200 --k 16
+"""
+
+import _init_path
+import argparse
+import time
+
+import torch
+
+from mtr.ops.attention import attention_utils_v2
+from mtr.ops.knn import knn_utils
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--num_batches', type=int, default=4, help='number of batches of the stacked points')
+    parser.add_argument('--max_num_points', type=int, default=200, help='max number of points of each batch')
+    parser.add_argument('--k', type=int, default=16, help='number of neighbors (local_size of the attention)')
+    parser.add_argument('--nhead', type=int, default=8, help='number of attention heads')
+    parser.add_argument('--hdim', type=int, default=32, help='channels of each head')
+    parser.add_argument('--num_repeats', type=int, default=10, help='number of repeats for timing')
+    args = parser.parse_args()
+    return args
+
+
+def generate_inputs(args, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batch_cnt = torch.randint(1, args.max_num_points + 1, (args.num_batches,), generator=generator).int()
+    batch_cnt[0] = max(args.k // 2, 1)  # less than k points
+    batch_offsets = torch.cat((torch.zeros(1, dtype=torch.int32), torch.cumsum(batch_cnt, dim=0).int()))
+    batch_idxs = torch.repeat_interleave(torch.arange(args.num_batches, dtype=torch.int32), batch_cnt.long())
+    xyz = torch.rand(int(batch_offsets[-1]), 3, generator=generator) * 100
+    features = [torch.randn(int(batch_offsets[-1]), args.nhead, args.hdim, generator=generator) for _ in range(3)]
+    return xyz, batch_idxs, batch_cnt, batch_offsets, features
+
+
+def measure(func, num_repeats, device):
+    func()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(num_repeats):
+        func()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / num_repeats * 1000
+
+
+def benchmark(args):
+    xyz, batch_idxs, batch_cnt, batch_offsets, (query_features, key_features, value_features) = generate_inputs(args, seed=2)
+    devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() and knn_utils.knn_cuda is not None else [])
+    for device in devices:
+        cur_inputs = [x.to(device) for x in (xyz, batch_idxs, batch_cnt, batch_offsets, query_features, key_features, value_features)]
+        cur_xyz, cur_batch_idxs, cur_batch_cnt, cur_batch_offsets, cur_query, cur_key, cur_value = cur_inputs
+        index_pair = knn_utils.knn_batch_mlogk(cur_xyz, cur_xyz, cur_batch_idxs, cur_batch_offsets, args.k)
+        attn_weight = attention_utils_v2.attention_weight_computation(cur_batch_cnt, cur_batch_cnt, cur_batch_idxs, index_pair, cur_query, cur_key)
+        knn_ms = measure(lambda: knn_utils.knn_batch_mlogk(cur_xyz, cur_xyz, cur_batch_idxs, cur_batch_offsets, args.k), args.num_repeats, device)
+        weight_ms = measure(lambda: attention_utils_v2.attention_weight_computation(
+            cur_batch_cnt, cur_batch_cnt, cur_batch_idxs, index_pair, cur_query, cur_key), args.num_repeats, device)
+        value_ms = measure(lambda: attention_utils_v2.attention_value_computation(
+            cur_batch_cnt, cur_batch_cnt, cur_batch_idxs, index_pair, attn_weight, cur_value), args.num_repeats, device)
+        print(f'device={device.type}, num_points={xyz.shape[0]}, k={args.k}: '
+              f'knn {knn_ms:.3f} ms, attention weight {weight_ms:.3f} ms, attention value {value_ms:.3f} ms')
+
+
+def main():
+    args = parse_config()
+    benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Compare the default dataloader outputs with the compact transport (COMPACT_TRANSPORT: float16 features and bit-packed masks),
+the bytes moved per batch and the end-to-end samples/sec (dataloader + host to device copy + model forward) are reported
+
+python benchmark_transport.py --cfg_file ../cfgs/waymo/mtr+100_percent_data.yaml --batch_size 8 --num_batches 100
+"""
+
+import _init_path
+import argparse
+import copy
+import time
+
+import numpy as np
+import torch
+
+from mtr.config import cfg, cfg_from_yaml_file
+from mtr.datasets import build_dataloader
+from mtr.models import model as model_utils
+from mtr.utils import common_utils
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description='arg parser')
+    parser.add_argument('--cfg_file', type=str, default=None, help='specify the config')
+    parser.add_argument('--batch_size', type=int, default=8, help='batch size (number of scenes)')
+    parser.add_argument('--workers', type=int, default=8, help='number of workers for dataloader')
+    parser.add_argument('--num_batches', type=int, default=100, help='number of batches for each mode')
+    parser.add_argument('--dataset_type', type=str, default='valid', help='train | valid | test')
+    parser.add_argument('--without_model', action='store_true', default=False, help='only measure the dataloader and the host to device copy')
+    args = parser.parse_args()
+
+    cfg_from_yaml_file(args.cfg_file, cfg)
+    cfg.MODEL.MOTION_DECODER.LOAD_CONTEXT_DATA = cfg.DATA_CONFIG.LOAD_CONTEXT_DATA
+    cfg.MODEL.GENERATE_EMBEDDING = cfg.DATA_CONFIG.GENERATE_EMBEDDING
+    if cfg.DATA_CONFIG.LOAD_CONTEXT_DATA:
+        cfg.MODEL.MOTION_DECODER.RETRIEVAL_WINDOW_SIZE = cfg.DATA_CONFIG.RETRIEVAL_WINDOW_SIZE
+    return args, cfg
+
+
+def get_batch_nbytes(input_dict):
+    nbytes = 0
+    for val in input_dict.values():
+        if isinstance(val, torch.Tensor):
+            nbytes += val.element_size() * val.numel()
+    return nbytes
+
+
+def benchmark_single_mode(args, dataset_cfg, model, logger):
+    _, dataloader, _ = build_dataloader(
+        dataset_cfg=dataset_cfg, batch_size=args.batch_size, dist=False, workers=args.workers,
+        logger=logger, training=False, dataset_type=args.dataset_type
+    )
+
+    nbytes_list, num_samples = [], 0
+    dataloader_iter = iter(dataloader)
+    next(dataloader_iter)  # warm up the workers
+
+    torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(args.num_batches):
+        try:
+            batch_dict = next(dataloader_iter)
+        except StopIteration:
+            break
+        input_dict = batch_dict['input_dict']
+        nbytes_list.append(get_batch_nbytes(input_dict))
+        num_samples += input_dict['center_objects_world'].shape[0]
+
+        if model is not None:
+            with torch.no_grad():
+                model(batch_dict)
+        else:
+            for key, val in input_dict.items():
+                if isinstance(val, torch.Tensor):
+                    input_dict[key] = val.cuda(non_blocking=True)
+    torch.cuda.synchronize()
+    time_cost = time.perf_counter() - start_time
+
+    return np.mean(nbytes_list), num_samples / time_cost
+
+
+def main():
+    args, cfg = parse_config()
+    logger = common_utils.create_logger()
+    assert torch.cuda.is_available(), 'the benchmark needs a GPU'
+
+    model = None
+    if not args.without_model:
+        model = model_utils.MotionTransformer(config=cfg.MODEL)
+        model.cuda()
+        model.eval()
+
+    results = {}
+    for mode in ['default', 'compact']:
+        dataset_cfg = copy.deepcopy(cfg.DATA_CONFIG)
+        dataset_cfg.COMPACT_TRANSPORT = (mode == 'compact')
+        results[mode] = benchmark_single_mode(args, dataset_cfg, model, logger)
+        logger.info(f'{mode:>8s}: {results[mode][0] / 1024 ** 2:.2f} MB / batch, {results[mode][1]:.1f} samples / sec')
+
+    logger.info(f'compact transport: {results["compact"][0] / results["default"][0] * 100:.1f}% bytes per batch, '
+                f'{results["compact"][1] / results["default"][1]:.2f}x samples / sec')
+
+
+if __name__ == '__main__':
+    main()
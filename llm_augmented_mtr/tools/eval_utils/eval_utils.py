@@ -38,10 +38,13 @@ def eval_one_epoch(cfg, model, dataloader, epoch_id, logger, dist_test=False, sa
         progress_bar = tqdm.tqdm(total=len(dataloader), leave=True, desc='eval', dynamic_ncols=True)
     start_time = time.time()
 
+    amp_dtype = common_utils.get_amp_dtype(cfg.OPTIMIZATION)
+    device_type = next(model.parameters()).device.type
     pred_dicts = []
     for i, batch_dict in enumerate(dataloader):
         with torch.no_grad():
-            batch_pred_dicts = model(batch_dict)
+            with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=(amp_dtype is not None)):
+                batch_pred_dicts = model(batch_dict)
             final_pred_dicts = dataset.generate_prediction_dicts(batch_pred_dicts, output_path=final_output_dir if save_to_file else None)
             pred_dicts += final_pred_dicts
 
@@ -178,6 +178,8 @@ def main():
     model.cuda()
 
     optimizer = build_optimizer(model, cfg.OPTIMIZATION)
+    # the loss scale of float16 AMP is saved and resumed with the optimizer
+    scaler = torch.cuda.amp.GradScaler(enabled=(common_utils.get_amp_dtype(cfg.OPTIMIZATION) == torch.float16))
 
     # load checkpoint if it is possible
     start_epoch = it = 0
@@ -188,7 +190,7 @@ def main():
 
     if args.ckpt is not None:
         it, start_epoch = model.load_params_with_optimizer(args.ckpt, to_cpu=dist_train, optimizer=optimizer,
-                                                           logger=logger) # type: ignore
+                                                           logger=logger, scaler=scaler) # type: ignore
         last_epoch = start_epoch + 1
     else:
         ckpt_list = glob.glob(str(ckpt_dir / '*.pth'))
@@ -202,7 +204,7 @@ def main():
 
                 try:
                     it, start_epoch = model.load_params_with_optimizer(
-                        ckpt_list[-1], to_cpu=dist_train, optimizer=optimizer, logger=logger
+                        ckpt_list[-1], to_cpu=dist_train, optimizer=optimizer, logger=logger, scaler=scaler
                     ) # type: ignore
                     last_epoch = start_epoch + 1
                     break
@@ -254,7 +256,8 @@ def main():
         eval_output_dir=eval_output_dir,
         test_loader=test_loader if not args.not_eval_with_train else None,
         cfg=cfg, dist_train=dist_train, logger_iter_interval=args.logger_iter_interval,
-        ckpt_save_time_interval=args.ckpt_save_time_interval
+        ckpt_save_time_interval=args.ckpt_save_time_interval,
+        scaler=scaler
     )
 
     logger.info('**********************End training %s/%s(%s)**********************\n\n\n'
@@ -10,15 +10,24 @@ import torch
 import tqdm
 from torch.nn.utils import clip_grad_norm_
 
+from mtr.utils import common_utils
+
 
 def train_one_epoch(model, optimizer, train_loader, accumulated_iter, optim_cfg,
                     rank, tbar, total_it_each_epoch, dataloader_iter, tb_log=None, leave_pbar=False, scheduler=None, show_grad_curve=False,
-                    logger=None, logger_iter_interval=50, cur_epoch=None, total_epochs=None, ckpt_save_dir=None, ckpt_save_time_interval=300):
+                    logger=None, logger_iter_interval=50, cur_epoch=None, total_epochs=None, ckpt_save_dir=None, ckpt_save_time_interval=300,
+                    scaler=None):
     if total_it_each_epoch == len(train_loader):
         dataloader_iter = iter(train_loader)
 
     optimizer, optimizer_2 = optimizer if isinstance(optimizer, list) else (optimizer, None)
 
+    amp_dtype = common_utils.get_amp_dtype(optim_cfg)
+    if scaler is None:
+        scaler = torch.cuda.amp.GradScaler(enabled=(amp_dtype == torch.float16))
+    # autocast on the device of the model (CUDA, or bfloat16 on CPU)
+    device_type = next(model.parameters()).device.type
+
     if rank == 0:
         pbar = tqdm.tqdm(total=total_it_each_epoch, leave=leave_pbar, desc='train', dynamic_ncols=True)
 
@@ -49,16 +58,22 @@ def train_one_epoch(model, optimizer, train_loader, accumulated_iter, optim_cfg,
         if optimizer_2 is not None:
             optimizer_2.zero_grad()
 
-        loss, tb_dict, disp_dict = model(batch)
+        with torch.autocast(device_type=device_type, dtype=amp_dtype, enabled=(amp_dtype is not None)):
+            loss, tb_dict, disp_dict = model(batch)
 
-        loss.backward()
+        # the scaler is only enabled for float16, otherwise these calls are the plain backward / step
+        scaler.scale(loss).backward()
 
+        scaler.unscale_(optimizer)
+        if optimizer_2 is not None:
+            scaler.unscale_(optimizer_2)
         total_norm = clip_grad_norm_(model.parameters(), optim_cfg.GRAD_NORM_CLIP)
 
-        optimizer.step()
+        scaler.step(optimizer)
 
         if optimizer_2 is not None:
-            optimizer_2.step()
+            scaler.step(optimizer_2)
+        scaler.update()
 
         accumulated_iter += 1
         disp_dict.update({'loss': loss.item(), 'lr': cur_lr})
@@ -95,7 +110,7 @@ def train_one_epoch(model, optimizer, train_loader, accumulated_iter, optim_cfg,
             if time_past_this_epoch // ckpt_save_time_interval >= ckpt_save_cnt:
                 ckpt_name = ckpt_save_dir / 'latest_model'
                 save_checkpoint(
-                    checkpoint_state(model, optimizer, cur_epoch, accumulated_iter), filename=ckpt_name,
+                    checkpoint_state(model, optimizer, cur_epoch, accumulated_iter, scaler=scaler), filename=ckpt_name,
                 )
                 logger.info(f'Save latest model to {ckpt_name}')
                 ckpt_save_cnt += 1
@@ -123,7 +138,7 @@ def train_model(model, optimizer, train_loader, optim_cfg,
                 start_epoch, total_epochs, start_iter, rank, ckpt_save_dir, train_sampler=None,
                 ckpt_save_interval=1, max_ckpt_save_num=50, merge_all_iters_to_one_epoch=False, tb_log=None,
                 scheduler=None, test_loader=None, logger=None, eval_output_dir=None, cfg=None, dist_train=False,
-                logger_iter_interval=50, ckpt_save_time_interval=300):
+                logger_iter_interval=50, ckpt_save_time_interval=300, scaler=None):
     accumulated_iter = start_iter
     with tqdm.trange(start_epoch, total_epochs, desc='epochs', dynamic_ncols=True, leave=(rank == 0)) as tbar:
         total_it_each_epoch = len(train_loader)
@@ -133,6 +148,9 @@ def train_model(model, optimizer, train_loader, optim_cfg,
             total_it_each_epoch = len(train_loader) // max(total_epochs, 1)
 
         dataloader_iter = iter(train_loader)
+        # keep the loss scale of float16 AMP across the epochs (the scaler restored from the checkpoint on resume)
+        if scaler is None:
+            scaler = torch.cuda.amp.GradScaler(enabled=(common_utils.get_amp_dtype(optim_cfg) == torch.float16))
         for cur_epoch in tbar:
             torch.cuda.empty_cache()
             if train_sampler is not None:
@@ -151,7 +169,8 @@ def train_model(model, optimizer, train_loader, optim_cfg,
                 dataloader_iter=dataloader_iter,
                 scheduler=scheduler, cur_epoch=cur_epoch, total_epochs=total_epochs,
                 logger=logger, logger_iter_interval=logger_iter_interval,
-                ckpt_save_dir=ckpt_save_dir, ckpt_save_time_interval=ckpt_save_time_interval
+                ckpt_save_dir=ckpt_save_dir, ckpt_save_time_interval=ckpt_save_time_interval,
+                scaler=scaler
             )
 
             # save trained model
@@ -167,7 +186,7 @@ def train_model(model, optimizer, train_loader, optim_cfg,
 
                 ckpt_name = ckpt_save_dir / ('checkpoint_epoch_%d' % trained_epoch)
                 save_checkpoint(
-                    checkpoint_state(model, optimizer, trained_epoch, accumulated_iter), filename=ckpt_name,
+                    checkpoint_state(model, optimizer, trained_epoch, accumulated_iter, scaler=scaler), filename=ckpt_name,
                 )
 
             # eval the model
@@ -226,8 +245,10 @@ def model_state_to_cpu(model_state):
     return model_state_cpu
 
 
-def checkpoint_state(model=None, optimizer=None, epoch=None, it=None):
+def checkpoint_state(model=None, optimizer=None, epoch=None, it=None, scaler=None):
     optim_state = optimizer.state_dict() if optimizer is not None else None
+    # the loss scale of float16 AMP, a disabled scaler has no state
+    scaler_state = scaler.state_dict() if scaler is not None and scaler.is_enabled() else None
     if model is not None:
         if isinstance(model, torch.nn.parallel.DistributedDataParallel):
             model_state = model_state_to_cpu(model.module.state_dict())
@@ -242,7 +263,9 @@ def checkpoint_state(model=None, optimizer=None, epoch=None, it=None):
     except:
         version = 'none'
 
-    return {'epoch': epoch, 'it': it, 'model_state': model_state, 'optimizer_state': optim_state, 'version': version}
+    return {
+        'epoch': epoch, 'it': it, 'model_state': model_state, 'optimizer_state': optim_state, 'scaler_state': scaler_state, 'version': version
+    }
 
 
 def save_checkpoint(state, filename='checkpoint'):